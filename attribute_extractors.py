@@ -5,7 +5,8 @@ import numpy as np
 import cv2
 from PIL import Image
 import os
-from constants import INPUT_RESOLUTION, PER_CHANNEL_MEAN, PER_CHANNEL_STD
+from devices import get_device, inference_mode, prepare_model, to_device
+from constants import INPUT_RESOLUTION, PER_CHANNEL_MEAN, PER_CHANNEL_STD, MGN_BATCH_SIZE
 
 
 def ndarraytopil(img):
@@ -21,23 +22,27 @@ class MgnWrapper:
 
     Attributes:
     model (MGN): MGN model architecture
+    device (torch.device): device the model runs on
     transform (Compose): transformations done to an image such as reshaping and normalizing
     """
-    def __init__(self, weights_path):
+    def __init__(self, weights_path, device='auto', num_threads=None):
         """
         The constructor for MgnWrapper class
 
         Parameters:
         weights_path (str): MGN model weights path (MGN.pt)
+        device (str): 'auto', 'cpu' or 'cuda'
+        num_threads (int): number of threads used for CPU inference
 
         """
         if not os.path.exists(weights_path):
             raise ValueError(
                 "Weights path given {} doesn't exist".format(weights_path))
+        self.device = get_device(device, num_threads)
         self.model = MGN()
-        self.model.load_state_dict(torch.load(weights_path))
-        self.model.cuda()
-        self.model.eval()
+        self.model.load_state_dict(
+            torch.load(weights_path, map_location=self.device))
+        prepare_model(self.model, self.device)
         self.transform = transforms.Compose([
             transforms.Resize(INPUT_RESOLUTION, interpolation=Image.BILINEAR),
             transforms.ToTensor(),
@@ -64,8 +69,9 @@ class MgnWrapper:
                 inputs = inputs.index_select(
                     3,
                     torch.arange(inputs.size(3) - 1, -1, -1).long())
-            input_img = inputs.to('cuda')
-            outputs = self.model(input_img)
+            input_img = to_device(inputs, self.device)
+            with inference_mode():
+                outputs = self.model(input_img)
             f = outputs[0].data.cpu()
             ff = ff + f
 
@@ -73,6 +79,41 @@ class MgnWrapper:
         ff = ff.div(fnorm.expand_as(ff))
         return ff
 
+    def compute_feat_vectors(self, inputs, batch_size=MGN_BATCH_SIZE):
+        """
+        Uses model to compute the feature vectors of many images at once
+
+        The original and horizontally flipped copies of every crop in a batch
+        are stacked into a single tensor so each batch needs one forward pass
+        and one device to host transfer.
+
+        Parameters:
+        inputs (list): list of PIL Images or ndarrays
+        batch_size (int): number of crops per forward pass
+
+        Returns:
+        ndarray: (N, 2048) float32 array of L2 normalized feature vectors
+        """
+        if batch_size < 1:
+            raise ValueError(
+                "batch_size must be positive, got {}".format(batch_size))
+        feats = np.empty((len(inputs), 2048), dtype=np.float32)
+        for start in range(0, len(inputs), batch_size):
+            batch = [
+                ndarraytopil(img) if isinstance(img, np.ndarray) else img
+                for img in inputs[start:start + batch_size]
+            ]
+            batch = torch.stack([self.transform(img) for img in batch]).float()
+            num = batch.size(0)
+            # Original crops followed by their mirror images
+            batch = torch.cat([batch, batch.flip(3)], dim=0)
+            with inference_mode():
+                outputs = self.model(to_device(batch, self.device))
+            ff = outputs[0][:num] + outputs[0][num:]
+            ff = ff.div(torch.norm(ff, p=2, dim=1, keepdim=True))
+            feats[start:start + num] = ff.cpu().numpy()
+        return feats
+
     def __call__(self, x):
         """ Return the feature vector of an image x """
         return self.compute_feat_vector(x)
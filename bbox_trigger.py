@@ -1,10 +1,67 @@
-from skimage.measure import compare_ssim
+try:
+    from skimage.metrics import structural_similarity
+except ImportError:
+    # scikit-image < 0.16
+    from skimage.measure import compare_ssim as structural_similarity
 import cv2
 from utils import crop_image
+from constants import TRIGGER_CHECK_STRIDE, TRIGGER_SSIM_MAX_SIDE
+from constants import TRIGGER_DIFF_THRESHOLD, TRIGGER_MIN_OVERLAP
+from constants import LT_EVICT_FRAMES
 import numpy as np
 import collections
 
 
+def ssim_size(coords, max_side=TRIGGER_SSIM_MAX_SIDE, min_side=7):
+    """
+    Returns the (width, height) a region is resized to before computing SSIM
+
+    The longest side is brought down to max_side, as long as the shortest side
+    stays at least min_side, the size of the SSIM window. Regions are never
+    upscaled.
+
+    Parameters:
+    coords (list): 2D list of the region coordinates
+    max_side (int): longest side after resizing
+    min_side (int): smallest allowed shortest side
+
+    Returns:
+    tuple: (width, height) of the resized region
+    """
+    width = coords[1][0] - coords[0][0]
+    height = coords[1][1] - coords[0][1]
+    scale = min(1.0, max_side / max(width, height))
+    scale = min(1.0, max(scale, min_side / min(width, height)))
+    return (max(int(round(width * scale)), 1),
+            max(int(round(height * scale)), 1))
+
+
+
+def boxes_in_region(boxes, coords, min_overlap=TRIGGER_MIN_OVERLAP):
+    """
+    Selects the boxes lying mostly inside a region
+
+    Parameters:
+    boxes (ndarray): (N, 4+) x1, y1, x2, y2 boxes in frame coordinates, extra columns are ignored
+    coords (list): 2D list of the region coordinates
+    min_overlap (float): smallest fraction of a box's area inside the region for it to be selected
+
+    Returns:
+    ndarray: (K, 4) selected boxes clipped to the region, in region coordinates
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    if boxes.size == 0:
+        return np.empty((0, 4), dtype=np.float32)
+    region = np.array([coords[0][0], coords[0][1], coords[1][0], coords[1][1]],
+                      dtype=np.float32)
+    clipped = np.empty((len(boxes), 4), dtype=np.float32)
+    clipped[:, [0, 2]] = np.clip(boxes[:, [0, 2]], region[0], region[2])
+    clipped[:, [1, 3]] = np.clip(boxes[:, [1, 3]], region[1], region[3])
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    inside = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+    keep = (area > 0) & (inside >= min_overlap * area)
+    return clipped[keep] - region[[0, 1, 0, 1]]
+
 
 class BboxTrigger:
     """
@@ -19,9 +76,26 @@ class BboxTrigger:
     _sample_coords (list): 2D list of trigger coordinates
     _detector (detector.py): object detector (default FasterRCNN)
     _check (int): flag for determining when triggering is in process
+    _check_stride (int): the door state is checked once every _check_stride frames
+    _diff_thresh (float): mean absolute gray level change of the check region below which the last SSIM score is reused
+    _ssim_size (tuple): (width, height) the check region is resized to before SSIM
+    _last_chkimg (ndarray): check region the last SSIM score was computed on
+    _score (float): last SSIM score
+    _frames (int): number of frames seen
+    _crop_detection (bool): whether people are detected on the trigger region crop instead of taken from the frame's detections
     """
-    def __init__(self, camera_id, ref_img, open_thresh, close_thresh,
-                 check_coords, sample_coords, detector):
+    def __init__(self,
+                 camera_id,
+                 ref_img,
+                 open_thresh,
+                 close_thresh,
+                 check_coords,
+                 sample_coords,
+                 detector,
+                 check_stride=TRIGGER_CHECK_STRIDE,
+                 diff_thresh=TRIGGER_DIFF_THRESHOLD,
+                 max_side=TRIGGER_SSIM_MAX_SIDE,
+                 crop_detection=False):
         """
         the constructor for BboxTrigger class
 
@@ -33,39 +107,70 @@ class BboxTrigger:
         _check_coords (list): 2D list of coordinates to check
         _sample_coords (list): 2D list of trigger coordinates
         _detector (detector.py): object detector (default FasterRCNN)
+        check_stride (int): the door state is checked once every check_stride frames
+        diff_thresh (float): mean absolute gray level change below which SSIM is not recomputed
+        max_side (int): longest side the check region is downscaled to before SSIM
+        crop_detection (bool): always run the detector on the trigger region crop, which finds smaller people than the full frame detections
 
         """
+        if check_stride < 1:
+            raise ValueError(
+                "check_stride must be positive, got {}".format(check_stride))
         self._camera_id = camera_id
         self._open_thresh = open_thresh
         self._close_thresh = close_thresh
         self._check_coords = check_coords
         self._sample_coords = sample_coords
         self._detector = detector  # ideally this is not here in the future either
-        self._ref_img = cv2.cvtColor(crop_image(ref_img, check_coords),
-                                     cv2.COLOR_BGR2GRAY)
+        self._check_stride = check_stride
+        self._crop_detection = crop_detection
+        self._diff_thresh = diff_thresh
+        self._ssim_size = ssim_size(check_coords, max_side)
+        self._ref_img = self._check_region(ref_img)
 
         self._check = 0
+        self._last_chkimg = None
+        self._score = None
+        self._frames = 0
+
+    @property
+    def camera_id(self):
+        """Returns the name of the camera this trigger watches"""
+        return self._camera_id
+
+    @property
+    def region(self):
+        """Returns the 2D list of coordinates of the trigger region"""
+        return self._sample_coords
 
-    def update(self, frames):
+    def update(self, frames, detections=None):
         """
         Given a image, find when to trigger and return bounding boxes of people in the trigger region
 
         Parameters:
         frames (dict): dictionary of frames from all the cameras
+        detections (ndarray): (N, 4+) boxes of the people detected or tracked in this camera's frame.
+                              The ones inside the trigger region are used instead of running the detector,
+                              None runs the detector on the trigger region crop
 
         Returns:
         bboxes (ndarry): bounding boxes of detected objects
         sampimg (ndarray): cropped image of the trigger region
         """
+        self._frames += 1
+        if (self._frames - 1) % self._check_stride != 0:
+            return False, None, None
+
         img = frames[self._camera_id]
-        chkimg = cv2.cvtColor(crop_image(img, self._check_coords),
-                              cv2.COLOR_BGR2GRAY)
-        score, diff = compare_ssim(self._ref_img, chkimg, full=True)
+        score = self._door_score(img)
 
         if self._check == 1:
             if score > self._close_thresh:
                 sampimg = crop_image(img, self._sample_coords)
-                bboxes, scores = self._detector.get_bboxes(sampimg)
+                if detections is None or self._crop_detection:
+                    bboxes, scores = self._detector.get_bboxes(sampimg)
+                else:
+                    bboxes = boxes_in_region(detections, self._sample_coords)
                 self._check = 0
                 return True, bboxes, sampimg
         else:
@@ -74,23 +179,47 @@ class BboxTrigger:
 
         return False, None, None
 
+    def _check_region(self, img):
+        """Returns the downscaled grayscale check region of img"""
+        chkimg = cv2.cvtColor(crop_image(img, self._check_coords),
+                              cv2.COLOR_BGR2GRAY)
+        if chkimg.shape[::-1] != self._ssim_size:
+            chkimg = cv2.resize(chkimg,
+                                self._ssim_size,
+                                interpolation=cv2.INTER_AREA)
+        return chkimg
+
+    def _door_score(self, img):
+        """
+        Returns the SSIM between the reference and the check region of img
+
+        SSIM is only recomputed when the check region changed noticeably since
+        the last time it was computed.
+        """
+        chkimg = self._check_region(img)
+        if self._last_chkimg is not None and cv2.absdiff(
+                chkimg, self._last_chkimg).mean() < self._diff_thresh:
+            return self._score
+        self._last_chkimg = chkimg
+        self._score = structural_similarity(self._ref_img, chkimg)
+        return self._score
+
 "use is completely different from BboxTrigger"
 class VectorTrigger:
     """
     This class is for a Line trigger
 
-
+    A person whose feet cross the line from the outside to the inside is
+    captured frame_offset frames later, as long as they stay within
+    length_thresh of the line's middle. The checks run in a LineTriggerBank,
+    together with the other lines.
     """
     def __init__(self, video, vector, inpt, length_thresh, frame_offset):
-        tmpvec = np.random.randn(2)
         maxx = max(vector[2], vector[0])
         minx = min(vector[2], vector[0])
         maxy = max(vector[3], vector[1])
         miny = min(vector[3], vector[1])
         invec = np.array([maxx - minx, maxy - miny])
-        # tmpvec -= tmpvec.dot(invec) * invec
-        # print(tmpvec.dot(invec))
-        # self.ovector = tmpvec / np.linalg.norm(tmpvec)
         self.ovector = np.array([invec[1], -1 * invec[0]])
         self.midpt = np.array([(vector[0] + vector[2])/2, (vector[1] + vector[3])/2])
         # 1 is in
@@ -99,40 +228,171 @@ class VectorTrigger:
         self.frame_offset = frame_offset
 
         self.video_oi = video
-        self.flags = collections.defaultdict(float)
-        self.prev_val = collections.defaultdict(float)
+        self._bank = None
 
     def update(self, peoplebboxes):
         """
         :param peoplebboxes: numpy array n x 5 with columns in x1, y1, x2, y2, id order
         :return: indexes to capture
         """
-        retval = list()
-        feetpoints = np.array([(peoplebboxes[:,0] + peoplebboxes[:,2])/2, np.max(peoplebboxes[:, [1,3]], 1)]).transpose()
-        displace_vects = self.midpt - feetpoints
-        disp_mags = np.linalg.norm(displace_vects, axis=1)
+        if self._bank is None:
+            self._bank = LineTriggerBank([self])
+        captures, _ = self._bank.update(self.video_oi, peoplebboxes)
+        return [index for index, _ in captures]
+
+
+# Crossing of a line by a tracked person. index is the row of the person's
+# box, line the index of the line in its bank, direction 1 when entering and
+# -1 when leaving, and frame the frame of the crossing
+LineCrossing = collections.namedtuple(
+    'LineCrossing', ['index', 'line', 'track_id', 'direction', 'frame'])
+
 
-        inout = np.sign(displace_vects.dot(self.ovector))
+class _LineGroup:
+    """
+    Lines of one camera and the state of the track ids near them
+
+    Attributes:
+    lines (ndarray): indexes of the lines in the bank
+    midpts (ndarray): (L, 2) middle point of each line
+    ovectors (ndarray): (L, 2) normal of each line, pointing out
+    length_thresh (ndarray): (L,) largest distance to the middle point of a checked person
+    frame_offset (ndarray): (L,) frames between entering and capture
+    flags (ndarray): (capacity, L) frames since each id entered, 0 when not entering
+    prev_val (ndarray): (capacity, L) side of the line each id was last seen on
+    last_seen (ndarray): (capacity,) frame each id was last seen on
+    rows (dict): row of the state arrays of each id
+    frames (int): number of updates
+    """
+    def __init__(self, lines, triggers, capacity=64):
+        self.lines = np.asarray(lines, dtype=int)
+        self.midpts = np.array([trig.midpt for trig in triggers], dtype=float)
+        self.ovectors = np.array([trig.ovector for trig in triggers],
+                                 dtype=float)
+        self.length_thresh = np.array(
+            [trig.length_thresh for trig in triggers], dtype=float)
+        self.frame_offset = np.array([trig.frame_offset for trig in triggers],
+                                     dtype=int)
+        self.flags = np.zeros((capacity, len(lines)), dtype=np.int32)
+        self.prev_val = np.zeros((capacity, len(lines)), dtype=np.int8)
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.row_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = dict()
+        self._free = list(range(capacity - 1, -1, -1))
+        self.frames = 0
+
+    def row(self, track_id):
+        """Returns the row of track_id, giving it a fresh one if it has none"""
+        row = self.rows.get(track_id)
+        if row is None:
+            if len(self._free) == 0:
+                self._grow()
+            row = self._free.pop()
+            self.flags[row] = 0
+            self.prev_val[row] = 0
+            self.row_ids[row] = track_id
+            self.rows[track_id] = row
+        return row
 
-        for i, (val, bboxes) in enumerate(zip(inout, peoplebboxes)):
-            if disp_mags[i] > self.length_thresh:
-                continue
-            id = bboxes[4]
+    def _grow(self):
+        capacity = len(self.last_seen)
+        self.flags = np.concatenate((self.flags, np.zeros_like(self.flags)))
+        self.prev_val = np.concatenate(
+            (self.prev_val, np.zeros_like(self.prev_val)))
+        self.last_seen = np.concatenate(
+            (self.last_seen, np.zeros_like(self.last_seen)))
+        self.row_ids = np.concatenate(
+            (self.row_ids, np.zeros_like(self.row_ids)))
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
 
-            if self.flags[id] >= 1: self.flags[id] += 1
-            if self.flags[id] >= self.frame_offset:
-                retval.append(i)
-                self.flags[id] = 0
+    def evict(self, frame, evict_after):
+        """Frees the rows of the ids not seen for more than evict_after frames"""
+        rows = np.fromiter(self.rows.values(), dtype=int, count=len(self.rows))
+        for row in rows[frame - self.last_seen[rows] > evict_after]:
+            del self.rows[int(self.row_ids[row])]
+            self._free.append(row)
 
-            # -1 - 1 is entering
-            if self.prev_val[id] - val == -2:
-                self.flags[id] = 1
 
-            if val == 0:
-                self.prev_val[id] = -1
-            else: self.prev_val[id] = val
+class LineTriggerBank:
+    """
+    Checks the people of a camera against all of its lines at once
+
+    The state of each track id is kept per camera in arrays with one row per
+    id and one column per line. Rows of ids not seen for evict_after frames
+    are reused.
+
+    Attributes:
+    triggers (list): VectorTrigger of each line
+    evict_after (int): frames after which an unseen id is forgotten
+    """
+    def __init__(self, triggers, evict_after=LT_EVICT_FRAMES):
+        self.triggers = list(triggers)
+        self.evict_after = evict_after
+        lines = collections.defaultdict(list)
+        for line, trig in enumerate(self.triggers):
+            lines[trig.video_oi].append(line)
+        self._groups = {
+            video: _LineGroup(video_lines,
+                              [self.triggers[line] for line in video_lines])
+            for video, video_lines in lines.items()
+        }
+
+    def update(self, video_name, peoplebboxes, frame=None):
+        """
+        Checks the people of a camera's frame against the camera's lines
+
+        Parameters:
+        video_name (str): camera of the frame
+        peoplebboxes (ndarray): (N, 5) x1, y1, x2, y2, id rows
+        frame (int): frame index, defaults to the number of updates of the camera
+
+        Returns:
+        captures (list): (box index, line index) of each person to capture
+        crossings (list): LineCrossing of each person who crossed a line
+        """
+        group = self._groups.get(video_name)
+        if group is None:
+            return list(), list()
+        group.frames += 1
+        if frame is None:
+            frame = group.frames
+        peoplebboxes = np.asarray(peoplebboxes, dtype=float).reshape(-1, 5)
+        group.evict(frame, self.evict_after)
+        if len(peoplebboxes) == 0:
+            return list(), list()
 
-        return retval
+        rows = np.array([group.row(int(track_id))
+                         for track_id in peoplebboxes[:, 4]], dtype=int)
+        group.last_seen[rows] = frame
 
+        # (N, L) distances and sides of every person's feet to every line
+        feetpoints = np.stack(((peoplebboxes[:, 0] + peoplebboxes[:, 2]) / 2,
+                               np.max(peoplebboxes[:, [1, 3]], 1)),
+                              axis=1)
+        displace_vects = group.midpts[None, :, :] - feetpoints[:, None, :]
+        near = np.linalg.norm(displace_vects, axis=2) <= group.length_thresh
+        inout = np.sign(np.einsum('nld,ld->nl', displace_vects,
+                                  group.ovectors)).astype(np.int8)
 
+        flags = group.flags[rows]
+        prev_val = group.prev_val[rows]
+        flags = np.where(flags >= 1, flags + 1, flags)
+        capture = near & (flags >= group.frame_offset)
+        flags[capture] = 0
+        # -1 - 1 is entering, 1 - -1 is leaving
+        entering = near & (prev_val - inout == -2)
+        leaving = near & (prev_val - inout == 2)
+        flags[entering] = 1
+        group.flags[rows] = np.where(near, flags, group.flags[rows])
+        group.prev_val[rows] = np.where(near, np.where(inout == 0, -1, inout),
+                                        prev_val)
 
+        captures = [(int(index), int(group.lines[line]))
+                    for index, line in zip(*np.nonzero(capture))]
+        crossings = [
+            LineCrossing(int(index), int(group.lines[line]),
+                         int(peoplebboxes[index, 4]),
+                         1 if entering[index, line] else -1, frame)
+            for index, line in zip(*np.nonzero(entering | leaving))
+        ]
+        return captures, crossings
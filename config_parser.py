@@ -4,6 +4,10 @@ import galleries
 import bbox_trigger
 import constants
 
+# Optional entry of a camera holding the [[x1, y1], [x2, y2]] region people
+# are detected in
+DETECTION_ROI_KEY = "detection_roi"
+
 def parse_json_filename(filename):
     if not os.path.exists(filename):
         raise ValueError("json filename does not exist")
@@ -15,7 +19,16 @@ def extract_line_trigger_list(json_dict):
     lines = list()
     for vidname in json_dict:
         for trig in json_dict[vidname]:
+            if trig == DETECTION_ROI_KEY:
+                continue
             line = json_dict[vidname][trig]["line"]
             point = json_dict[vidname][trig]["point"]
             lines.append(bbox_trigger.VectorTrigger(vidname, line, point, constants.LT_MAX_DISTANCE, constants.LT_FRAME_OFFSET))
     return lines
+
+def extract_detection_rois(json_dict):
+    rois = dict()
+    for vidname in json_dict:
+        if DETECTION_ROI_KEY in json_dict[vidname]:
+            rois[vidname] = json_dict[vidname][DETECTION_ROI_KEY]
+    return rois
@@ -20,11 +20,96 @@ TRIGGER_ROI_COORDS_TWO = [[114, 64], [600, 722]]
 DOOR_CLOSED_THRESHOLD = 0.27
 DOOR_OPEN_THRESHOLD = 0.87
 
+# Detector parameters
+DETECTION_SCORE_THRESHOLD = 0.5
+DETECTION_CLASSES = ('person', )
+# Region [[x1, y1], [x2, y2]] people are detected in, for some cameras
+DETECTION_ROIS = {}
+
 # MGN normalization parameters
 PER_CHANNEL_MEAN = [0.485, 0.456, 0.406]
 PER_CHANNEL_STD = [0.229, 0.224, 0.225]
 INPUT_RESOLUTION = (384, 128)
+MGN_BATCH_SIZE = 32
+
+# Largest number of video frames skipped by decoding instead of seeking
+VIDEO_MAX_GRAB_SKIP = 60
+
+# Decoded frames buffered per camera by the prefetching loader
+PREFETCH_QUEUE_DEPTH = 8
+# Seconds a blocked decode thread waits before checking if it should stop
+PREFETCH_POLL_INTERVAL = 0.1
+
+# Memory budget of the in-memory crop store (2 GiB)
+CROP_STORE_MAX_BYTES = 2 * 1024**3
+
+# Online feature extraction: crops waiting to be featurized before the
+# tracking loop blocks, and seconds the worker waits to fill a micro-batch
+ONLINE_FEATURES_MAX_PENDING = 512
+ONLINE_FEATURES_MAX_WAIT = 0.05
+
+# Approximate gallery search: number of inverted lists, lists probed per
+# query and k-means iterations used to build them
+IVF_NLIST = 256
+IVF_NPROBE = 8
+IVF_KMEANS_ITERATIONS = 10
+
+# Reference crops kept per track, the ones with the best quality. Quality
+# favours person boxes close to the ideal height / width ratio, at least as
+# large as the MGN input and with a confident detection
+MAX_TRACK_CROPS = 16
+CROP_QUALITY_ASPECT_RATIO = 2.0
+CROP_QUALITY_FULL_AREA = INPUT_RESOLUTION[0] * INPUT_RESOLUTION[1]
+
+# Track rows buffered per chunk by the track writers
+TRACK_WRITER_CHUNK_ROWS = 65536
+
+# Door state check of the bbox triggers: frames between checks, mean gray
+# level change of the check region needed to recompute SSIM, and longest side
+# the check region is downscaled to
+TRIGGER_CHECK_STRIDE = 1
+TRIGGER_DIFF_THRESHOLD = 2.0
+TRIGGER_SSIM_MAX_SIDE = 64
+# Smallest fraction of a detection inside a trigger region for the person to
+# be added to the gallery
+TRIGGER_MIN_OVERLAP = 0.5
+
+# Track level re-id: crops pooled by 'topk' aggregation, and id written for
+# tracks whose match confidence is below the unknown threshold
+TRACK_POOL_TOP_K = 4
+REID_UNKNOWN_ID = -1
+
+# Global identity assignment: candidate identities searched per query, span
+# in frames of the first frames of the tracks solved together, and frames
+# needed to walk between two cameras, by default and for some camera pairs
+REID_CANDIDATES = 5
+REID_ASSIGNMENT_WINDOW = 100
+REID_MIN_TRANSITION_FRAMES = 1
+CAMERA_TRANSITION_FRAMES = {}
+
+# Adaptive detection: most samples between two keyframes, largest relative
+# position uncertainty of a confirmed track, gray level change of a changed
+# pixel and fraction of changed pixels of the downscaled frame that force a
+# keyframe, its longest side, and optical flow points per box side and points
+# needed to move a box
+SCHEDULER_MAX_INTERVAL = 5
+SCHEDULER_MAX_UNCERTAINTY = 0.1
+SCHEDULER_MOTION_THRESHOLD = 25
+SCHEDULER_MOTION_AREA = 0.005
+SCHEDULER_MOTION_MAX_SIDE = 160
+SCHEDULER_FLOW_GRID = 5
+SCHEDULER_FLOW_MIN_POINTS = 5
+
+# Motion gate: longest side of the downscaled frame, gray level change of a
+# moving pixel, smallest fraction of moving pixels of a moving sample, and
+# margin around the moving region as a fraction of the frame size
+MOTION_GATE_MAX_SIDE = 160
+MOTION_GATE_PIXEL_THRESHOLD = 25
+MOTION_GATE_MIN_AREA = 0.002
+MOTION_GATE_ROI_PADDING = 0.05
 
 #Line Trigger
 LT_MAX_DISTANCE = 500
 LT_FRAME_OFFSET = 5
+# Frames after which the line trigger state of an unseen track id is dropped
+LT_EVICT_FRAMES = 300
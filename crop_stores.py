@@ -0,0 +1,200 @@
+'''
+Stores for the person crops referenced by tracks
+
+Crops are kept as raw BGR arrays so they never go through a JPEG encode and
+decode cycle before being featurized.
+'''
+
+import collections
+import os
+import tempfile
+import numpy as np
+from constants import CROP_STORE_MAX_BYTES
+
+CROP_STORE_CHOICES = ['memory', 'mmap']
+
+
+def get_crop_store(typestore, max_bytes=CROP_STORE_MAX_BYTES, path=None):
+    """
+    Creates a crop store
+
+    Parameters:
+    typestore (str): 'memory' or 'mmap'
+    max_bytes (int): memory budget of the 'memory' store
+    path (str): file backing the 'mmap' store, or the file the 'memory'
+                store spills to once it is over budget. None uses a
+                temporary file for 'mmap' and disables spilling for 'memory'
+
+    Returns:
+    CropStore: the crop store
+    """
+    if typestore == 'memory':
+        spill = MmapCropStore(path) if path is not None else None
+        return MemoryCropStore(max_bytes, spill=spill)
+    elif typestore == 'mmap':
+        return MmapCropStore(path)
+    raise ValueError("unknown crop store type {}".format(typestore))
+
+
+class CropStore:
+    """
+    Base class of the crop stores, maps integer keys to crops
+
+    Attributes:
+    _next_key (int): key given to the next crop put in the store
+    """
+    def __init__(self):
+        self._next_key = 0
+
+    def _new_key(self):
+        key = self._next_key
+        self._next_key += 1
+        return key
+
+    def get_many(self, keys):
+        """Returns the crops of keys that are still in the store"""
+        crops = [self.get(key) for key in keys]
+        return [crop for crop in crops if crop is not None]
+
+    def close(self):
+        pass
+
+
+class MemoryCropStore(CropStore):
+    """
+    Bounded in-memory crop store
+
+    Once the crops take more than max_bytes, the oldest ones are moved to
+    the spill store, or dropped when there is none.
+
+    Attributes:
+    max_bytes (int): memory budget
+    nbytes (int): memory currently used by the crops
+    _crops (OrderedDict): crops keyed by key, oldest first
+    _spill (CropStore): store receiving the crops evicted from memory
+    """
+    def __init__(self, max_bytes=CROP_STORE_MAX_BYTES, spill=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._crops = collections.OrderedDict()
+        self._spill = spill
+
+    def put(self, img):
+        """
+        Adds a crop to the store
+
+        Parameters:
+        img (ndarray): crop, copied so it doesn't keep the full frame alive
+
+        Returns:
+        int: key of the crop
+        """
+        key = self._new_key()
+        img = np.array(img)
+        self._crops[key] = img
+        self.nbytes += img.nbytes
+        while self.nbytes > self.max_bytes and len(self._crops) > 0:
+            oldkey, oldimg = self._crops.popitem(last=False)
+            self.nbytes -= oldimg.nbytes
+            if self._spill is not None:
+                self._spill.put(oldimg, key=oldkey)
+        return key
+
+    def get(self, key):
+        """Returns the crop of key, None if it was dropped"""
+        if key in self._crops:
+            return self._crops[key]
+        if self._spill is not None:
+            return self._spill.get(key)
+        return None
+
+    def discard(self, key):
+        """Removes the crop of key from the store"""
+        img = self._crops.pop(key, None)
+        if img is not None:
+            self.nbytes -= img.nbytes
+        elif self._spill is not None:
+            self._spill.discard(key)
+
+    def __len__(self):
+        spilled = len(self._spill) if self._spill is not None else 0
+        return len(self._crops) + spilled
+
+    def close(self):
+        self._crops.clear()
+        self.nbytes = 0
+        if self._spill is not None:
+            self._spill.close()
+
+
+class MmapCropStore(CropStore):
+    """
+    Crop store backed by a single append-only file read through a memory map
+
+    Attributes:
+    path (str): path of the backing file
+    _index (dict): (offset, shape) of each crop in the file keyed by key
+    _file (file): backing file opened for appending
+    _size (int): number of bytes written to the file
+    _map (np.memmap): read-only map of the file, remapped when it grows
+    _temporary (bool): whether the file is removed on close
+    """
+    def __init__(self, path=None):
+        super().__init__()
+        self._temporary = path is None
+        if self._temporary:
+            fd, path = tempfile.mkstemp(suffix='.crops')
+            os.close(fd)
+        self.path = path
+        self._file = open(path, 'wb')
+        self._size = 0
+        self._index = dict()
+        self._map = None
+
+    def put(self, img, key=None):
+        """
+        Appends a crop to the file
+
+        Parameters:
+        img (ndarray): uint8 crop
+        key (int): key to store the crop under, None picks a new one
+
+        Returns:
+        int: key of the crop
+        """
+        if key is None:
+            key = self._new_key()
+        data = np.ascontiguousarray(img, dtype=np.uint8)
+        self._file.write(data.tobytes())
+        self._index[key] = (self._size, data.shape)
+        self._size += data.nbytes
+        return key
+
+    def get(self, key):
+        """Returns the crop of key, None if it isn't in the store"""
+        if key not in self._index:
+            return None
+        offset, shape = self._index[key]
+        end = offset + int(np.prod(shape))
+        if end == offset:
+            return np.empty(shape, dtype=np.uint8)
+        if self._map is None or len(self._map) < end:
+            self._file.flush()
+            self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+        return np.array(self._map[offset:end]).reshape(shape)
+
+    def discard(self, key):
+        """Forgets the crop of key, the file space is not reclaimed"""
+        self._index.pop(key, None)
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        self._map = None
+        self._index.clear()
+        if not self._file.closed:
+            self._file.close()
+        if self._temporary and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,302 @@
+'''
+Adaptive scheduling of the person detector
+
+The detector only runs on keyframes. On the samples in between the tracks
+are carried by their Kalman prediction, optionally refined with optical
+flow. Keyframes come closer together when tracks become uncertain, people
+enter or the scene moves.
+
+Motion gates skip the detector altogether on samples where nothing moves,
+and can restrict detection to the part of the frame that moved.
+'''
+
+import cv2
+import numpy as np
+from constants import SCHEDULER_MAX_INTERVAL, SCHEDULER_MAX_UNCERTAINTY
+from constants import SCHEDULER_MOTION_THRESHOLD, SCHEDULER_MOTION_AREA
+from constants import SCHEDULER_MOTION_MAX_SIDE
+from constants import SCHEDULER_FLOW_GRID, SCHEDULER_FLOW_MIN_POINTS
+from constants import MOTION_GATE_MAX_SIDE, MOTION_GATE_PIXEL_THRESHOLD
+from constants import MOTION_GATE_MIN_AREA, MOTION_GATE_ROI_PADDING
+
+MOTION_GATE_CHOICES = ['none', 'diff', 'mog2']
+
+
+def thumbnail(frame, max_side=SCHEDULER_MOTION_MAX_SIDE):
+    """Returns a grayscale float32 copy of a BGR frame with its longest side brought down to max_side"""
+    height, width = frame.shape[:2]
+    scale = min(1.0, max_side / max(width, height))
+    size = (max(int(round(width * scale)), 1),
+            max(int(round(height * scale)), 1))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, size,
+                      interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def optical_flow_boxes(previous_frame,
+                       frame,
+                       boxes,
+                       grid=SCHEDULER_FLOW_GRID,
+                       min_points=SCHEDULER_FLOW_MIN_POINTS):
+    """
+    Moves boxes with the sparse optical flow between two frames
+
+    A grid of points inside each box is followed with pyramidal Lucas-Kanade
+    and the box is shifted by the median displacement of the points found.
+
+    Parameters:
+    previous_frame (ndarray): BGR frame the boxes are in
+    frame (ndarray): next BGR frame
+    boxes (ndarray): (N, 4) x1, y1, x2, y2 boxes
+    grid (int): points per side of the grid of each box
+    min_points (int): points that must be found to move a box
+
+    Returns:
+    ndarray: (N, 4) moved boxes, NaN rows for boxes with too few points found
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    moved = np.full(boxes.shape, np.nan)
+    if len(boxes) == 0:
+        return moved
+    height, width = frame.shape[:2]
+    steps = (np.arange(grid) + 0.5) / grid
+    offsets = np.stack(np.meshgrid(steps, steps), axis=-1).reshape(-1, 2)
+    sizes = boxes[:, 2:] - boxes[:, :2]
+    points = boxes[:, None, :2] + offsets[None, :, :] * sizes[:, None, :]
+    points = np.clip(points, 0, [width - 1, height - 1]).astype(np.float32)
+    found_points, status, _ = cv2.calcOpticalFlowPyrLK(
+        cv2.cvtColor(previous_frame, cv2.COLOR_BGR2GRAY),
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), points.reshape(-1, 1, 2),
+        None)
+    status = status.reshape(len(boxes), -1).astype(bool)
+    shifts = found_points.reshape(points.shape) - points
+    shifts[~status] = np.nan
+    enough = status.sum(axis=1) >= min_points
+    if np.any(enough):
+        shift = np.nanmedian(shifts[enough], axis=1)
+        moved[enough] = boxes[enough] + np.tile(shift, 2)
+    return moved
+
+
+class DetectionScheduler:
+    """
+    Decides on which samples of each camera the detector runs
+
+    A camera is detected every interval samples. The interval grows by one
+    after each keyframe without new tracks, up to max_interval, and drops
+    back to one when a track starts or a trigger fires. A keyframe is also
+    forced when a confirmed track becomes too uncertain or enough of the
+    frame changed since the last keyframe, e.g. when someone walks in.
+
+    Attributes:
+    max_interval (int): most samples between two keyframes
+    max_uncertainty (float): largest relative position uncertainty of a
+                             confirmed track, see Sort.uncertainty
+    motion_threshold (float): gray level change since the last keyframe of a
+                              changed pixel, None to ignore motion
+    motion_area (float): fraction of changed pixels that forces a keyframe
+    detected (dict): number of detected samples of each camera
+    skipped (dict): number of skipped samples of each camera
+    """
+    def __init__(self,
+                 max_interval=SCHEDULER_MAX_INTERVAL,
+                 max_uncertainty=SCHEDULER_MAX_UNCERTAINTY,
+                 motion_threshold=SCHEDULER_MOTION_THRESHOLD,
+                 motion_area=SCHEDULER_MOTION_AREA):
+        if max_interval < 1:
+            raise ValueError(
+                "max_interval must be positive, got {}".format(max_interval))
+        self.max_interval = max_interval
+        self.max_uncertainty = max_uncertainty
+        self.motion_threshold = motion_threshold
+        self.motion_area = motion_area
+        self.detected = dict()
+        self.skipped = dict()
+        self._interval = dict()
+        # Samples since the last keyframe and thumbnail of that keyframe
+        self._since = dict()
+        self._keyframes = dict()
+        self._alerts = set()
+
+    def should_detect(self, camera, frame, tracker):
+        """
+        Decides whether the detector runs on a sample, call once per sample
+
+        Parameters:
+        camera (str): camera of the frame
+        frame (ndarray): the camera's frame
+        tracker (Sort): the camera's tracker
+
+        Returns:
+        bool: True to detect, False to coast the tracks
+        """
+        interval = self._interval.setdefault(camera, 1)
+        thumb = None
+        detect = (camera not in self._keyframes or camera in self._alerts
+                  or self._since[camera] + 1 >= interval
+                  or self._uncertain(tracker))
+        if not detect and self.motion_threshold is not None:
+            thumb = thumbnail(frame)
+            changed = np.abs(thumb -
+                             self._keyframes[camera]) > self.motion_threshold
+            detect = np.mean(changed) >= self.motion_area
+        if detect:
+            self._since[camera] = 0
+            if thumb is None and self.motion_threshold is not None:
+                thumb = thumbnail(frame)
+            self._keyframes[camera] = thumb
+            self._alerts.discard(camera)
+            self.detected[camera] = self.detected.get(camera, 0) + 1
+        else:
+            self._since[camera] += 1
+            self.skipped[camera] = self.skipped.get(camera, 0) + 1
+        return detect
+
+    def _uncertain(self, tracker):
+        """Whether a confirmed track of tracker is too uncertain"""
+        confirmed = [
+            trk.time_since_update == 0 and trk.hits >= tracker.min_hits
+            for trk in tracker.trackers
+        ]
+        if not any(confirmed):
+            return False
+        uncertainty = tracker.uncertainty()[np.array(confirmed, dtype=bool)]
+        return np.max(uncertainty) > self.max_uncertainty
+
+    def observe(self, camera, tracker):
+        """
+        Adapts the interval of a camera after its tracker was updated on a keyframe
+
+        Parameters:
+        camera (str): camera of the keyframe
+        tracker (Sort): the camera's tracker
+        """
+        # Tracks started on the keyframe have no hits yet
+        if any(trk.hits == 0 for trk in tracker.trackers):
+            self._interval[camera] = 1
+        else:
+            self._interval[camera] = min(
+                self._interval.get(camera, 1) + 1, self.max_interval)
+
+    def alert(self, camera):
+        """Forces a keyframe on the next sample of camera, e.g. when a trigger fired"""
+        self._alerts.add(camera)
+        self._interval[camera] = 1
+
+    def skip_ratio(self, camera):
+        """Returns the fraction of the samples of camera that were not detected"""
+        total = self.detected.get(camera, 0) + self.skipped.get(camera, 0)
+        return self.skipped.get(camera, 0) / max(total, 1)
+
+
+class MotionGate:
+    """
+    Tells whether anything moved in a camera's frame
+
+    The frame is downscaled and compared to the previous sample ('diff') or
+    to a MOG2 background model ('mog2'). A sample is static when less than
+    min_area of its pixels changed and the camera has no tracks, people who
+    stopped moving are still detected until their tracks end.
+
+    Attributes:
+    method (str): 'diff' or 'mog2'
+    max_side (int): longest side of the downscaled frame
+    pixel_threshold (float): gray level change of a moving pixel for 'diff'
+    min_area (float): smallest fraction of moving pixels of a moving sample
+    padding (float): margin added around the moving region, as a fraction
+                     of the frame size
+    checked (int): number of samples gated
+    skipped (int): number of static samples
+    """
+    def __init__(self,
+                 method='diff',
+                 max_side=MOTION_GATE_MAX_SIDE,
+                 pixel_threshold=MOTION_GATE_PIXEL_THRESHOLD,
+                 min_area=MOTION_GATE_MIN_AREA,
+                 padding=MOTION_GATE_ROI_PADDING):
+        if method not in MOTION_GATE_CHOICES[1:]:
+            raise ValueError("unknown motion gate {}".format(method))
+        self.method = method
+        self.max_side = max_side
+        self.pixel_threshold = pixel_threshold
+        self.min_area = min_area
+        self.padding = padding
+        self.checked = 0
+        self.skipped = 0
+        self._previous = None
+        self._subtractor = None
+        if method == 'mog2':
+            self._subtractor = cv2.createBackgroundSubtractorMOG2(
+                detectShadows=False)
+
+    def _mask(self, thumb):
+        """Returns the moving pixels of a thumbnail, None for the first one"""
+        if self.method == 'mog2':
+            mask = self._subtractor.apply(thumb.astype(np.uint8)) > 0
+            first = self.checked == 1
+        else:
+            mask = None
+            if self._previous is not None:
+                mask = np.abs(thumb - self._previous) > self.pixel_threshold
+            first = mask is None
+            self._previous = thumb
+        return None if first else mask
+
+    def update(self, frame, boxes=None):
+        """
+        Gates a sample, call once per sample
+
+        Parameters:
+        frame (ndarray): the camera's BGR frame
+        boxes (ndarray): (N, 4) boxes of the camera's tracks, kept inside the
+                         returned region. A camera with tracks inside the
+                         frame is never static
+
+        Returns:
+        tuple: x1, y1, x2, y2 region holding the motion and the tracks,
+               None when the sample is static
+        """
+        self.checked += 1
+        height, width = frame.shape[:2]
+        thumb = thumbnail(frame, self.max_side)
+        mask = self._mask(thumb)
+        if mask is None:
+            return (0, 0, width, height)
+        moving = np.mean(mask) >= self.min_area
+        if boxes is not None:
+            # Predicted boxes can leave the frame, only their visible part counts
+            size = np.array([width, height, width, height])
+            boxes = np.clip(
+                np.asarray(boxes, dtype=np.float64).reshape(-1, 4), 0, size)
+            boxes = boxes[np.all(boxes[:, 2:] > boxes[:, :2], axis=1)]
+        tracked = boxes is not None and len(boxes) > 0
+        if not moving and not tracked:
+            self.skipped += 1
+            return None
+
+        region = np.array([np.inf, np.inf, -np.inf, -np.inf])
+        if moving:
+            rows = np.flatnonzero(np.any(mask, axis=1))
+            cols = np.flatnonzero(np.any(mask, axis=0))
+            scale_x = width / mask.shape[1]
+            scale_y = height / mask.shape[0]
+            region = np.array([
+                cols[0] * scale_x, rows[0] * scale_y,
+                (cols[-1] + 1) * scale_x, (rows[-1] + 1) * scale_y
+            ])
+        if tracked:
+            region[:2] = np.minimum(region[:2], boxes[:, :2].min(axis=0))
+            region[2:] = np.maximum(region[2:], boxes[:, 2:].max(axis=0))
+        margin = self.padding * np.array([width, height])
+        region[:2] -= margin
+        region[2:] += margin
+        x1, y1 = np.maximum(np.floor(region[:2]), 0).astype(int)
+        x2, y2 = np.minimum(np.ceil(region[2:]), [width, height]).astype(int)
+        if x2 <= x1 or y2 <= y1:
+            self.skipped += 1
+            return None
+        return (int(x1), int(y1), int(x2), int(y2))
+
+    def skip_ratio(self):
+        """Returns the fraction of the samples that were static"""
+        return self.skipped / max(self.checked, 1)
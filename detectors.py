@@ -1,4 +1,8 @@
-from constants import defaultkey
+from constants import defaultkey, DETECTION_SCORE_THRESHOLD, DETECTION_CLASSES
+from devices import get_device, inference_mode, prepare_model
+from utils import crop_image
+import cv2
+import torch
 import torchvision
 import numpy as np
 
@@ -26,50 +30,160 @@ class FasterRCNN:
 
     Attributes:
     model (detection): pretrained fasterrcnn
-    transform (Compose): transformations done to an image such as converting to tensor
+    device (torch.device): device the model runs on
+    score_threshold (float): minimum confidence score of a kept detection
+    max_side (int): longest side images are downscaled to before detection,
+                    None to let the model resize them
 
 
     """
-    def __init__(self):
+    def __init__(self,
+                 device='auto',
+                 num_threads=None,
+                 score_threshold=DETECTION_SCORE_THRESHOLD,
+                 classes=DETECTION_CLASSES,
+                 max_side=None):
         """
         constructor for FasterRCNN class
+
+        Parameters:
+        device (str): 'auto', 'cpu' or 'cuda'
+        num_threads (int): number of threads used for CPU inference
+        score_threshold (float): minimum confidence score of a kept detection
+        classes (iterable): COCO class names to keep
+        max_side (int): longest side images are downscaled to before detection,
+                        None to let the model resize them
         """
+        unknown = set(classes) - set(COCO_INSTANCE_CATEGORY_NAMES)
+        if unknown:
+            raise ValueError("unknown COCO classes {}".format(sorted(unknown)))
+        self.score_threshold = score_threshold
 
+        self.device = get_device(device, num_threads)
+        self._class_ids = torch.tensor([
+            label for label, name in enumerate(COCO_INSTANCE_CATEGORY_NAMES)
+            if name in classes
+        ]).to(self.device)
         self.model = torchvision.models.detection.fasterrcnn_resnet50_fpn(
             pretrained=True)
-        self.model.cuda()
-        self.model.eval()
-        self.transform = torchvision.transforms.Compose(
-            [torchvision.transforms.ToTensor()])
+        prepare_model(self.model, self.device)
+        self.max_side = max_side
+        if max_side is not None:
+            # Images are already downscaled, don't let the model resize them back up
+            self.model.transform.min_size = (max_side, )
+            self.model.transform.max_size = max_side
+        # Reused for the BGR to RGB conversion of every image
+        self._rgb = np.empty(0, dtype=np.uint8)
+
+    def _to_tensor(self, img):
+        """
+        Converts a BGR image into the RGB float tensor the model expects
 
-    def get_bboxes(self, frame):
+        Parameters:
+        img (ndarray): BGR image
+
+        Returns:
+        tensor (Tensor): (3, H, W) image on the model's device, downscaled to max_side
+        scale (float): size of the tensor relative to img
+        """
+        height, width = img.shape[:2]
+        scale = 1.0
+        if self.max_side is not None and max(height, width) > self.max_side:
+            scale = self.max_side / max(height, width)
+            width = max(int(round(width * scale)), 1)
+            height = max(int(round(height * scale)), 1)
+            img = cv2.resize(img, (width, height),
+                             interpolation=cv2.INTER_AREA)
+        if self._rgb.size < img.size:
+            self._rgb = np.empty(img.size, dtype=np.uint8)
+        rgb = self._rgb[:img.size].reshape(height, width, 3)
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=rgb)
+        # The float conversion copies the buffer before it is reused
+        tensor = torch.from_numpy(rgb).to(self.device).permute(2, 0, 1).float()
+        return tensor.div_(255), scale
+
+    def get_bboxes(self, frame, roi=None):
         """
         Given a frame finds all the bounding boxes of people
 
         Parameters:
         frame (ndarray): frame of a video 
+        roi (tuple): x1, y1, x2, y2 region people are searched in, None for the whole frame
 
         Returns:
-        bboxes_ppl (ndarray): an array of bounding boxes of people
-        box_scr (array): array of confidence scores for each bounding box in bboxes_ppl
+        bboxes_ppl (ndarray): (N, 4) float32 array of x1, y1, x2, y2 boxes of people
+        box_scr (ndarray): (N,) float32 array of confidence scores for each bounding box in bboxes_ppl
+        """
+        img, scale = self._to_tensor(crop_roi(frame, roi))
+        with inference_mode():
+            pred = self.model([img])  # Pass the image to the model
+        return self._filter_prediction(pred[0], roi, scale)
+
+    def get_bboxes_batch(self, frames, rois=None):
         """
-        img = self.transform(frame)  # Apply the transform to the image
-        img = img.cuda()
-        pred = self.model([img])  # Pass the image to the model
-        pred_dict = pred[0]
-        threshold = .5
-        bboxes_ppl = [
-            bbox for bbox, label, score in zip(pred_dict['boxes'].cuda(
-            ), pred_dict['labels'].cuda(), pred_dict['scores'].cuda())
-            if COCO_INSTANCE_CATEGORY_NAMES[label] == 'person'
-            and score > threshold
-        ]
-        box_scr = np.array([
-            scr.cpu().detach() for scr, label in zip(
-                pred_dict['scores'].cuda(), pred_dict['labels'].cuda()) if
-            COCO_INSTANCE_CATEGORY_NAMES[label] == 'person' and scr > threshold
+        Finds the bounding boxes of people in many frames with one model call
+
+        Parameters:
+        frames (dict): frames to run detection on, keyed by any hashable
+                       (e.g. camera name or (frame index, camera name))
+        rois (dict): x1, y1, x2, y2 region people are searched in for some
+                     of the keys of frames, the others are searched whole
+
+        Returns:
+        dict: same keys as frames, each mapped to a (bboxes, scores) tuple
+              as returned by get_bboxes
+        """
+        keys = list(frames.keys())
+        if len(keys) == 0:
+            return dict()
+        rois = rois or dict()
+        imgs, scales = zip(*[
+            self._to_tensor(crop_roi(frames[key], rois.get(key)))
+            for key in keys
         ])
-        bboxes_ppl = np.array([[(box[0].cpu().detach(), box[1].cpu().detach()),
-                                (box[2].cpu().detach(), box[3].cpu().detach())]
-                               for box in bboxes_ppl])
-        return bboxes_ppl, box_scr
+        with inference_mode():
+            preds = self.model(list(imgs))
+        return {
+            key: self._filter_prediction(pred_dict, rois.get(key), scale)
+            for key, pred_dict, scale in zip(keys, preds, scales)
+        }
+
+    def _filter_prediction(self, pred_dict, roi=None, scale=1.0):
+        """
+        Keeps the detections of the wanted classes above the score threshold
+
+        Parameters:
+        pred_dict (dict): one image's output of the torchvision detector
+        roi (tuple): region the image was cropped from, boxes are moved back to frame coordinates
+        scale (float): size of the image relative to the region, boxes are scaled back
+
+        Returns:
+        bboxes (ndarray): (N, 4) float32 array of boxes
+        scores (ndarray): (N,) float32 array of scores
+        """
+        labels = pred_dict['labels']
+        scores = pred_dict['scores']
+        keep = (labels.unsqueeze(1) == self._class_ids).any(1) & (
+            scores > self.score_threshold)
+        # Single device to host transfer for boxes and scores together
+        dets = torch.cat((pred_dict['boxes'][keep], scores[keep].unsqueeze(1)),
+                         dim=1).cpu().numpy().astype(np.float32)
+        bboxes = np.ascontiguousarray(dets[:, :4])
+        scores = np.ascontiguousarray(dets[:, 4])
+        if scale != 1.0:
+            bboxes /= scale
+        if roi is not None:
+            bboxes[:, [0, 2]] += roi[0]
+            bboxes[:, [1, 3]] += roi[1]
+        return bboxes, scores
+
+
+def crop_roi(frame, roi):
+    """Returns the x1, y1, x2, y2 region roi of frame, the whole frame when roi is None"""
+    if roi is None:
+        return frame
+    cropped = crop_image(frame, ((roi[0], roi[1]), (roi[2], roi[3])))
+    if cropped.size == 0:
+        raise ValueError("empty region {} of a {}x{} frame".format(
+            tuple(roi), frame.shape[1], frame.shape[0]))
+    return cropped
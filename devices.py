@@ -0,0 +1,74 @@
+'''
+Helpers for choosing where the torch models run
+'''
+
+import torch
+
+DEVICE_CHOICES = ['auto', 'cpu', 'cuda']
+
+
+def get_device(device='auto', num_threads=None):
+    """
+    Resolves a device option into a torch device
+
+    Parameters:
+    device (str): one of 'auto', 'cpu' or 'cuda'. 'auto' picks cuda when available
+    num_threads (int): number of threads torch uses for CPU ops, None keeps torch's default
+
+    Returns:
+    torch.device: the device the models should be moved to
+    """
+    if device not in DEVICE_CHOICES:
+        raise ValueError("device must be one of {}, got {}".format(
+            DEVICE_CHOICES, device))
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    elif device == 'cuda' and not torch.cuda.is_available():
+        raise ValueError("cuda device requested but cuda is not available")
+    if num_threads is not None:
+        if num_threads < 1:
+            raise ValueError(
+                "num_threads must be positive, got {}".format(num_threads))
+        torch.set_num_threads(num_threads)
+    return torch.device(device)
+
+
+def inference_mode():
+    """Returns the cheapest available context manager for running inference"""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def supports_channels_last(device):
+    """Whether the channels last memory format should be used on device"""
+    return device.type == 'cpu' and hasattr(torch, 'channels_last')
+
+
+def prepare_model(model, device):
+    """
+    Moves a model to device and puts it in eval mode
+
+    On CPU the model is converted to channels last, which lets the convolution
+    kernels avoid layout conversions.
+
+    Parameters:
+    model (nn.Module): model to prepare
+    device (torch.device): device to move the model to
+
+    Returns:
+    nn.Module: the prepared model
+    """
+    model.to(device)
+    if supports_channels_last(device):
+        model.to(memory_format=torch.channels_last)
+    model.eval()
+    return model
+
+
+def to_device(batch, device):
+    """Moves an NCHW batch to device using the layout prepare_model chose"""
+    batch = batch.to(device)
+    if supports_channels_last(device):
+        batch = batch.contiguous(memory_format=torch.channels_last)
+    return batch
@@ -1,10 +1,56 @@
 from constants import defaultkey
 from utils import unitdotprod
 from utils import crop_image
+from matching import as_matrix
+from bbox_trigger import LineTriggerBank
 import numpy as np
 
 
-class TriggerGallery:
+class Gallery:
+    """
+    Base class of the galleries, keeps the people and their feature vectors
+
+    Attributes:
+    _people (list): list of people in the gallery
+    _feats (list): feature vector corresponding to each person in the gallery
+    _attribute_extractor (MgnWrapper): Attribute extractor
+    _index (GalleryIndex): persistent index the people are also appended to
+    """
+    def __init__(self, attribute_extractor, index=None):
+        self._people = list()
+        self._feats = list()
+        self._attribute_extractor = attribute_extractor
+        self._index = index
+
+    def _add_people(self, cropimgs, camera, findex, boxes):
+        """
+        Featurizes crops in one batch and adds them to the gallery and its index
+
+        Parameters:
+        cropimgs (list): crops of the people
+        camera (str): camera the crops come from
+        findex (int): frame index the crops come from
+        boxes (list): box of each crop
+        """
+        if len(cropimgs) == 0:
+            return
+        vects = self._attribute_extractor.compute_feat_vectors(cropimgs)
+        self._people.extend(cropimgs)
+        self._feats.extend(vects)
+        if self._index is not None:
+            self._index.append(vects,
+                               camera=camera,
+                               frame=findex,
+                               boxes=boxes,
+                               crops=cropimgs)
+
+    @property
+    def feats(self):
+        """Returns (N, 2048) matrix of the people's feature vectors"""
+        return as_matrix(self._feats, 2048)
+
+
+class TriggerGallery(Gallery):
     """
     this class is the gallery for images obtained from BboxTrigger
 
@@ -13,74 +59,103 @@ class TriggerGallery:
     _feats (list): feature vector corresponding to each person in the gallery
     _triggers (BboxTrigger): bounding box trigger object
     _attribute_extractor (MgnWrapper): Attribute extractor
+    _index (GalleryIndex): persistent index the people are also appended to
     """
-    def __init__(self, attribute_extractor, triggers):
+    def __init__(self, attribute_extractor, triggers, index=None):
         """
         constructor for TriggerGallery
 
         Parameters:
         triggers (BboxTrigger): bounding box trigger object
         attribute_extractor (MgnWrapper): Attribute extractor
+        index (GalleryIndex): persistent index the people are also appended to
         """
-        self._people = list()
-        self._feats = list()
+        super().__init__(attribute_extractor, index)
         self._triggers = triggers
-        self._attribute_extractor = attribute_extractor
 
     def add_trigger(self, trig):
         """adds a trigger"""
         self._triggers.append(trig)
 
-    def update(self, frames):
-        """adds people and features to the gallery"""
+    def update(self, frames, findex=None, detections=None):
+        """
+        adds people and features to the gallery
+
+        Parameters:
+        frames (dict): frame of each camera
+        findex (int): frame index
+        detections (dict): (N, 4+) boxes of the people in each camera's frame,
+                           reused by the triggers instead of detecting again.
+                           Triggers of cameras missing from it detect on
+                           their region crop
+
+        Returns:
+        list: camera of each trigger that fired
+        """
+        fired = list()
         for trig in self._triggers:
-            add, boxes, img = trig.update(frames)
+            add, boxes, img = trig.update(
+                frames, None if detections is None else detections.get(
+                    trig.camera_id))
             if add:
-                for box in boxes:
-                    cropimg = crop_image(img, box)
-                    vect = self._attribute_extractor(cropimg)
-                    self._people.append(cropimg)
-                    self._feats.append(vect)
+                cropimgs = [
+                    crop_image(img, np.reshape(box, (2, 2))) for box in boxes
+                ]
+                self._add_people(cropimgs, trig.camera_id, findex, boxes)
+                fired.append(trig.camera_id)
+        return fired
 
     @property
     def people(self):
         """Returns list of people"""
         return self._people
 
-class TriggerLineGallery:
+class TriggerLineGallery(Gallery):
     """
     this class is the gallery for images obtained from VectorTrigger
 
     Attributes:
     _people (list): list of people in the gallery
     _feats (list): feature vector corresponding to each person in the gallery
-    _triggers (BboxTrigger): bounding box trigger object
+    triggers (list): VectorTrigger of each line
+    _bank (LineTriggerBank): checks the people against all the lines at once
     _attribute_extractor (MgnWrapper): Attribute extractor
+    _index (GalleryIndex): persistent index the people are also appended to
     """
-    def __init__(self, attribute_extractor, triggers):
+    def __init__(self, attribute_extractor, triggers, index=None):
         """
         constructor for TriggerGallery
 
         Parameters:
-        triggers (BboxTrigger): bounding box trigger object
+        triggers (list): VectorTrigger of each line
         attribute_extractor (MgnWrapper): Attribute extractor
+        index (GalleryIndex): persistent index the people are also appended to
         """
+        super().__init__(attribute_extractor, index)
         self.triggers = triggers
-        self._people = list()
-        self._feats = list()
-        self._attribute_extractor = attribute_extractor
+        self._bank = LineTriggerBank(triggers)
 
-    def update(self, video_name, frame, bboxes):
-        """adds people and features to the gallery"""
-        for trig in self.triggers:
-            if trig.video_oi != video_name: continue
-            indsToSave = trig.update(bboxes)
-            for index in indsToSave:
-                cropimg = crop_image(frame, np.reshape(bboxes[index, :-1], (2,2)))
-                vect = self._attribute_extractor(cropimg)
-                self._people.append(cropimg)
-                self._feats.append(vect)
+    def update(self, video_name, frame, bboxes, findex=None):
+        """
+        adds people and features to the gallery
+
+        Parameters:
+        video_name (str): camera of the frame
+        frame (ndarray): the frame
+        bboxes (ndarray): (N, 5) x1, y1, x2, y2, id rows of the tracked people
+        findex (int): frame index
+
+        Returns:
+        list: LineCrossing of each person who crossed a line
+        """
+        captures, crossings = self._bank.update(video_name, bboxes, findex)
+        boxes = [bboxes[index, :-1] for index, _ in captures]
+        cropimgs = [
+            crop_image(frame, np.reshape(box, (2, 2))) for box in boxes
+        ]
+        self._add_people(cropimgs, video_name, findex, boxes)
+        return crossings
 
     def people(self):
         """Returns list of people"""
-        return self._people
\ No newline at end of file
+        return self._people
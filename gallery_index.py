@@ -0,0 +1,136 @@
+'''
+On-disk index of gallery embeddings that grows as triggers fire
+
+An index is a directory holding:
+    index.json      embedding length and dtype
+    embeddings.bin  append-only raw embeddings, one row per gallery entry
+    meta.jsonl      one JSON object per gallery entry with its id, camera,
+                    frame, box and crop file
+    crops/          optional JPEG of each gallery entry
+
+The embeddings file is memory mapped so reopening an index costs nothing,
+and gallery ids are the row numbers of the embeddings.
+'''
+
+import json
+import os
+import cv2
+import numpy as np
+
+GALLERY_DTYPE_CHOICES = ['float32', 'float16']
+
+
+class GalleryIndex:
+    """
+    Memory mappable gallery of embeddings with their provenance
+
+    Attributes:
+    path (str): directory of the index
+    dim (int): length of an embedding
+    dtype (np.dtype): dtype the embeddings are stored with
+    metadata (list): dict with the id, camera, frame, box and crop of each entry
+    """
+    def __init__(self, path, dim=2048, dtype='float32', save_crops=True):
+        """
+        Opens the index in path, creating it if it doesn't exist
+
+        Parameters:
+        path (str): directory of the index
+        dim (int): length of an embedding, checked against an existing index
+        dtype (str): 'float32' or 'float16', checked against an existing index
+        save_crops (bool): whether appended crops are written to crops/
+        """
+        if dtype not in GALLERY_DTYPE_CHOICES:
+            raise ValueError("dtype must be one of {}, got {}".format(
+                GALLERY_DTYPE_CHOICES, dtype))
+        self.path = path
+        self.save_crops = save_crops
+        header_path = os.path.join(path, "index.json")
+        if os.path.exists(header_path):
+            with open(header_path, "r") as header_file:
+                header = json.load(header_file)
+            if header["dim"] != dim or header["dtype"] != dtype:
+                raise ValueError(
+                    "index {} holds {} {} embeddings, not {} {}".format(
+                        path, header["dim"], header["dtype"], dim, dtype))
+        else:
+            os.makedirs(os.path.join(path, "crops"), exist_ok=True)
+            with open(header_path, "w") as header_file:
+                json.dump({"dim": dim, "dtype": dtype}, header_file)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+
+        self.metadata = list()
+        meta_path = os.path.join(path, "meta.jsonl")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as meta_file:
+                self.metadata = [json.loads(line) for line in meta_file]
+        self._embeddings_path = os.path.join(path, "embeddings.bin")
+        # Drop rows written without their metadata by an interrupted append
+        self._truncate(len(self.metadata) * self.dim * self.dtype.itemsize)
+
+        self._embeddings_file = open(self._embeddings_path, "ab")
+        self._meta_file = open(meta_path, "a")
+        self._map = None
+
+    def _truncate(self, nbytes):
+        if os.path.exists(self._embeddings_path) and os.path.getsize(
+                self._embeddings_path) > nbytes:
+            with open(self._embeddings_path, "r+b") as embeddings_file:
+                embeddings_file.truncate(nbytes)
+
+    def append(self, feats, camera=None, frame=None, boxes=None, crops=None):
+        """
+        Appends gallery entries
+
+        Parameters:
+        feats (ndarray): (N, dim) embeddings
+        camera (str): camera the entries were captured on
+        frame (int): frame index the entries were captured at
+        boxes (list): x1, y1, x2, y2 box of each entry, or None
+        crops (list): crop image of each entry, or None
+
+        Returns:
+        list: ids of the new entries
+        """
+        feats = np.asarray(feats, dtype=self.dtype).reshape(-1, self.dim)
+        ids = list(range(len(self.metadata), len(self.metadata) + len(feats)))
+        self._embeddings_file.write(np.ascontiguousarray(feats).tobytes())
+        self._embeddings_file.flush()
+        for i, entry_id in enumerate(ids):
+            crop_file = None
+            if self.save_crops and crops is not None:
+                crop_file = os.path.join("crops", "{:08d}.jpg".format(entry_id))
+                cv2.imwrite(os.path.join(self.path, crop_file), crops[i])
+            entry = {
+                "id": entry_id,
+                "camera": camera,
+                "frame": None if frame is None else int(frame),
+                "box": None if boxes is None else
+                [float(coord) for coord in np.ravel(boxes[i])],
+                "crop": crop_file,
+            }
+            self._meta_file.write(json.dumps(entry) + "\n")
+            self.metadata.append(entry)
+        self._meta_file.flush()
+        return ids
+
+    @property
+    def embeddings(self):
+        """(N, dim) read-only memory map of the embeddings"""
+        if len(self.metadata) == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        if self._map is None or len(self._map) != len(self.metadata):
+            self._map = np.memmap(self._embeddings_path,
+                                  dtype=self.dtype,
+                                  mode='r',
+                                  shape=(len(self.metadata), self.dim))
+        return self._map
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def close(self):
+        self._map = None
+        self._embeddings_file.close()
+        self._meta_file.close()
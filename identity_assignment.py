@@ -0,0 +1,160 @@
+'''
+Assignment of gallery identities to the tracks of all the cameras at once
+
+A person can't be in two places at the same time, and walking from one
+camera to another takes time. Two tracks conflict when they are closer in
+time than the transition time between their cameras, and conflicting tracks
+can't be given the same identity.
+
+Tracks are processed in windows of their first frame. The tracks of a window
+are split into groups connected by conflicts, each group is solved as a
+linear assignment on its candidate identities so its tracks get distinct
+identities, and identities already given to earlier conflicting tracks are
+excluded. Only the candidate identities of each track are scored, so the
+work grows with the number of tracks rather than tracks times gallery.
+'''
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from constants import REID_ASSIGNMENT_WINDOW, REID_MIN_TRANSITION_FRAMES
+from constants import REID_UNKNOWN_ID
+
+
+def transition_matrix(cameras,
+                      min_frames=REID_MIN_TRANSITION_FRAMES,
+                      priors=None):
+    """
+    Builds the smallest number of frames between two tracks of each pair of cameras
+
+    Tracks of the same camera only conflict when they share a frame.
+
+    Parameters:
+    cameras (list): camera names
+    min_frames (int): transition time between cameras missing from priors
+    priors (dict): transition time of some (camera, camera) pairs, in any order
+
+    Returns:
+    ndarray: (C, C) symmetric transition times
+    """
+    transitions = np.full((len(cameras), len(cameras)),
+                          min_frames,
+                          dtype=np.int64)
+    np.fill_diagonal(transitions, 1)
+    positions = {camera: i for i, camera in enumerate(cameras)}
+    for (first, second), frames in (priors or dict()).items():
+        if first in positions and second in positions:
+            transitions[positions[first], positions[second]] = frames
+            transitions[positions[second], positions[first]] = frames
+    return transitions
+
+
+def conflicts(cameras, first_frames, last_frames, transitions):
+    """
+    Finds the pairs of tracks that can't be the same person
+
+    Parameters:
+    cameras (ndarray): (N,) camera index of each track
+    first_frames (ndarray): (N,) first frame of each track
+    last_frames (ndarray): (N,) last frame of each track
+    transitions (ndarray): (C, C) transition times, see transition_matrix
+
+    Returns:
+    ndarray: (N, N) boolean matrix, True for conflicting tracks
+    """
+    gaps = np.maximum(first_frames[None, :] - last_frames[:, None],
+                      first_frames[:, None] - last_frames[None, :])
+    conflicting = gaps < transitions[cameras[:, None], cameras[None, :]]
+    np.fill_diagonal(conflicting, False)
+    return conflicting
+
+
+def _solve_group(candidates, rows):
+    """Assigns distinct identities to the conflicting tracks of rows"""
+    block = candidates[rows]
+    columns = np.unique(block.indices)
+    if len(columns) == 0:
+        return []
+    scores = block[:, columns].toarray()
+    present = np.zeros(scores.shape, dtype=bool)
+    present[np.repeat(np.arange(len(rows)), np.diff(block.indptr)),
+            np.searchsorted(columns, block.indices)] = True
+    # A pair that isn't a candidate costs more than all the candidate pairs of
+    # an assignment together, so as many tracks as possible get an identity
+    # and those pairs are dropped after
+    spread = scores.max() - scores.min()
+    costs = np.where(present, scores.max() - scores,
+                     spread * min(scores.shape) + 1)
+    matched_rows, matched_cols = linear_sum_assignment(costs)
+    return [(rows[r], columns[c], scores[r, c])
+            for r, c in zip(matched_rows, matched_cols) if present[r, c]]
+
+
+def assign_identities(candidates,
+                      cameras,
+                      first_frames,
+                      last_frames,
+                      transitions,
+                      window=REID_ASSIGNMENT_WINDOW):
+    """
+    Gives tracks of all the cameras gallery identities without conflicts
+
+    Parameters:
+    candidates (csr_matrix): (N, G) similarity of the candidate identities of
+                             each track, identities without an entry are not
+                             considered
+    cameras (ndarray): (N,) camera index of each track
+    first_frames (ndarray): (N,) first frame of each track
+    last_frames (ndarray): (N,) last frame of each track
+    transitions (ndarray): (C, C) transition times, see transition_matrix
+    window (int): span of the first frames of the tracks solved together
+
+    Returns:
+    indices (ndarray): (N,) gallery index of each track, REID_UNKNOWN_ID when
+                       none of its candidates could be given to it
+    confidences (ndarray): (N,) similarity of the assigned identity, -inf for
+                           unassigned tracks
+    """
+    candidates = csr_matrix(candidates)
+    cameras = np.asarray(cameras, dtype=np.int64)
+    first_frames = np.asarray(first_frames, dtype=np.int64)
+    last_frames = np.asarray(last_frames, dtype=np.int64)
+    indices = np.full(len(cameras), REID_UNKNOWN_ID, dtype=np.int64)
+    confidences = np.full(len(cameras), -np.inf, dtype=np.float32)
+    if len(cameras) == 0:
+        return indices, confidences
+
+    # Tracks given each identity so far
+    owners = dict()
+    order = np.argsort(first_frames, kind='stable')
+    windows = (first_frames[order] - first_frames[order[0]]) // max(window, 1)
+    bounds = np.flatnonzero(np.diff(windows)) + 1
+    for rows in np.split(order, bounds):
+        # Drop the identities given to earlier tracks conflicting with a track
+        allowed = candidates[rows].tocoo()
+        keep = np.ones(allowed.nnz, dtype=bool)
+        for entry, (row, column) in enumerate(zip(allowed.row, allowed.col)):
+            earlier = owners.get(column)
+            if earlier is not None:
+                track = rows[row]
+                gaps = np.maximum(first_frames[earlier] - last_frames[track],
+                                  first_frames[track] - last_frames[earlier])
+                keep[entry] = not np.any(
+                    gaps < transitions[cameras[track], cameras[earlier]])
+        allowed = coo_matrix(
+            (allowed.data[keep], (rows[allowed.row[keep]], allowed.col[keep])),
+            shape=candidates.shape).tocsr()
+
+        # Conflicting tracks of the window are solved together
+        graph = csr_matrix(
+            conflicts(cameras[rows], first_frames[rows], last_frames[rows],
+                      transitions))
+        _, labels = connected_components(graph, directed=False)
+        for label in np.unique(labels):
+            for track, column, score in _solve_group(allowed,
+                                                     rows[labels == label]):
+                indices[track] = column
+                confidences[track] = score
+                owners.setdefault(column, list()).append(track)
+    return indices, confidences
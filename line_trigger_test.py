@@ -1,11 +1,23 @@
 # TODO:(nhendy) script level docstring
 import tempfile
+from track_writers import TrackWriter, TRACK_FORMAT_CHOICES
 import galleries
 from detectors import FasterRCNN
 from attribute_extractors import MgnWrapper
+from devices import DEVICE_CHOICES
+from crop_stores import get_crop_store, CROP_STORE_CHOICES
+from online_features import OnlineFeatureExtractor
+from detection_scheduler import DetectionScheduler, optical_flow_boxes
+from detection_scheduler import MotionGate, MOTION_GATE_CHOICES
+from gallery_index import GalleryIndex, GALLERY_DTYPE_CHOICES
+from matching import as_matrix, ExactSearch, get_search_backend, evaluate_search
+from matching import DISTANCE_CHOICES, SEARCH_CHOICES
+from matching import track_queries, track_candidates, vote
+from identity_assignment import assign_identities, transition_matrix
 import loaders
 from PIL import Image
-from utils import crop_image
+from utils import crop_image, crop_quality, bounding_region, intersect_regions
+from track_sinks import ListSink, FileSink, TeeSink
 import config_parser
 import argparse
 import functools
@@ -15,7 +27,7 @@ import numpy as np
 import cv2
 from third_party.sort import Sort
 from bbox_trigger import VectorTrigger
-from scipy.stats import mode
+from scipy.sparse import vstack
 from tqdm import tqdm
 from constants import *
 
@@ -31,12 +43,32 @@ def init_args():
                         "--distance",
                         default='dot_product',
                         help="Distance metric used for retrieval",
-                        choices=['dot_product'])
+                        choices=DISTANCE_CHOICES)
+    parser.add_argument("--search",
+                        default='exact',
+                        help="Gallery search backend",
+                        choices=SEARCH_CHOICES)
+    parser.add_argument("--ivf_nlist",
+                        default=IVF_NLIST,
+                        help="Number of lists of the ivf search backend",
+                        type=int)
+    parser.add_argument("--ivf_nprobe",
+                        default=IVF_NPROBE,
+                        help="Number of lists scanned per query by the ivf search backend",
+                        type=int)
+    parser.add_argument(
+        "--report_search",
+        action='store_true',
+        help="Report recall and latency of the search backend against exact search")
     parser.add_argument("-l",
                         "--loader",
                         default='videos',
                         help="Type of data loading",
-                        choices=['videos', 'frames'])
+                        choices=loaders.LOADER_CHOICES)
+    parser.add_argument("--prefetch_depth",
+                        default=PREFETCH_QUEUE_DEPTH,
+                        help="Frames decoded ahead per camera by prefetch loaders",
+                        type=int)
     parser.add_argument("-g",
                         "--gallery",
                         default='trigger',
@@ -65,6 +97,99 @@ def init_args():
         default="tmpgal/",
         help="Path to gallery",
     )
+    parser.add_argument(
+        "--gallery_index",
+        default=None,
+        help="Directory of a persistent gallery index, reused and appended to across runs")
+    parser.add_argument("--gallery_dtype",
+                        default='float32',
+                        help="dtype of the embeddings in a new gallery index",
+                        choices=GALLERY_DTYPE_CHOICES)
+    parser.add_argument("--device",
+                        default='auto',
+                        help="Device to run the models on",
+                        choices=DEVICE_CHOICES)
+    parser.add_argument("--num_threads",
+                        default=None,
+                        help="Number of threads used for CPU inference",
+                        type=int)
+    parser.add_argument(
+        "--detect_batch",
+        default=1,
+        help="Number of consecutive samples detected in one call for all cameras",
+        type=int)
+    parser.add_argument("--crop_store",
+                        default='memory',
+                        help="Where the track reference crops are kept",
+                        choices=CROP_STORE_CHOICES)
+    parser.add_argument(
+        "--crop_store_max_mb",
+        default=CROP_STORE_MAX_BYTES // 1024**2,
+        help="Memory budget of the memory crop store in MiB",
+        type=int)
+    parser.add_argument(
+        "--crop_store_path",
+        default=None,
+        help="File backing the mmap crop store, or the file the memory crop store spills to",
+    )
+    parser.add_argument(
+        "--max_track_crops",
+        default=MAX_TRACK_CROPS,
+        help="Reference crops kept per track, the best ones are kept. 0 keeps them all",
+        type=int)
+    parser.add_argument(
+        "--track_summaries",
+        default=None,
+        help="Directory the summaries of finished tracks are written to, one JSON lines file per camera")
+    parser.add_argument(
+        "--appearance_association",
+        action='store_true',
+        help="Associate detections to tracks by MGN appearance as well as motion (DeepSORT style)")
+    parser.add_argument(
+        "--online_features",
+        action='store_true',
+        help="Featurize track crops on a background thread during tracking")
+    parser.add_argument("--score_threshold",
+                        default=DETECTION_SCORE_THRESHOLD,
+                        help="Minimum confidence score of a detection",
+                        type=float)
+    parser.add_argument(
+        "--adaptive_detection",
+        action='store_true',
+        help="Only detect on keyframes and coast the tracks in between, keyframes get closer when tracks are uncertain, people enter or the scene moves. Needs a detect_batch of 1")
+    parser.add_argument("--max_detect_interval",
+                        default=SCHEDULER_MAX_INTERVAL,
+                        help="Most samples between two keyframes of adaptive detection",
+                        type=int)
+    parser.add_argument(
+        "--optical_flow",
+        action='store_true',
+        help="Refine the tracks of the samples skipped by adaptive detection with optical flow")
+    parser.add_argument(
+        "--detect_max_side",
+        default=None,
+        help="Longest side frames are downscaled to before detection, boxes are scaled back",
+        type=int)
+    parser.add_argument(
+        "--detection_roi",
+        action='store_true',
+        help="Only detect people in the region of each camera given in DETECTION_ROIS or the config file")
+    parser.add_argument(
+        "--motion_gate",
+        default='none',
+        help="Skip detection on samples where nothing moved, by frame differencing or MOG2 background subtraction",
+        choices=MOTION_GATE_CHOICES)
+    parser.add_argument(
+        "--roi_detection",
+        action='store_true',
+        help="Only detect people in the region the motion gate saw moving and around the tracks")
+    parser.add_argument("--output_dir",
+                        default=".",
+                        help="Directory the re-identified tracks of each camera are written to")
+    parser.add_argument("--output_format",
+                        default='txt',
+                        help="Format of the track files",
+                        choices=TRACK_FORMAT_CHOICES)
     parser.add_argument("--config",
                         help="json file with configuration info")
     return parser.parse_args()
@@ -94,17 +219,6 @@ def get_max_index(array, k=1):
         return [x for _, x in sorted(zip(maxnums, maxinds), reverse=True)]
 
 
-def load_gallery_feat_vectors(imgs_dir, attribute_extractor):
-    if not os.path.exists(imgs_dir):
-        raise ValueError("path doesn't exist")
-    feat_vectors = list()
-    for name in os.listdir(imgs_dir):
-        feat_vector = read_img_and_compute_feat_vector(
-            os.path.join(imgs_dir, name), attribute_extractor)
-        feat_vectors.append(feat_vector)
-    return feat_vectors
-
-
 def cosine_similarity(x, y):
     return np.dot(x, y) / (np.sqrt(np.dot(x, x)) * np.sqrt(np.dot(y, y)))
 
@@ -116,125 +230,336 @@ def write_gallery_imgs(imgs, path):
         cv2.imwrite(os.path.join(path, "{:5d}.jpg".format(i)), img)
 
 
-def run_mot_and_fill_gallery(video_loader, gallery, detector, sort_trackers,
-                             output_files):
-
-    # Iterate through frames of all cameras
+def run_mot_and_fill_gallery(video_loader,
+                             gallery,
+                             detector,
+                             sort_trackers,
+                             track_writers,
+                             crop_store,
+                             detect_batch=1,
+                             feature_queue=None,
+                             attribute_extractor=None,
+                             scheduler=None,
+                             optical_flow=False,
+                             motion_gates=None,
+                             roi_detection=False,
+                             camera_rois=None):
+
+    if scheduler is not None and detect_batch > 1:
+        # The scheduler decides each sample after the trackers were updated
+        # on the previous one
+        raise ValueError("adaptive detection needs a detect_batch of 1")
+    # Previous sample of each camera, for optical flow
+    previous_frames = dict()
+    # Iterate through frames of all cameras, detect_batch samples at a time
     iterator = tqdm(video_loader)
-    for findex, frames in iterator:
-        if findex >= 400:
+    for samples in loaders.batch_samples(iterator, detect_batch):
+        samples = [(findex, frames) for findex, frames in samples
+                   if findex < 400]
+        if len(samples) == 0:
             iterator.close()
             break
-        # Iterate through each camera
-        for vidname, frame in frames.items():
-            # Get bounding boxes of all people
-            boxes, scores = detector.get_bboxes(frame)
-
-            # Send people bounding boxes to tracker
-            # Get three things: normal Sort output (tracking bounding boxes it wants to send), corresponding track objects, and objects of new tracks
-            tracker = sort_trackers[vidname]
-            dets = np.column_stack((np.reshape(boxes, [-1, 4]), scores))
-            matched_tracks, matched_kb_trackers, new_kb_trackers = tracker.update(
-                dets)
-
-            gallery.update(vidname, frame, matched_tracks)
-
-            # Find indexes of returned bounding boxes that meet ideal ratio
-            trkbboxes = np.array(matched_tracks)
-            widths = trkbboxes[:, 2] - trkbboxes[:, 0]
-            heights = trkbboxes[:, 3] - trkbboxes[:, 1]
-            aspectratio = heights / widths
-            readybools = np.isclose(aspectratio, 2, rtol=0.25)
-            indexes = np.arange(len(matched_tracks))[readybools]
-
-            # Iterate through returned bounding boxes
-            for ind, trk in enumerate(matched_tracks):
-                box = ((int(trk[0]), int(trk[1])), (int(trk[2]), int(trk[3])))
-
-                # If bounding box meets ideal ratio, save image of person as reference
-                if ind in indexes:
-                    cropimg = crop_image(frame, box)
-                    if cropimg.size > 5:
-                        fd, temp_file_name = tempfile.mkstemp(suffix='.jpg')
-                        cv2.imwrite(temp_file_name, cropimg)
-                        os.close(fd)
-                        matched_kb_trackers[ind].save_img(temp_file_name)
-
-                # Write bounding box, frame number, and trackid to file
-                output_files[vidname].write("%d,%d,%.2f,%.2f,%.2f,%.2f\n" %
-                                            (findex, trk[4], box[0][0],
-                                             box[0][1], box[1][0], box[1][1]))
-
-            # Iterate through new tracks and add their current bounding box to list of track references
-            for trk in new_kb_trackers:
-                d = trk.get_state()[0]
-                box = ((int(d[0]), int(d[1])), (int(d[2]), int(d[3])))
-                cropimg = crop_image(frame, box)
-                if cropimg.size > 5:
-                    fd, temp_file_name = tempfile.mkstemp(suffix='.jpg')
-                    cv2.imwrite(temp_file_name, cropimg)
-                    os.close(fd)
-                    trk.save_img(temp_file_name)
-
-
-def run_reid_model_and_assign_ids(sort_trackers, attribute_extractor,
-                                  output_files, gallery_feature_vectors):
-    # Iterate through trackers for each camera
-    for vidname, sorto in sort_trackers.items():
-        tracks = sorto.trackers + sorto.rejects
-        convertdict = dict()
 
-        # Iterate through tracks within each tracker
-        for trk in tqdm(tracks):
-            reidimgs = trk.imgfiles
-
-            # Iterate through every reference image for this track
-            for img in reidimgs:
-                # Get feature vector of image
-                uniqvect = read_img_and_compute_feat_vector(
-                    img, attribute_extractor)
-
-                if uniqvect is not None:
-                    # Find out what is the most similar gallery image
-                    # TODO: (nhendy) figure out if this is needs to be normalized
-                    dists = [
-                        np.average(np.dot(uniqvect, np.transpose(feat_vector)))
-                        for feat_vector in gallery_feature_vectors
-                    ]
-                    index = dists.index(max(dists))
-                    trk.reid.append(index)
+        # Get bounding boxes of all people in every camera and sample at once.
+        # Static samples are not detected and the scheduler skips the samples
+        # whose tracks can be coasted
+        frames_to_detect = dict()
+        rois = dict()
+        static = list()
+        for findex, frames in samples:
+            for vidname, frame in frames.items():
+                key = (findex, vidname)
+                roi = None if camera_rois is None else camera_rois.get(vidname)
+                if motion_gates is not None:
+                    moving = motion_gates[vidname].update(
+                        frame, sort_trackers[vidname].bboxes())
+                    if moving is not None and roi_detection:
+                        moving = moving if roi is None else intersect_regions(
+                            roi, moving)
+                        roi = moving
+                    if moving is None:
+                        static.append(key)
+                        continue
+                if roi is not None:
+                    rois[key] = roi
+                if scheduler is None or scheduler.should_detect(
+                        vidname, frame, sort_trackers[vidname]):
+                    frames_to_detect[key] = frame
+        detections = detector.get_bboxes_batch(frames_to_detect, rois)
+        embeddings = dict()
+        if attribute_extractor is not None:
+            embeddings = embed_detections(frames_to_detect, detections,
+                                          attribute_extractor)
+        # Trackers still get an update, without detections, on static samples
+        for key in static:
+            detections[key] = (np.empty((0, 4), dtype=np.float32),
+                               np.empty(0, dtype=np.float32))
+
+        for findex, frames in samples:
+            # Iterate through each camera
+            for vidname, frame in frames.items():
+                if (findex, vidname) in detections:
+                    boxes, scores = detections[(findex, vidname)]
+                    matched_tracks = update_tracker(
+                        findex, frame, boxes, scores, sort_trackers[vidname],
+                        track_writers[vidname], crop_store, feature_queue,
+                        embeddings.get((findex, vidname)))
+                    if scheduler is not None:
+                        scheduler.observe(vidname, sort_trackers[vidname])
+                else:
+                    matched_tracks = coast_tracker(
+                        findex, frame,
+                        previous_frames.get(vidname) if optical_flow else None,
+                        sort_trackers[vidname], track_writers[vidname])
+                if optical_flow:
+                    previous_frames[vidname] = frame
+
+                crossings = gallery.update(vidname, frame, matched_tracks,
+                                           findex)
+                if scheduler is not None and len(crossings) > 0:
+                    scheduler.alert(vidname)
+
+
+def embed_detections(frames, detections, attribute_extractor):
+    embeddings = dict()
+    crops = list()
+    rows = list()
+    for key, (boxes, _) in detections.items():
+        embeddings[key] = np.zeros((len(boxes), 2048), dtype=np.float32)
+        for i, box in enumerate(boxes):
+            cropimg = crop_image(frames[key], ((max(box[0], 0), max(box[1], 0)),
+                                               (box[2], box[3])))
+            if cropimg.size > 5:
+                crops.append(cropimg)
+                rows.append((key, i))
+
+    # Embed the detections of all frames in batches
+    feats = attribute_extractor.compute_feat_vectors(crops)
+    for (key, i), feat in zip(rows, feats):
+        embeddings[key][i] = feat
+    return embeddings
+
+
+def update_tracker(findex,
+                   frame,
+                   boxes,
+                   scores,
+                   tracker,
+                   track_writer,
+                   crop_store,
+                   feature_queue=None,
+                   embeddings=None):
+    # Send people bounding boxes to tracker
+    # Get three things: normal Sort output (tracking bounding boxes it wants to send), corresponding track objects, and objects of new tracks
+    dets = np.column_stack((boxes, scores))
+    matched_tracks, matched_kb_trackers, new_kb_trackers = tracker.update(
+        dets, findex, embeddings)
+
+    # Find indexes of returned bounding boxes that meet ideal ratio
+    trkbboxes = np.array(matched_tracks)
+    widths = trkbboxes[:, 2] - trkbboxes[:, 0]
+    heights = trkbboxes[:, 3] - trkbboxes[:, 1]
+    aspectratio = heights / widths
+    readybools = np.isclose(aspectratio, 2, rtol=0.25)
+    indexes = np.arange(len(matched_tracks))[readybools]
+
+    # Save images of people whose bounding box meets ideal ratio as references
+    for ind in indexes:
+        trk = matched_tracks[ind]
+        box = ((int(trk[0]), int(trk[1])), (int(trk[2]), int(trk[3])))
+        cropimg = crop_image(frame, box)
+        if cropimg.size > 5:
+            kbtrk = matched_kb_trackers[ind]
+            save_track_crop(kbtrk, cropimg, crop_store, feature_queue,
+                            crop_quality(box, kbtrk.score))
+
+    # Keep bounding boxes, frame number, and trackids
+    track_writer.append(findex, matched_tracks)
+
+    # Iterate through new tracks and add their current bounding box to list of track references
+    for trk in new_kb_trackers:
+        d = trk.get_state()[0]
+        box = ((int(d[0]), int(d[1])), (int(d[2]), int(d[3])))
+        cropimg = crop_image(frame, box)
+        if cropimg.size > 5:
+            save_track_crop(trk, cropimg, crop_store, feature_queue,
+                            crop_quality(box, trk.score))
+
+    return matched_tracks
+
+
+def coast_tracker(findex, frame, previous_frame, tracker, track_writer):
+    boxes = None
+    if previous_frame is not None:
+        boxes = optical_flow_boxes(previous_frame, frame, tracker.bboxes())
+    matched_tracks, _ = tracker.coast(boxes)
+    track_writer.append(findex, matched_tracks)
+    return matched_tracks
+
+
+def save_track_crop(trk,
+                    cropimg,
+                    crop_store,
+                    feature_queue=None,
+                    quality=0.0):
+    """
+    Saves a reference crop of a track and queues it for online featurizing
 
-            # Creating a dictionary mapping the trackIDs to the Re-IDs based on most frequent Re-ID of a track
-            if len(trk.reid) > 0:
-                convertdict[trk.id] = mode(trk.reid)[0][0]
+    The track only keeps its best crops, the crop it drops is removed from
+    the crop store.
 
-        # Vectorize mapping from track id to reid id.
-        track_id_to_reid_id = np.vectorize(
-            lambda value: convertdict.get(value, value))
+    Parameters:
+    trk (KalmanBoxTracker): track the crop belongs to
+    cropimg (ndarray): crop of the person
+    crop_store (CropStore): store keeping the track reference crops
+    feature_queue (OnlineFeatureExtractor): None when features are computed after tracking
+    quality (float): quality of the crop, see utils.crop_quality
+    """
+    key = crop_store.put(cropimg)
+    dropped = trk.appearance.save_crop(key, quality)
+    if dropped is not None:
+        crop_store.discard(dropped)
+    if feature_queue is not None and dropped != key:
+        feature_queue.submit(trk.appearance, cropimg, key)
 
-        # Use vectorized mapping function to change trackIDs to Re-IDs in output file
-        output_files[vidname][:, 1] = track_id_to_reid_id(
-            output_files[vidname][:, 1])
 
-        # Save
-        np.savetxt(vidname + ".txt", output_files[vidname])
+def track_feat_vectors(trk, attribute_extractor, crop_store):
+    """
+    Returns the (N, 2048) embeddings of a track's reference crops and the
+    quality of each of those crops
 
+    Embeddings computed online are reused, otherwise the crops are featurized.
+    """
+    features, qualities = trk.appearance.scored_features()
+    if len(features) > 0:
+        return np.stack(features), qualities
+    crops = list()
+    qualities = list()
+    for key, quality in zip(trk.appearance.crop_keys,
+                            trk.appearance.crop_qualities):
+        crop = crop_store.get(key)
+        if crop is not None:
+            crops.append(crop)
+            qualities.append(quality)
+    return attribute_extractor.compute_feat_vectors(crops), qualities
+
+
+def run_reid_model_and_assign_ids(camera_tracks,
+                                  attribute_extractor,
+                                  track_writers,
+                                  gallery_feature_vectors,
+                                  crop_store,
+                                  distance='dot_product',
+                                  search=None,
+                                  report_search=False,
+                                  output_dir=".",
+                                  output_format='txt',
+                                  aggregation='mean',
+                                  pool_top_k=TRACK_POOL_TOP_K,
+                                  unknown_threshold=None,
+                                  global_assignment=False,
+                                  reid_candidates=REID_CANDIDATES,
+                                  assignment_window=REID_ASSIGNMENT_WINDOW,
+                                  transition_frames=REID_MIN_TRANSITION_FRAMES):
+    # Hold the gallery as one contiguous (G, D) matrix
+    gallery_matrix = as_matrix(gallery_feature_vectors)
+    if search is None:
+        search = ExactSearch(distance)
+    search.build(gallery_matrix)
+    exact = None
+    if report_search:
+        exact = ExactSearch(distance).build(gallery_matrix)
+
+    # Match the tracks of each camera to the gallery
+    matches = dict()
+    for vidname, tracks in camera_tracks.items():
+        # Get feature vectors and qualities of every reference image of every track
+        track_crops = [
+            track_feat_vectors(trk, attribute_extractor, crop_store)
+            for trk in tqdm(tracks)
+        ]
+        if len(gallery_matrix) == 0 or len(tracks) == 0:
+            continue
+
+        track_feats, track_qualities = zip(*track_crops)
+        # One pooled query per track, or one query per crop when voting
+        queries, owners = track_queries(track_feats, track_qualities,
+                                        aggregation, pool_top_k,
+                                        gallery_matrix.shape[1])
+        indexes, scores = search.search(
+            queries, reid_candidates if global_assignment else 1)
+        if exact is not None:
+            stats = evaluate_search(search, exact, queries)
+            tqdm.write(
+                "{}: search recall {:.3f}, {:.3f} ms/query ({:.3f} ms exact)"
+                .format(vidname, stats["recall"], stats["latency_ms"],
+                        stats["exact_latency_ms"]))
+        matches[vidname] = (track_feats, indexes, scores, owners)
+
+    # Re-ID and confidence of the tracks of each camera
+    assignments = dict()
+    if global_assignment and len(matches) > 0:
+        cameras = list(matches.keys())
+        candidates = vstack([
+            track_candidates(indexes, scores, owners,
+                             (len(camera_tracks[vidname]), len(gallery_matrix)),
+                             unknown_threshold)
+            for vidname, (_, indexes, scores, owners) in matches.items()
+        ]).tocsr()
+        tracks = [trk for vidname in cameras for trk in camera_tracks[vidname]]
+        reids, confidences = assign_identities(
+            candidates,
+            np.repeat(np.arange(len(cameras)),
+                      [len(camera_tracks[vidname]) for vidname in cameras]),
+            [trk.first_frame for trk in tracks],
+            [trk.last_frame for trk in tracks],
+            transition_matrix(cameras, transition_frames,
+                              CAMERA_TRANSITION_FRAMES), assignment_window)
+        offsets = np.cumsum([len(camera_tracks[vidname])
+                             for vidname in cameras])[:-1]
+        for vidname, camera_reids, camera_confidences in zip(
+                cameras, np.split(reids, offsets),
+                np.split(confidences, offsets)):
+            assignments[vidname] = (camera_reids, camera_confidences)
+    else:
+        for vidname, (_, indexes, scores, owners) in matches.items():
+            assignments[vidname] = vote(indexes[:, 0], scores[:, 0], owners,
+                                        len(camera_tracks[vidname]))
 
-def convert_files_to_numpy(temp_dir, output_files):
-    for video_name, file_handle in output_files.items():
-        file_handle.close()
-        output_files[video_name] = np.loadtxt(os.path.join(
-            temp_dir, "{}.txt".format(video_name)),
-                                              delimiter=',')
+    for vidname, tracks in camera_tracks.items():
+        convertdict = dict()
+        if vidname in matches:
+            track_feats = matches[vidname][0]
+            reids, confidences = assignments[vidname]
+            # Creating a dictionary mapping the trackIDs to the Re-IDs, tracks
+            # without crops keep their trackID
+            for trk, feats, reid, confidence in zip(tracks, track_feats, reids,
+                                                    confidences):
+                if len(feats) == 0:
+                    continue
+                if unknown_threshold is not None and confidence < unknown_threshold:
+                    reid = REID_UNKNOWN_ID
+                convertdict[trk.id] = reid
+
+        # Change trackIDs to Re-IDs and save
+        track_writers[vidname].write(
+            os.path.join(output_dir, "{}.{}".format(vidname, output_format)),
+            output_format, convertdict)
 
 
 def main():
     args = init_args()
 
-    detector = FasterRCNN()
-    attribute_extractor = MgnWrapper(args.weights_path)
-    dataloader = loaders.get_loader(args.video_path, args.loader,
-                                    args.interval)
+    detector = FasterRCNN(args.device,
+                          args.num_threads,
+                          score_threshold=args.score_threshold,
+                          max_side=args.detect_max_side)
+    attribute_extractor = MgnWrapper(args.weights_path, args.device,
+                                     args.num_threads)
+    dataloader = loaders.get_loader(args.video_path,
+                                    args.loader,
+                                    args.interval,
+                                    queue_depth=args.prefetch_depth)
 
     # TODO: (nhendy) do this mapping in a config file
     if args.config:
@@ -260,40 +585,129 @@ def main():
             )
         ]
 
-    gallery = galleries.TriggerLineGallery(attribute_extractor, trigger_causes)
+    camera_rois = None
+    if args.detection_roi:
+        rois = dict(DETECTION_ROIS)
+        if args.config:
+            rois.update(config_parser.extract_detection_rois(json_dict))
+        camera_rois = {
+            vidname: bounding_region([roi])
+            for vidname, roi in rois.items()
+        }
+
+    index = None
+    if args.gallery_index:
+        index = GalleryIndex(args.gallery_index, dtype=args.gallery_dtype)
+    gallery = galleries.TriggerLineGallery(attribute_extractor,
+                                           trigger_causes,
+                                           index=index)
 
     temp_dir = tempfile.mkdtemp()
-
-    # create trackers for each video/camera
-    sort_trackers = {
-        vidnames: Sort()
+    feature_queue = OnlineFeatureExtractor(
+        attribute_extractor) if args.online_features else None
+    search = get_search_backend(args.search,
+                                args.distance,
+                                nlist=args.ivf_nlist,
+                                nprobe=args.ivf_nprobe)
+    crop_store = get_crop_store(args.crop_store,
+                                max_bytes=args.crop_store_max_mb * 1024**2,
+                                path=args.crop_store_path)
+
+    # create trackers for each video/camera, finished tracks are handed to
+    # the camera's sink
+    track_sinks = {
+        vidnames: ListSink()
         for vidnames in dataloader.get_vid_names()
     }
-    output_files = {
-        vidnames: open(os.path.join(temp_dir, "{}.txt".format(vidnames)), "w")
+    if args.track_summaries:
+        os.makedirs(args.track_summaries, exist_ok=True)
+    sort_trackers = dict()
+    for vidnames, sink in track_sinks.items():
+        on_finish = sink
+        if args.track_summaries:
+            on_finish = TeeSink(
+                sink,
+                FileSink(
+                    os.path.join(args.track_summaries,
+                                 "{}.jsonl".format(vidnames))))
+        sort_trackers[vidnames] = Sort(max_crops=args.max_track_crops or None,
+                                       on_finish=on_finish)
+    # Full chunks of track rows are spilled to temp_dir
+    track_writers = {
+        vidnames: TrackWriter(spill_dir=temp_dir)
         for vidnames in dataloader.get_vid_names()
     }
 
+    scheduler = None
+    if args.adaptive_detection:
+        scheduler = DetectionScheduler(args.max_detect_interval)
+    motion_gates = None
+    if args.motion_gate != 'none':
+        motion_gates = {
+            vidnames: MotionGate(args.motion_gate)
+            for vidnames in dataloader.get_vid_names()
+        }
+
     # Run detector, Sort and fill up gallery
-    run_mot_and_fill_gallery(dataloader, gallery, detector, sort_trackers,
-                             output_files)
+    run_mot_and_fill_gallery(dataloader,
+                             gallery,
+                             detector,
+                             sort_trackers,
+                             track_writers,
+                             crop_store,
+                             detect_batch=args.detect_batch,
+                             feature_queue=feature_queue,
+                             attribute_extractor=attribute_extractor
+                             if args.appearance_association else None,
+                             scheduler=scheduler,
+                             optical_flow=args.optical_flow,
+                             motion_gates=motion_gates,
+                             roi_detection=args.roi_detection,
+                             camera_rois=camera_rois)
+    if motion_gates is not None:
+        for vidname, gate in motion_gates.items():
+            tqdm.write("{}: {} of {} samples static, skipped {:.1%}".format(
+                vidname, gate.skipped, gate.checked, gate.skip_ratio()))
+    if scheduler is not None:
+        for vidname in sort_trackers:
+            tqdm.write("{}: detected {} samples, skipped {:.1%}".format(
+                vidname, scheduler.detected.get(vidname, 0),
+                scheduler.skip_ratio(vidname)))
+    for sorto in sort_trackers.values():
+        sorto.finish_all()
+        sorto.on_finish.close()
+    if feature_queue is not None:
+        feature_queue.close()
 
     # Save images from gallery captured throughout video
     write_gallery_imgs(gallery.people(), args.gallery_path)
 
     """
-    # Load up the gallery feature vectors
-    gallery_feature_vectors = load_gallery_feat_vectors(
-        args.gallery_path, attribute_extractor)
+    # Gallery feature vectors were computed as people were added
+    if index is not None:
+        gallery_feature_vectors = index.embeddings
+    else:
+        gallery_feature_vectors = gallery.feats
 
-    # TODO: (nhendy) this is needed because downstream functions
-    # assume the dict contain numpy arrays not files. Remove later
-    convert_files_to_numpy(temp_dir, output_files)
+    camera_tracks = {
+        vidnames: sink.summaries
+        for vidnames, sink in track_sinks.items()
+    }
 
     # Run reid model and map track ids to reid ids
-    run_reid_model_and_assign_ids(sort_trackers, attribute_extractor,
-                                  output_files, gallery_feature_vectors)
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_reid_model_and_assign_ids(camera_tracks, attribute_extractor,
+                                  track_writers, gallery_feature_vectors,
+                                  crop_store, args.distance,
+                                  search, args.report_search,
+                                  args.output_dir, args.output_format)
     """
 
+    for track_writer in track_writers.values():
+        track_writer.close()
+    crop_store.close()
+    if index is not None:
+        index.close()
+
 if __name__ == "__main__":
     sys.exit(main())
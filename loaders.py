@@ -1,11 +1,31 @@
-from constants import defaultkey
+from constants import defaultkey, VIDEO_MAX_GRAB_SKIP
+from constants import PREFETCH_QUEUE_DEPTH, PREFETCH_POLL_INTERVAL
 from PIL import Image
 import os
+import queue
+import threading
 import cv2
 import numpy as np
 
 
-def get_loader(path, typeloader, interval):
+def get_loader(path,
+               typeloader,
+               interval,
+               sequential=True,
+               queue_depth=PREFETCH_QUEUE_DEPTH):
+    """
+    Creates the loader for the data in path
+
+    Parameters:
+    path (str): directory with one video file or frame directory per camera
+    typeloader (str): 'videos', 'frames', 'prefetch_videos' or 'prefetch_frames'
+    interval (int): sampling interval
+    sequential (bool): decode videos sequentially instead of seeking
+    queue_depth (int): frames buffered per camera by the prefetch loaders
+
+    Returns:
+    Loader: loader yielding (index, frames) tuples
+    """
     # check if path exists
     if not os.path.exists(path):
         raise ValueError("path: {} does not exist".format(path))
@@ -15,18 +35,60 @@ def get_loader(path, typeloader, interval):
     if len(contents) == 0:
         raise ValueError("nothing in {}".format(path))
 
+    prefix = "prefetch_"
+    if typeloader.startswith(prefix):
+        loader = get_loader(path, typeloader[len(prefix):], interval,
+                            sequential)
+        return PrefetchLoader(loader, queue_depth=queue_depth)
     if typeloader == "videos":
         contents = [
             name for name in contents
             if not os.path.isdir(os.path.join(path, name))
         ]
-        return VideoLoader(path, contents, interval=interval)
+        return VideoLoader(path,
+                           contents,
+                           interval=interval,
+                           sequential=sequential)
     elif typeloader == "frames":
         contents = [
             name for name in contents
             if os.path.isdir(os.path.join(path, name))
         ]
         return FrameLoader(path, contents, interval=interval)
+    raise ValueError("unknown loader type {}".format(typeloader))
+
+
+def num_samples(length, interval):
+    """Number of indexes 0, interval, 2 * interval, ... below length"""
+    return (length + interval - 1) // interval
+
+
+def batch_samples(loader, batch_size):
+    """
+    Groups consecutive (index, frames) samples of a loader into lists
+
+    Parameters:
+    loader (iterable): loader yielding (index, frames) tuples
+    batch_size (int): number of samples per group, the last one may be shorter
+
+    Returns:
+    generator of lists of (index, frames) tuples
+    """
+    if batch_size < 1:
+        raise ValueError(
+            "batch_size must be positive, got {}".format(batch_size))
+    batch = list()
+    for sample in loader:
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+
+LOADER_CHOICES = ['videos', 'frames', 'prefetch_videos', 'prefetch_frames']
+
 
 class Loader:
     def __init__(self):
@@ -36,7 +98,27 @@ class Loader:
         return self.videos.keys()
 
 class VideoLoader(Loader):
-    def __init__(self, path, vids, interval=1):
+    """
+    Loads frames with the same index from several videos
+
+    When sequential is set, frames are decoded in order and the frames
+    between two samples are skipped with grab(), which avoids a keyframe seek
+    and re-decode for every sample. Seeking is only used for backward or
+    large forward jumps.
+
+    Attributes:
+    videos (dict): cv2.VideoCapture of each video keyed by name
+    length (int): number of frames in the shortest video
+    interval (int): sampling interval
+    sequential (bool): whether to decode sequentially instead of seeking
+    max_skip (int): largest number of frames skipped with grab() before seeking
+    """
+    def __init__(self,
+                 path,
+                 vids,
+                 interval=1,
+                 sequential=True,
+                 max_skip=VIDEO_MAX_GRAB_SKIP):
         super().__init__()
         self.path = path
         names = [os.path.splitext(key)[0] for key in vids]
@@ -45,29 +127,63 @@ class VideoLoader(Loader):
             for name, file in zip(names, vids)
         }
         self.index = 0
-        self.length = min([
-            vid.get(cv2.CAP_PROP_FRAME_COUNT)
-            for name, vid in self.videos.items()
-        ])
+        # Frame indexes are shared by all videos so only the shortest one's
+        # frames can be sampled, whatever the frame rates are
+        self.length = int(
+            min([
+                vid.get(cv2.CAP_PROP_FRAME_COUNT)
+                for name, vid in self.videos.items()
+            ]))
         self.interval = interval
+        self.sequential = sequential
+        self.max_skip = max_skip
+        # Index of the next frame each capture will decode
+        self._positions = {name: 0 for name in self.videos}
+
+    def read_frame(self, name, index):
+        """
+        Reads a single frame of one video
+
+        Parameters:
+        name (str): name of the video
+        index (int): index of the frame
+
+        Returns:
+        ndarray: the frame, None if it couldn't be read
+        """
+        vid = self.videos[name]
+        skip = index - self._positions[name]
+        if not self.sequential or skip < 0 or skip > self.max_skip:
+            vid.set(cv2.CAP_PROP_POS_FRAMES, index)
+        else:
+            for _ in range(skip):
+                if not vid.grab():
+                    return None
+        success, frame = vid.read()
+        self._positions[name] = index + 1
+        if not success:
+            return None
+        return frame
 
     def __iter__(self):
         self.index = 0
         return self
 
     def __next__(self):
+        if self.index >= self.length:
+            raise StopIteration
+
         retval = dict()
-        for name, vid in self.videos.items():
-            vid.set(cv2.CAP_PROP_POS_FRAMES, self.index)
-            success, retval[name] = vid.read()
-            if not success:
+        for name in self.videos:
+            retval[name] = self.read_frame(name, self.index)
+            if retval[name] is None:
                 raise StopIteration
         indtosend = self.index
         self.index = self.index + self.interval
         return indtosend, retval
 
     def __len__(self):
-        return int(self.length / self.interval)
+        return num_samples(self.length, self.interval)
 
 class FrameLoader(Loader):
     def __init__(self, path, dirs, interval=1):
@@ -84,6 +200,22 @@ class FrameLoader(Loader):
         ])
         self.interval = interval
 
+    def read_frame(self, name, index):
+        """
+        Reads a single frame of one camera
+
+        Parameters:
+        name (str): name of the camera directory
+        index (int): index of the frame
+
+        Returns:
+        ndarray: the frame in cv2 BGR format
+        """
+        pilimg = Image.open(
+            os.path.join(self.path, name, self.videos[name][index]))
+        # convert to cv2 numpy format
+        return cv2.cvtColor(np.array(pilimg), cv2.COLOR_RGB2BGR)
+
     def __iter__(self):
         self.index = 0
         return self
@@ -93,14 +225,118 @@ class FrameLoader(Loader):
             raise StopIteration
 
         retval = dict()
-        for name, imgs in self.videos.items():
-            pilimg = Image.open(os.path.join(self.path, name, imgs[self.index]))
-            # convert to cv2 numpy format
-            retval[name] = cv2.cvtColor(np.array(pilimg), cv2.COLOR_RGB2BGR)
+        for name in self.videos:
+            retval[name] = self.read_frame(name, self.index)
 
         indtosend = self.index
         self.index = self.index + self.interval
         return indtosend, retval
 
     def __len__(self):
-        return int(self.length / self.interval)
+        return num_samples(self.length, self.interval)
+
+
+class PrefetchLoader(Loader):
+    """
+    Wraps a VideoLoader or FrameLoader and decodes frames ahead of time
+
+    Every camera gets its own decode thread (cv2 and PIL release the GIL while
+    decoding) filling a bounded queue, so decoding overlaps with whatever the
+    consumer does with the previous samples. A full queue blocks its worker,
+    which bounds the memory used by decoded frames.
+
+    Attributes:
+    loader (Loader): wrapped loader providing read_frame
+    queue_depth (int): number of decoded frames buffered per camera
+    """
+
+    # Put on a camera's queue once it has no more frames
+    _END = None
+
+    def __init__(self, loader, queue_depth=PREFETCH_QUEUE_DEPTH):
+        super().__init__()
+        if queue_depth < 1:
+            raise ValueError(
+                "queue_depth must be positive, got {}".format(queue_depth))
+        self.loader = loader
+        self.queue_depth = queue_depth
+        self._queues = dict()
+        self._workers = list()
+        self._stop = threading.Event()
+
+    @property
+    def videos(self):
+        return self.loader.videos
+
+    def _decode(self, name, frame_queue, stop):
+        """Worker decoding every sampled frame of one camera in order"""
+        try:
+            for index in range(0, self.loader.length, self.loader.interval):
+                frame = self.loader.read_frame(name, index)
+                if frame is None:
+                    break
+                if not self._put(frame_queue, (index, frame), stop):
+                    return
+        except Exception as error:
+            # Handed to the consumer, which would otherwise wait forever
+            self._put(frame_queue, error, stop)
+            return
+        self._put(frame_queue, self._END, stop)
+
+    @staticmethod
+    def _put(frame_queue, item, stop):
+        """Blocks until item is queued or stop is set, returns if it was queued"""
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=PREFETCH_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        self.close()
+        self._stop = threading.Event()
+        self._queues = {
+            name: queue.Queue(maxsize=self.queue_depth)
+            for name in self.get_vid_names()
+        }
+        self._workers = [
+            threading.Thread(target=self._decode,
+                             args=(name, frame_queue, self._stop),
+                             daemon=True)
+            for name, frame_queue in self._queues.items()
+        ]
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __next__(self):
+        retval = dict()
+        indtosend = None
+        for name, frame_queue in self._queues.items():
+            item = frame_queue.get()
+            if isinstance(item, Exception):
+                self.close()
+                raise item
+            if item is self._END:
+                self.close()
+                raise StopIteration
+            indtosend, retval[name] = item
+        if indtosend is None:
+            raise StopIteration
+        return indtosend, retval
+
+    def close(self):
+        """Stops the decode threads and drops the frames they buffered"""
+        self._stop.set()
+        for frame_queue in self._queues.values():
+            while not frame_queue.empty():
+                frame_queue.get_nowait()
+        for worker in self._workers:
+            worker.join()
+        self._queues = dict()
+        self._workers = list()
+
+    def __len__(self):
+        return len(self.loader)
@@ -0,0 +1,417 @@
+'''
+Scoring of query embeddings against the gallery embeddings
+'''
+
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+from constants import IVF_NLIST, IVF_NPROBE, IVF_KMEANS_ITERATIONS
+from constants import TRACK_POOL_TOP_K, REID_UNKNOWN_ID
+
+DISTANCE_CHOICES = ['dot_product', 'cosine', 'euclidean']
+SEARCH_CHOICES = ['exact', 'ivf']
+AGGREGATION_CHOICES = ['mean', 'topk', 'vote']
+
+
+def as_matrix(feats, dim=None):
+    """
+    Stacks feature vectors into a contiguous float32 matrix
+
+    Parameters:
+    feats (list or ndarray): feature vectors, one per row
+    dim (int): length of a feature vector, used when feats is empty
+
+    Returns:
+    ndarray: (N, D) float32 matrix
+    """
+    if len(feats) == 0:
+        return np.empty((0, dim or 0), dtype=np.float32)
+    feats = np.asarray(feats, dtype=np.float32)
+    return np.ascontiguousarray(feats.reshape(len(feats), -1))
+
+
+def normalize(feats):
+    """L2 normalizes each row of a matrix"""
+    norms = np.linalg.norm(feats, axis=1, keepdims=True)
+    return feats / np.maximum(norms, 1e-12)
+
+
+def similarity_matrix(queries, gallery, distance='dot_product'):
+    """
+    Scores every query against every gallery vector, higher is more similar
+
+    Parameters:
+    queries (ndarray): (Q, D) query embeddings
+    gallery (ndarray): (G, D) gallery embeddings
+    distance (str): 'dot_product', 'cosine' or 'euclidean'. Euclidean
+                    distances are negated so that higher stays better
+
+    Returns:
+    ndarray: (Q, G) similarity matrix
+    """
+    if distance == 'dot_product':
+        return np.dot(queries, gallery.T)
+    elif distance == 'cosine':
+        return np.dot(normalize(queries), normalize(gallery).T)
+    elif distance == 'euclidean':
+        sqdists = (np.sum(queries**2, axis=1)[:, None] +
+                   np.sum(gallery**2, axis=1)[None, :] -
+                   2 * np.dot(queries, gallery.T))
+        return -np.sqrt(np.maximum(sqdists, 0))
+    raise ValueError("unknown distance {}".format(distance))
+
+
+def top_k(similarities, k=1):
+    """
+    Finds the k most similar gallery entries of each query
+
+    Parameters:
+    similarities (ndarray): (Q, G) similarity matrix
+    k (int): number of entries kept per query, capped at G
+
+    Returns:
+    indices (ndarray): (Q, k) gallery indexes, most similar first
+    scores (ndarray): (Q, k) similarity of each of those entries
+    """
+    k = min(k, similarities.shape[1])
+    if k == 1:
+        indices = np.argmax(similarities, axis=1)[:, None]
+    else:
+        indices = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, indices, axis=1),
+                           axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+    return indices, np.take_along_axis(similarities, indices, axis=1)
+
+
+def get_search_backend(typesearch,
+                       distance='dot_product',
+                       nlist=IVF_NLIST,
+                       nprobe=IVF_NPROBE):
+    """
+    Creates a gallery search backend
+
+    Parameters:
+    typesearch (str): 'exact' or 'ivf'
+    distance (str): metric used to compare embeddings
+    nlist (int): number of lists of the 'ivf' backend
+    nprobe (int): number of lists scanned per query by the 'ivf' backend
+
+    Returns:
+    ExactSearch or IVFSearch: backend, call build() before searching
+    """
+    if typesearch == 'exact':
+        return ExactSearch(distance)
+    elif typesearch == 'ivf':
+        return IVFSearch(distance, nlist=nlist, nprobe=nprobe)
+    raise ValueError("unknown search backend {}".format(typesearch))
+
+
+class ExactSearch:
+    """
+    Brute force search, scores queries against the whole gallery
+
+    Attributes:
+    distance (str): metric used to compare embeddings
+    gallery (ndarray): (G, D) gallery embeddings
+    """
+    def __init__(self, distance='dot_product'):
+        self.distance = distance
+        self.gallery = None
+
+    def build(self, gallery):
+        """Indexes the (G, D) gallery embeddings, returns self"""
+        self.gallery = as_matrix(gallery)
+        return self
+
+    def search(self, queries, k=1):
+        """
+        Finds the k most similar gallery entries of each query
+
+        Parameters:
+        queries (ndarray): (Q, D) query embeddings
+        k (int): number of entries returned per query
+
+        Returns:
+        indices (ndarray): (Q, k) gallery indexes, most similar first
+        scores (ndarray): (Q, k) similarity of each of those entries
+        """
+        return top_k(similarity_matrix(queries, self.gallery, self.distance),
+                     k)
+
+
+class IVFSearch:
+    """
+    Approximate search with an inverted file index
+
+    The gallery is clustered with k-means into nlist lists. A query is only
+    scored against the entries of the nprobe lists whose centroids are the
+    most similar to it, so a search costs about nprobe / nlist of an exact
+    scan.
+
+    Attributes:
+    distance (str): metric used to compare embeddings
+    nlist (int): number of lists the gallery is split into
+    nprobe (int): number of lists scanned per query
+    iterations (int): k-means iterations used to build the lists
+    centroids (ndarray): (nlist, D) centroid of each list
+    """
+    def __init__(self,
+                 distance='dot_product',
+                 nlist=IVF_NLIST,
+                 nprobe=IVF_NPROBE,
+                 iterations=IVF_KMEANS_ITERATIONS,
+                 seed=0):
+        if nlist < 1 or nprobe < 1:
+            raise ValueError("nlist and nprobe must be positive")
+        self.distance = distance
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.centroids = None
+        self._rng = np.random.RandomState(seed)
+        self._gallery = None
+        self._order = None
+        self._offsets = None
+
+    def build(self, gallery):
+        """Clusters the (G, D) gallery embeddings into lists, returns self"""
+        gallery = as_matrix(gallery)
+        if len(gallery) == 0:
+            self.centroids = gallery
+            self._gallery = gallery
+            self._order = np.empty(0, dtype=np.int64)
+            self._offsets = np.zeros(1, dtype=np.int64)
+            return self
+        nlist = min(self.nlist, len(gallery))
+        centroids = gallery[self._rng.choice(len(gallery),
+                                             nlist,
+                                             replace=False)]
+        for _ in range(self.iterations):
+            assignment = self._assign(gallery, centroids)
+            counts = np.bincount(assignment, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, gallery)
+            # Empty lists keep their previous centroid
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assignment = self._assign(gallery, centroids)
+
+        # Store the entries list by list so each list is a contiguous slice
+        self._order = np.argsort(assignment, kind='stable')
+        self._gallery = gallery[self._order]
+        self._offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignment, minlength=nlist))))
+        self.centroids = centroids
+        return self
+
+    @staticmethod
+    def _assign(gallery, centroids):
+        return np.argmax(similarity_matrix(gallery, centroids, 'euclidean'),
+                         axis=1)
+
+    def search(self, queries, k=1):
+        """
+        Finds the k most similar gallery entries of each query among the probed lists
+
+        Parameters:
+        queries (ndarray): (Q, D) query embeddings
+        k (int): number of entries returned per query
+
+        Returns:
+        indices (ndarray): (Q, k) gallery indexes, most similar first, -1 when
+                           the probed lists hold fewer than k entries
+        scores (ndarray): (Q, k) similarity of each of those entries
+        """
+        queries = as_matrix(queries, self._gallery.shape[1])
+        k = min(k, len(self._gallery))
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if len(queries) == 0 or k == 0:
+            return indices, scores
+        probes, _ = top_k(
+            similarity_matrix(queries, self.centroids, self.distance),
+            self.nprobe)
+        for q, lists in enumerate(probes):
+            candidates = np.concatenate([
+                np.arange(self._offsets[l], self._offsets[l + 1])
+                for l in lists
+            ])
+            sims = similarity_matrix(queries[q:q + 1],
+                                     self._gallery[candidates], self.distance)
+            found, found_scores = top_k(sims, k)
+            indices[q, :found.shape[1]] = self._order[candidates[found[0]]]
+            scores[q, :found.shape[1]] = found_scores[0]
+        return indices, scores
+
+
+def pool_embeddings(feats, qualities=None, aggregation='mean',
+                    k=TRACK_POOL_TOP_K):
+    """
+    Pools the crop embeddings of a track into one descriptor
+
+    Parameters:
+    feats (ndarray): (N, D) crop embeddings, N > 0
+    qualities (list): quality of each crop, None weighs the crops equally
+    aggregation (str): 'mean' for the quality weighted mean of all the crops,
+                       'topk' for the mean of the k best crops
+    k (int): number of crops pooled by 'topk'
+
+    Returns:
+    ndarray: (D,) L2 normalized descriptor
+    """
+    feats = as_matrix(feats)
+    if qualities is None:
+        weights = np.ones(len(feats), dtype=np.float32)
+    else:
+        weights = np.maximum(np.asarray(qualities, dtype=np.float32), 0)
+    if aggregation == 'topk':
+        best = np.argsort(-weights, kind='stable')[:k]
+        feats = feats[best]
+        weights = np.ones(len(best), dtype=np.float32)
+    elif aggregation != 'mean':
+        raise ValueError("unknown aggregation {}".format(aggregation))
+    if weights.sum() <= 0:
+        weights = np.ones(len(feats), dtype=np.float32)
+    return normalize(np.dot(weights, feats)[None, :])[0]
+
+
+def track_queries(track_feats,
+                  track_qualities=None,
+                  aggregation='mean',
+                  k=TRACK_POOL_TOP_K,
+                  dim=None):
+    """
+    Builds the gallery queries of some tracks
+
+    Pooling aggregations give one query per track, 'vote' one per crop.
+    Tracks without embeddings have no query.
+
+    Parameters:
+    track_feats (list): (N, D) crop embeddings of each track
+    track_qualities (list): quality of each crop of each track, or None
+    aggregation (str): 'mean', 'topk' or 'vote'
+    k (int): number of crops pooled by 'topk'
+    dim (int): length of an embedding, used when there are no queries
+
+    Returns:
+    queries (ndarray): (Q, D) query embeddings
+    owners (ndarray): (Q,) index of the track of each query
+    """
+    if track_qualities is None:
+        track_qualities = [None] * len(track_feats)
+    if aggregation == 'vote':
+        counts = [len(feats) for feats in track_feats]
+        queries = [feats for feats in track_feats if len(feats) > 0]
+        queries = np.concatenate(queries) if len(queries) > 0 else []
+        owners = np.repeat(np.arange(len(track_feats)), counts)
+    else:
+        owners = np.array(
+            [t for t, feats in enumerate(track_feats) if len(feats) > 0],
+            dtype=np.int64)
+        queries = [
+            pool_embeddings(track_feats[t], track_qualities[t], aggregation, k)
+            for t in owners
+        ]
+    return as_matrix(queries, dim), owners
+
+
+def vote(indices, scores, owners, num_tracks):
+    """
+    Gives each track the gallery entry most of its queries matched
+
+    Ties go to the lowest gallery index. With one query per track this is
+    just that query's match.
+
+    Parameters:
+    indices (ndarray): (Q,) best gallery index of each query, -1 for none
+    scores (ndarray): (Q,) similarity of each of those matches
+    owners (ndarray): (Q,) index of the track of each query
+    num_tracks (int): number of tracks
+
+    Returns:
+    indices (ndarray): (T,) gallery index of each track, REID_UNKNOWN_ID when
+                       none of its queries matched
+    confidences (ndarray): (T,) mean similarity of the queries agreeing with
+                           the track's match, -inf when there is none
+    """
+    track_indices = np.full(num_tracks, REID_UNKNOWN_ID, dtype=np.int64)
+    confidences = np.full(num_tracks, -np.inf, dtype=np.float32)
+    found = indices >= 0
+    if not np.any(found):
+        return track_indices, confidences
+    pairs, inverse, counts = np.unique(np.stack(
+        (owners[found], indices[found]), axis=1),
+                                       axis=0,
+                                       return_inverse=True,
+                                       return_counts=True)
+    inverse = inverse.reshape(-1)
+    mean_scores = np.bincount(inverse, weights=scores[found]) / counts
+    # Per track, the most voted pair comes first, lowest gallery index on ties
+    order = np.lexsort((pairs[:, 1], -counts, pairs[:, 0]))
+    tracks, first = np.unique(pairs[order, 0], return_index=True)
+    winners = order[first]
+    track_indices[tracks] = pairs[winners, 1]
+    confidences[tracks] = mean_scores[winners]
+    return track_indices, confidences
+
+
+def track_candidates(indices, scores, owners, shape, min_score=None):
+    """
+    Gathers the candidate gallery identities of tracks from their query matches
+
+    Parameters:
+    indices (ndarray): (Q, k) gallery indexes found for each query, -1 for none
+    scores (ndarray): (Q, k) similarity of each of those entries
+    owners (ndarray): (Q,) index of the track of each query
+    shape (tuple): number of tracks and of gallery entries
+    min_score (float): smallest similarity of a candidate, None keeps them all
+
+    Returns:
+    csr_matrix: (T, G) mean similarity of the queries of a track that found
+                each of its candidates
+    """
+    found = indices >= 0
+    if min_score is not None:
+        found &= scores >= min_score
+    rows = np.broadcast_to(np.asarray(owners)[:, None], indices.shape)[found]
+    columns = indices[found]
+    sums = coo_matrix((scores[found].astype(np.float64), (rows, columns)),
+                      shape=shape).tocsr()
+    counts = coo_matrix((np.ones(len(rows)), (rows, columns)),
+                        shape=shape).tocsr()
+    sums.sum_duplicates()
+    counts.sum_duplicates()
+    sums.data /= counts.data
+    return sums
+
+
+def evaluate_search(backend, exact, queries, k=1):
+    """
+    Compares an approximate backend to the exact search on some queries
+
+    Parameters:
+    backend (IVFSearch): built approximate backend
+    exact (ExactSearch): exact backend built on the same gallery
+    queries (ndarray): (Q, D) query embeddings
+    k (int): number of entries returned per query
+
+    Returns:
+    dict: recall@k of the backend and the latency per query in ms of both
+    """
+    start = time.perf_counter()
+    found, _ = backend.search(queries, k)
+    approx_time = time.perf_counter() - start
+    start = time.perf_counter()
+    expected, _ = exact.search(queries, k)
+    exact_time = time.perf_counter() - start
+
+    hits = sum(
+        len(np.intersect1d(row_found, row_expected))
+        for row_found, row_expected in zip(found, expected))
+    num = max(len(queries), 1)
+    return {
+        "recall": hits / max(expected.size, 1),
+        "latency_ms": 1000 * approx_time / num,
+        "exact_latency_ms": 1000 * exact_time / num,
+    }
@@ -0,0 +1,117 @@
+'''
+Featurizes track crops on a background thread while tracking goes on
+'''
+
+import queue
+import threading
+import numpy as np
+from constants import MGN_BATCH_SIZE, ONLINE_FEATURES_MAX_PENDING
+from constants import ONLINE_FEATURES_MAX_WAIT
+
+
+class OnlineFeatureExtractor:
+    """
+    Computes the embeddings of track crops in micro-batches on a worker thread
+
+    Crops are queued with submit() from the tracking loop. The worker groups
+    whatever is queued into batches of up to batch_size crops, featurizes them
+    with one compute_feat_vectors call and adds the embeddings to their
+    tracks with TrackAppearance.add_features.
+
+    Attributes:
+    attribute_extractor (MgnWrapper): attribute extractor
+    batch_size (int): largest number of crops featurized at once
+    max_wait (float): seconds the worker waits for more crops to fill a batch
+    """
+
+    # Put on the queue to stop the worker
+    _STOP = None
+
+    def __init__(self,
+                 attribute_extractor,
+                 batch_size=MGN_BATCH_SIZE,
+                 max_pending=ONLINE_FEATURES_MAX_PENDING,
+                 max_wait=ONLINE_FEATURES_MAX_WAIT):
+        """
+        constructor for OnlineFeatureExtractor, starts the worker
+
+        Parameters:
+        attribute_extractor (MgnWrapper): attribute extractor
+        batch_size (int): largest number of crops featurized at once
+        max_pending (int): crops queued before submit() blocks
+        max_wait (float): seconds the worker waits for more crops to fill a batch
+        """
+        self.attribute_extractor = attribute_extractor
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, appearance, crop, key):
+        """
+        Queues a crop of a track to be featurized
+
+        Parameters:
+        appearance (TrackAppearance): appearance of the track the crop belongs to
+        crop (ndarray): crop, copied so it doesn't keep the full frame alive
+        key (int): crop store key of the crop
+        """
+        self._raise_worker_error()
+        self._queue.put((appearance, np.array(crop), key))
+
+    def _next_batch(self):
+        """Blocks for one crop then gathers more until the batch is full"""
+        batch = [self._queue.get()]
+        while batch[-1] is not self._STOP and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.max_wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            if batch[-1] is self._STOP:
+                stop = True
+                batch.pop()
+            try:
+                if len(batch) > 0 and self._error is None:
+                    self._featurize(batch)
+            except Exception as error:
+                self._error = error
+            finally:
+                for _ in range(len(batch) + int(stop)):
+                    self._queue.task_done()
+
+    def _featurize(self, batch):
+        appearances, crops, keys = zip(*batch)
+        feats = self.attribute_extractor.compute_feat_vectors(
+            list(crops), batch_size=self.batch_size)
+        # Crops of the same track are added together
+        rows = dict()
+        for row, appearance in enumerate(appearances):
+            rows.setdefault(id(appearance), (appearance, list()))[1].append(row)
+        for appearance, track_rows in rows.values():
+            appearance.add_features(feats[track_rows],
+                                    [keys[row] for row in track_rows])
+
+    def _raise_worker_error(self):
+        if self._error is not None:
+            raise RuntimeError(
+                "online feature extraction failed") from self._error
+
+    def flush(self):
+        """Blocks until every submitted crop has been featurized"""
+        self._queue.join()
+        self._raise_worker_error()
+
+    def close(self):
+        """Featurizes the remaining crops and stops the worker"""
+        if self._worker.is_alive():
+            self._queue.put(self._STOP)
+            self._worker.join()
+        self._raise_worker_error()
@@ -3,12 +3,24 @@ This script runs the full reid pipepline.
 '''
 
 import tempfile
+from track_writers import TrackWriter, TRACK_FORMAT_CHOICES
 import galleries
 from detectors import FasterRCNN
 from attribute_extractors import MgnWrapper
+from devices import DEVICE_CHOICES
+from crop_stores import get_crop_store, CROP_STORE_CHOICES
+from online_features import OnlineFeatureExtractor
+from detection_scheduler import DetectionScheduler, optical_flow_boxes
+from detection_scheduler import MotionGate, MOTION_GATE_CHOICES
+from gallery_index import GalleryIndex, GALLERY_DTYPE_CHOICES
+from matching import as_matrix, ExactSearch, get_search_backend, evaluate_search
+from matching import DISTANCE_CHOICES, SEARCH_CHOICES, AGGREGATION_CHOICES
+from matching import track_queries, track_candidates, vote
+from identity_assignment import assign_identities, transition_matrix
 import loaders
 from PIL import Image
-from utils import crop_image
+from utils import crop_image, crop_quality, bounding_region, intersect_regions
+from track_sinks import ListSink, FileSink, TeeSink
 import argparse
 import functools
 import os
@@ -17,7 +29,7 @@ import numpy as np
 import cv2
 from third_party.sort import Sort
 from bbox_trigger import BboxTrigger
-from scipy.stats import mode
+from scipy.sparse import vstack
 from tqdm import tqdm
 from constants import *
 
@@ -33,12 +45,32 @@ def init_args():
                         "--distance",
                         default='dot_product',
                         help="Distance metric used for retrieval",
-                        choices=['dot_product'])
+                        choices=DISTANCE_CHOICES)
+    parser.add_argument("--search",
+                        default='exact',
+                        help="Gallery search backend",
+                        choices=SEARCH_CHOICES)
+    parser.add_argument("--ivf_nlist",
+                        default=IVF_NLIST,
+                        help="Number of lists of the ivf search backend",
+                        type=int)
+    parser.add_argument("--ivf_nprobe",
+                        default=IVF_NPROBE,
+                        help="Number of lists scanned per query by the ivf search backend",
+                        type=int)
+    parser.add_argument(
+        "--report_search",
+        action='store_true',
+        help="Report recall and latency of the search backend against exact search")
     parser.add_argument("-l",
                         "--loader",
                         default='videos',
                         help="Type of data loading",
-                        choices=['videos', 'frames'])
+                        choices=loaders.LOADER_CHOICES)
+    parser.add_argument("--prefetch_depth",
+                        default=PREFETCH_QUEUE_DEPTH,
+                        help="Frames decoded ahead per camera by prefetch loaders",
+                        type=int)
     parser.add_argument("-g",
                         "--gallery",
                         default='trigger',
@@ -72,6 +104,137 @@ def init_args():
         default="tmpgal/",
         help="Path to gallery",
     )
+    parser.add_argument(
+        "--gallery_index",
+        default=None,
+        help="Directory of a persistent gallery index, reused and appended to across runs")
+    parser.add_argument("--gallery_dtype",
+                        default='float32',
+                        help="dtype of the embeddings in a new gallery index",
+                        choices=GALLERY_DTYPE_CHOICES)
+    parser.add_argument("--device",
+                        default='auto',
+                        help="Device to run the models on",
+                        choices=DEVICE_CHOICES)
+    parser.add_argument("--num_threads",
+                        default=None,
+                        help="Number of threads used for CPU inference",
+                        type=int)
+    parser.add_argument(
+        "--detect_batch",
+        default=1,
+        help="Number of consecutive samples detected in one call for all cameras",
+        type=int)
+    parser.add_argument("--crop_store",
+                        default='memory',
+                        help="Where the track reference crops are kept",
+                        choices=CROP_STORE_CHOICES)
+    parser.add_argument(
+        "--crop_store_max_mb",
+        default=CROP_STORE_MAX_BYTES // 1024**2,
+        help="Memory budget of the memory crop store in MiB",
+        type=int)
+    parser.add_argument(
+        "--crop_store_path",
+        default=None,
+        help="File backing the mmap crop store, or the file the memory crop store spills to",
+    )
+    parser.add_argument(
+        "--max_track_crops",
+        default=MAX_TRACK_CROPS,
+        help="Reference crops kept per track, the best ones are kept. 0 keeps them all",
+        type=int)
+    parser.add_argument(
+        "--track_summaries",
+        default=None,
+        help="Directory the summaries of finished tracks are written to, one JSON lines file per camera")
+    parser.add_argument(
+        "--appearance_association",
+        action='store_true',
+        help="Associate detections to tracks by MGN appearance as well as motion (DeepSORT style)")
+    parser.add_argument(
+        "--online_features",
+        action='store_true',
+        help="Featurize track crops on a background thread during tracking")
+    parser.add_argument("--score_threshold",
+                        default=DETECTION_SCORE_THRESHOLD,
+                        help="Minimum confidence score of a detection",
+                        type=float)
+    parser.add_argument("--trigger_stride",
+                        default=TRIGGER_CHECK_STRIDE,
+                        help="Frames between two door state checks of a trigger",
+                        type=int)
+    parser.add_argument(
+        "--trigger_crop_detection",
+        action='store_true',
+        help="Detect people on the trigger region crop instead of reusing the frame detections")
+    parser.add_argument(
+        "--adaptive_detection",
+        action='store_true',
+        help="Only detect on keyframes and coast the tracks in between, keyframes get closer when tracks are uncertain, people enter or the scene moves. Needs a detect_batch of 1")
+    parser.add_argument("--max_detect_interval",
+                        default=SCHEDULER_MAX_INTERVAL,
+                        help="Most samples between two keyframes of adaptive detection",
+                        type=int)
+    parser.add_argument(
+        "--optical_flow",
+        action='store_true',
+        help="Refine the tracks of the samples skipped by adaptive detection with optical flow")
+    parser.add_argument(
+        "--detect_max_side",
+        default=None,
+        help="Longest side frames are downscaled to before detection, boxes are scaled back",
+        type=int)
+    parser.add_argument(
+        "--detection_roi",
+        action='store_true',
+        help="Only detect people in the region of each camera given in DETECTION_ROIS, or around its triggers")
+    parser.add_argument(
+        "--motion_gate",
+        default='none',
+        help="Skip detection on samples where nothing moved, by frame differencing or MOG2 background subtraction",
+        choices=MOTION_GATE_CHOICES)
+    parser.add_argument(
+        "--roi_detection",
+        action='store_true',
+        help="Only detect people in the region the motion gate saw moving and around the tracks")
+    parser.add_argument(
+        "--aggregation",
+        default='mean',
+        help="How the crops of a track are matched to the gallery: pooled into one quality weighted mean or top-k mean descriptor, or matched one by one and voted",
+        choices=AGGREGATION_CHOICES)
+    parser.add_argument("--pool_top_k",
+                        default=TRACK_POOL_TOP_K,
+                        help="Number of best crops pooled by the topk aggregation",
+                        type=int)
+    parser.add_argument(
+        "--unknown_threshold",
+        default=None,
+        help="Smallest match confidence of a track, tracks below it are written with id {}".format(REID_UNKNOWN_ID),
+        type=float)
+    parser.add_argument(
+        "--global_assignment",
+        action='store_true',
+        help="Assign identities to the tracks of all cameras at once, so one person is never in two places at the same time")
+    parser.add_argument("--reid_candidates",
+                        default=REID_CANDIDATES,
+                        help="Candidate identities searched per query by the global assignment",
+                        type=int)
+    parser.add_argument("--assignment_window",
+                        default=REID_ASSIGNMENT_WINDOW,
+                        help="Span in frames of the track starts solved together by the global assignment",
+                        type=int)
+    parser.add_argument("--transition_frames",
+                        default=REID_MIN_TRANSITION_FRAMES,
+                        help="Frames needed to walk between two cameras, pairs in CAMERA_TRANSITION_FRAMES override it",
+                        type=int)
+    parser.add_argument("--output_dir",
+                        default=".",
+                        help="Directory the re-identified tracks of each camera are written to")
+    parser.add_argument("--output_format",
+                        default='txt',
+                        help="Format of the track files",
+                        choices=TRACK_FORMAT_CHOICES)
     return parser.parse_args()
 
 
@@ -83,27 +246,6 @@ def read_img_and_compute_feat_vector(path, attribute_extractor):
     return None
 
 
-def load_gallery_feat_vectors(imgs_dir, attribute_extractor):
-    """
-    Gets all the feature vectors from the gallery
-
-    Parameters:
-    imgs_dir (str): path to gallery directory
-    attribute_extractor (MgnWrapper): attribute extractor object
-
-    Returns:
-    feat_vectos (list): list of feature vectors
-    """
-    if not os.path.exists(imgs_dir):
-        raise ValueError("path doesn't exist")
-    feat_vectors = list()
-    for name in sorted(os.listdir(imgs_dir)):
-        feat_vector = read_img_and_compute_feat_vector(
-            os.path.join(imgs_dir, name), attribute_extractor)
-        feat_vectors.append(feat_vector)
-    return feat_vectors
-
-
 def cosine_similarity(x, y):
     """Computes cosines similarity (dot product) between x and y """
     return np.dot(x, y) / (np.sqrt(np.dot(x, x)) * np.sqrt(np.dot(y, y)))
@@ -123,8 +265,42 @@ def write_gallery_imgs(imgs, path):
         cv2.imwrite(os.path.join(path, "{:5d}.jpg".format(i)), img)
 
 
-def run_mot_and_fill_gallery(video_loader, gallery, detector, sort_trackers,
-                             output_files):
+def detection_rois(vidnames, triggers):
+    """
+    Finds the region each camera's people are detected in
+
+    Parameters:
+    vidnames (list): camera names
+    triggers (list): BboxTrigger of the gallery
+
+    Returns:
+    dict: x1, y1, x2, y2 region of each camera, the one in DETECTION_ROIS or
+          the region holding its triggers. Cameras with neither are not in it
+    """
+    rois = dict()
+    for vidname in vidnames:
+        regions = [trig.region for trig in triggers if trig.camera_id == vidname]
+        if vidname in DETECTION_ROIS:
+            rois[vidname] = bounding_region([DETECTION_ROIS[vidname]])
+        elif len(regions) > 0:
+            rois[vidname] = bounding_region(regions)
+    return rois
+
+
+def run_mot_and_fill_gallery(video_loader,
+                             gallery,
+                             detector,
+                             sort_trackers,
+                             track_writers,
+                             crop_store,
+                             detect_batch=1,
+                             feature_queue=None,
+                             attribute_extractor=None,
+                             scheduler=None,
+                             optical_flow=False,
+                             motion_gates=None,
+                             roi_detection=False,
+                             camera_rois=None):
 
     """
     This method creates the SORT tracks and fills the gallery
@@ -134,140 +310,409 @@ def run_mot_and_fill_gallery(video_loader, gallery, detector, sort_trackers,
     gallery (TriggerGallery): Gallery object
     detector (FasterRCNN): Object detection object
     sort_trackers (Sort): sort trackers
-    output_files (Dict): one for each tracker
+    track_writers (Dict): TrackWriter of each camera
+    crop_store (CropStore): store keeping the track reference crops
+    detect_batch (int): number of consecutive samples whose frames from all cameras are detected in one call
+    feature_queue (OnlineFeatureExtractor): featurizes track crops during tracking, None to do it afterwards
+    attribute_extractor (MgnWrapper): embeds the detections for appearance association, None to associate by IOU only
+    scheduler (DetectionScheduler): picks the samples each camera is detected on, None to detect every sample. Needs a detect_batch of 1
+    optical_flow (bool): refine the tracks of skipped samples with optical flow
+    motion_gates (dict): MotionGate of each camera, samples where nothing moved update the trackers without detecting. None to detect them
+    roi_detection (bool): only detect people in the region that moved and around the tracks
+    camera_rois (dict): x1, y1, x2, y2 region people are detected in for some cameras
 
     Returns
     file with tracks
     """
-    # Iterate through frames of all cameras
-    for findex, frames in tqdm(video_loader):
-
-        # Send frames from each camera to gallery to decide if references need to be captured based off triggering
-        gallery.update(frames)
-
-        # Iterate through each camera
-        for vidname, frame in frames.items():
-            # Get bounding boxes of all people
-            boxes, scores = detector.get_bboxes(frame)
-
-            # Send people bounding boxes to tracker
-            # Get three things: normal Sort output (tracking bounding boxes it wants to send), corresponding track objects, and objects of new tracks
-            tracker = sort_trackers[vidname]
-            dets = np.column_stack((np.reshape(boxes, [-1, 4]), scores))
-            matched_tracks, matched_kb_trackers, new_kb_trackers = tracker.update(
-                dets)
-
-            # Find indexes of returned bounding boxes that meet ideal ratio
-            trkbboxes = np.array(matched_tracks)
-            widths = trkbboxes[:, 2] - trkbboxes[:, 0]
-            heights = trkbboxes[:, 3] - trkbboxes[:, 1]
-            aspectratio = heights / widths
-            readybools = np.isclose(aspectratio, 2, rtol=0.25)
-            indexes = np.arange(len(matched_tracks))[readybools]
-
-            # Iterate through returned bounding boxes
-            for ind, trk in enumerate(matched_tracks):
-                box = ((int(trk[0]), int(trk[1])), (int(trk[2]), int(trk[3])))
-
-                # If bounding box meets ideal ratio, save image of person as reference
-                if ind in indexes:
-                    cropimg = crop_image(frame, box)
-                    if cropimg.size > 5:
-                        fd, temp_file_name = tempfile.mkstemp(suffix='.jpg')
-                        cv2.imwrite(temp_file_name, cropimg)
-                        os.close(fd)
-                        matched_kb_trackers[ind].save_img(temp_file_name)
-
-                # Write bounding box, frame number, and trackid to file
-                output_files[vidname].write("%d,%d,%.2f,%.2f,%.2f,%.2f\n" %
-                                            (findex, trk[4], box[0][0],
-                                             box[0][1], box[1][0], box[1][1]))
-
-            # Iterate through new tracks and add their current bounding box to list of track references
-            for trk in new_kb_trackers:
-                d = trk.get_state()[0]
-                box = ((int(d[0]), int(d[1])), (int(d[2]), int(d[3])))
-                cropimg = crop_image(frame, box)
-                if cropimg.size > 5:
-                    fd, temp_file_name = tempfile.mkstemp(suffix='.jpg')
-                    cv2.imwrite(temp_file_name, cropimg)
-                    os.close(fd)
-                    trk.save_img(temp_file_name)
-
-
-def run_reid_model_and_assign_ids(sort_trackers, attribute_extractor,
-                                  output_files, gallery_feature_vectors):
+    if scheduler is not None and detect_batch > 1:
+        # The scheduler decides each sample after the trackers were updated
+        # on the previous one
+        raise ValueError("adaptive detection needs a detect_batch of 1")
+    # Previous sample of each camera, for optical flow
+    previous_frames = dict()
+    # Iterate through frames of all cameras, detect_batch samples at a time
+    for samples in loaders.batch_samples(tqdm(video_loader), detect_batch):
+
+        # Get bounding boxes of all people in every camera and sample at once.
+        # Static samples are not detected and the scheduler skips the samples
+        # whose tracks can be coasted
+        frames_to_detect = dict()
+        rois = dict()
+        static = list()
+        for findex, frames in samples:
+            for vidname, frame in frames.items():
+                key = (findex, vidname)
+                roi = None if camera_rois is None else camera_rois.get(vidname)
+                if motion_gates is not None:
+                    moving = motion_gates[vidname].update(
+                        frame, sort_trackers[vidname].bboxes())
+                    if moving is not None and roi_detection:
+                        moving = moving if roi is None else intersect_regions(
+                            roi, moving)
+                        roi = moving
+                    if moving is None:
+                        static.append(key)
+                        continue
+                if roi is not None:
+                    rois[key] = roi
+                if scheduler is None or scheduler.should_detect(
+                        vidname, frame, sort_trackers[vidname]):
+                    frames_to_detect[key] = frame
+        detections = detector.get_bboxes_batch(frames_to_detect, rois)
+        embeddings = dict()
+        if attribute_extractor is not None:
+            embeddings = embed_detections(frames_to_detect, detections,
+                                          attribute_extractor)
+        # Trackers still get an update, without detections, on static samples
+        for key in static:
+            detections[key] = (np.empty((0, 4), dtype=np.float32),
+                               np.empty(0, dtype=np.float32))
+
+        for findex, frames in samples:
+            # Send frames from each camera to gallery to decide if references need to be captured based off triggering,
+            # the triggers take the people from the detections or detect on their region on skipped samples
+            fired = gallery.update(
+                frames, findex, {
+                    vidname: detections[(findex, vidname)][0]
+                    for vidname in frames if (findex, vidname) in detections
+                })
+
+            # Iterate through each camera
+            for vidname, frame in frames.items():
+                if (findex, vidname) in detections:
+                    boxes, scores = detections[(findex, vidname)]
+                    update_tracker(findex, frame, boxes, scores,
+                                   sort_trackers[vidname],
+                                   track_writers[vidname], crop_store,
+                                   feature_queue,
+                                   embeddings.get((findex, vidname)))
+                    if scheduler is not None:
+                        scheduler.observe(vidname, sort_trackers[vidname])
+                else:
+                    coast_tracker(
+                        findex, frame,
+                        previous_frames.get(vidname) if optical_flow else None,
+                        sort_trackers[vidname], track_writers[vidname])
+                if optical_flow:
+                    previous_frames[vidname] = frame
+            if scheduler is not None:
+                for vidname in fired:
+                    scheduler.alert(vidname)
+
+
+def embed_detections(frames, detections, attribute_extractor):
+    """
+    Computes the appearance embeddings of the detections of many frames at once
 
+    Parameters:
+    frames (dict): frames keyed by (frame index, camera)
+    detections (dict): (boxes, scores) of each frame, same keys as frames
+    attribute_extractor (MgnWrapper): attribute extractor
+
+    Returns:
+    dict: (N, 2048) embeddings of the boxes of each frame, zero for boxes too small to crop
     """
-    Using attribute extractor and sort tracks to assign ID's to people in the tracks
+    embeddings = dict()
+    crops = list()
+    rows = list()
+    for key, (boxes, _) in detections.items():
+        embeddings[key] = np.zeros((len(boxes), 2048), dtype=np.float32)
+        for i, box in enumerate(boxes):
+            cropimg = crop_image(frames[key], ((max(box[0], 0), max(box[1], 0)),
+                                               (box[2], box[3])))
+            if cropimg.size > 5:
+                crops.append(cropimg)
+                rows.append((key, i))
+
+    # Embed the detections of all frames in batches
+    feats = attribute_extractor.compute_feat_vectors(crops)
+    for (key, i), feat in zip(rows, feats):
+        embeddings[key][i] = feat
+    return embeddings
+
+
+def update_tracker(findex,
+                   frame,
+                   boxes,
+                   scores,
+                   tracker,
+                   track_writer,
+                   crop_store,
+                   feature_queue=None,
+                   embeddings=None):
+    """
+    Sends one camera's detections to its tracker and saves track references
 
     Parameters:
-    sort_trackers (Sort): SORT trackers object
-    attribute_extractor (MgnWrapper): attribute extractor object
-    output_files (Dict): one for each tracker
-    gallery_feature_vectors (list): a list of feature vectors from load_gallery_feat_vectors()
-    
+    findex (int): frame index
+    frame (ndarray): frame the detections were found in
+    boxes (ndarray): (N, 4) bounding boxes of people
+    scores (ndarray): (N,) confidence score of each bounding box
+    tracker (Sort): the camera's tracker
+    track_writer (TrackWriter): collects the camera's tracks
+    crop_store (CropStore): store keeping the track reference crops
+    feature_queue (OnlineFeatureExtractor): None when features are computed after tracking
+    embeddings (ndarray): (N, 2048) embeddings of the boxes, None to associate by IOU only
+
     Returns:
-    A txt file with the format
-    frameID - ID - bounding box coordinates(4 values)
+    matched_tracks (ndarray): Sort output, one x1, y1, x2, y2, id row per track
     """
-    # Iterate through trackers for each camera
-    for vidname, sorto in sort_trackers.items():
-        tracks = sorto.trackers + sorto.rejects
-        convertdict = dict()
+    # Send people bounding boxes to tracker
+    # Get three things: normal Sort output (tracking bounding boxes it wants to send), corresponding track objects, and objects of new tracks
+    dets = np.column_stack((boxes, scores))
+    matched_tracks, matched_kb_trackers, new_kb_trackers = tracker.update(
+        dets, findex, embeddings)
+
+    # Find indexes of returned bounding boxes that meet ideal ratio
+    trkbboxes = np.array(matched_tracks)
+    widths = trkbboxes[:, 2] - trkbboxes[:, 0]
+    heights = trkbboxes[:, 3] - trkbboxes[:, 1]
+    aspectratio = heights / widths
+    readybools = np.isclose(aspectratio, 2, rtol=0.25)
+    indexes = np.arange(len(matched_tracks))[readybools]
+
+    # Save images of people whose bounding box meets ideal ratio as references
+    for ind in indexes:
+        trk = matched_tracks[ind]
+        box = ((int(trk[0]), int(trk[1])), (int(trk[2]), int(trk[3])))
+        cropimg = crop_image(frame, box)
+        if cropimg.size > 5:
+            kbtrk = matched_kb_trackers[ind]
+            save_track_crop(kbtrk, cropimg, crop_store, feature_queue,
+                            crop_quality(box, kbtrk.score))
+
+    # Keep bounding boxes, frame number, and trackids
+    track_writer.append(findex, matched_tracks)
+
+    # Iterate through new tracks and add their current bounding box to list of track references
+    for trk in new_kb_trackers:
+        d = trk.get_state()[0]
+        box = ((int(d[0]), int(d[1])), (int(d[2]), int(d[3])))
+        cropimg = crop_image(frame, box)
+        if cropimg.size > 5:
+            save_track_crop(trk, cropimg, crop_store, feature_queue,
+                            crop_quality(box, trk.score))
+
+    return matched_tracks
+
+
+def coast_tracker(findex, frame, previous_frame, tracker, track_writer):
+    """
+    Advances one camera's tracker on a sample the detector skipped
 
-        # Iterate through tracks within each tracker
-        for trk in tqdm(tracks):
-            reidimgs = trk.imgfiles
+    Parameters:
+    findex (int): frame index
+    frame (ndarray): the camera's frame
+    previous_frame (ndarray): the camera's previous sample, tracks are moved by the optical flow between the two. None to only use their Kalman prediction
+    tracker (Sort): the camera's tracker
+    track_writer (TrackWriter): collects the camera's tracks
 
-            # Iterate through every reference image for this track
-            for img in reidimgs:
-                # Get feature vector of image
-                uniqvect = read_img_and_compute_feat_vector(
-                    img, attribute_extractor)
+    Returns:
+    matched_tracks (ndarray): Sort output, one x1, y1, x2, y2, id row per track
+    """
+    boxes = None
+    if previous_frame is not None:
+        boxes = optical_flow_boxes(previous_frame, frame, tracker.bboxes())
+    matched_tracks, _ = tracker.coast(boxes)
+    track_writer.append(findex, matched_tracks)
+    return matched_tracks
+
+
+def save_track_crop(trk,
+                    cropimg,
+                    crop_store,
+                    feature_queue=None,
+                    quality=0.0):
+    """
+    Saves a reference crop of a track and queues it for online featurizing
 
-                if uniqvect is not None:
-                    # Find out what is the most similar gallery image
-                    # TODO: (nhendy) figure out if this is needs to be normalized
-                    dists = [
-                        np.average(np.dot(uniqvect, np.transpose(feat_vector)))
-                        for feat_vector in gallery_feature_vectors
-                    ]
-                    index = dists.index(max(dists))
-                    trk.reid.append(index)
+    The track only keeps its best crops, the crop it drops is removed from
+    the crop store.
 
-            # Creating a dictionary mapping the trackIDs to the Re-IDs based on most frequent Re-ID of a track
-            if len(trk.reid) > 0:
-                convertdict[trk.id] = mode(trk.reid)[0][0]
+    Parameters:
+    trk (KalmanBoxTracker): track the crop belongs to
+    cropimg (ndarray): crop of the person
+    crop_store (CropStore): store keeping the track reference crops
+    feature_queue (OnlineFeatureExtractor): None when features are computed after tracking
+    quality (float): quality of the crop, see utils.crop_quality
+    """
+    key = crop_store.put(cropimg)
+    dropped = trk.appearance.save_crop(key, quality)
+    if dropped is not None:
+        crop_store.discard(dropped)
+    if feature_queue is not None and dropped != key:
+        feature_queue.submit(trk.appearance, cropimg, key)
 
-        # Vectorize mapping from track id to reid id.
-        track_id_to_reid_id = np.vectorize(
-            lambda value: convertdict.get(value, value))
 
-        # Use vectorized mapping function to change trackIDs to Re-IDs in output file
-        output_files[vidname][:, 1] = track_id_to_reid_id(
-            output_files[vidname][:, 1])
+def track_feat_vectors(trk, attribute_extractor, crop_store):
+    """
+    Returns the (N, 2048) embeddings of a track's reference crops and the
+    quality of each of those crops
 
-        # Save
-        np.savetxt(vidname + ".txt", output_files[vidname])
+    Embeddings computed online are reused, otherwise the crops are featurized.
+    """
+    features, qualities = trk.appearance.scored_features()
+    if len(features) > 0:
+        return np.stack(features), qualities
+    crops = list()
+    qualities = list()
+    for key, quality in zip(trk.appearance.crop_keys,
+                            trk.appearance.crop_qualities):
+        crop = crop_store.get(key)
+        if crop is not None:
+            crops.append(crop)
+            qualities.append(quality)
+    return attribute_extractor.compute_feat_vectors(crops), qualities
+
+
+def run_reid_model_and_assign_ids(camera_tracks,
+                                  attribute_extractor,
+                                  track_writers,
+                                  gallery_feature_vectors,
+                                  crop_store,
+                                  distance='dot_product',
+                                  search=None,
+                                  report_search=False,
+                                  output_dir=".",
+                                  output_format='txt',
+                                  aggregation='mean',
+                                  pool_top_k=TRACK_POOL_TOP_K,
+                                  unknown_threshold=None,
+                                  global_assignment=False,
+                                  reid_candidates=REID_CANDIDATES,
+                                  assignment_window=REID_ASSIGNMENT_WINDOW,
+                                  transition_frames=REID_MIN_TRANSITION_FRAMES):
 
+    """
+    Using attribute extractor and sort tracks to assign ID's to people in the tracks
 
-def convert_files_to_numpy(temp_dir, output_files):
-    """converts txt files to numpy arrays """
-    for video_name, file_handle in output_files.items():
-        file_handle.close()
-        output_files[video_name] = np.loadtxt(os.path.join(
-            temp_dir, "{}.txt".format(video_name)),
-                                              delimiter=',')
+    Parameters:
+    camera_tracks (Dict): TrackSummary list of each camera
+    attribute_extractor (MgnWrapper): attribute extractor object
+    track_writers (Dict): TrackWriter of each camera
+    gallery_feature_vectors (ndarray): (G, 2048) feature vectors of the gallery
+    crop_store (CropStore): store keeping the track reference crops
+    distance (str): metric used to compare crops to the gallery, see matching.DISTANCE_CHOICES
+    search (ExactSearch or IVFSearch): gallery search backend, None for exact search
+    report_search (bool): report recall and latency of search against exact search
+    output_dir (str): directory the track files are written to
+    output_format (str): 'txt' or 'npy'
+    aggregation (str): 'mean' or 'topk' to match one pooled descriptor per
+                       track, 'vote' to match every crop and vote
+    pool_top_k (int): number of best crops pooled by 'topk'
+    unknown_threshold (float): smallest match confidence, tracks below it get
+                               REID_UNKNOWN_ID. None keeps every match
+    global_assignment (bool): solve the tracks of all cameras together so
+                              tracks that can't be the same person get
+                              different identities
+    reid_candidates (int): candidate identities searched per query by the
+                           global assignment
+    assignment_window (int): span in frames of the track starts solved together
+    transition_frames (int): frames needed to walk between two cameras
+    
+    Returns:
+    A txt or npy file per camera with the format
+    frameID - ID - bounding box coordinates(4 values)
+    """
+    # Hold the gallery as one contiguous (G, D) matrix
+    gallery_matrix = as_matrix(gallery_feature_vectors)
+    if search is None:
+        search = ExactSearch(distance)
+    search.build(gallery_matrix)
+    exact = None
+    if report_search:
+        exact = ExactSearch(distance).build(gallery_matrix)
+
+    # Match the tracks of each camera to the gallery
+    matches = dict()
+    for vidname, tracks in camera_tracks.items():
+        # Get feature vectors and qualities of every reference image of every track
+        track_crops = [
+            track_feat_vectors(trk, attribute_extractor, crop_store)
+            for trk in tqdm(tracks)
+        ]
+        if len(gallery_matrix) == 0 or len(tracks) == 0:
+            continue
+
+        track_feats, track_qualities = zip(*track_crops)
+        # One pooled query per track, or one query per crop when voting
+        queries, owners = track_queries(track_feats, track_qualities,
+                                        aggregation, pool_top_k,
+                                        gallery_matrix.shape[1])
+        indexes, scores = search.search(
+            queries, reid_candidates if global_assignment else 1)
+        if exact is not None:
+            stats = evaluate_search(search, exact, queries)
+            tqdm.write(
+                "{}: search recall {:.3f}, {:.3f} ms/query ({:.3f} ms exact)"
+                .format(vidname, stats["recall"], stats["latency_ms"],
+                        stats["exact_latency_ms"]))
+        matches[vidname] = (track_feats, indexes, scores, owners)
+
+    # Re-ID and confidence of the tracks of each camera
+    assignments = dict()
+    if global_assignment and len(matches) > 0:
+        cameras = list(matches.keys())
+        candidates = vstack([
+            track_candidates(indexes, scores, owners,
+                             (len(camera_tracks[vidname]), len(gallery_matrix)),
+                             unknown_threshold)
+            for vidname, (_, indexes, scores, owners) in matches.items()
+        ]).tocsr()
+        tracks = [trk for vidname in cameras for trk in camera_tracks[vidname]]
+        reids, confidences = assign_identities(
+            candidates,
+            np.repeat(np.arange(len(cameras)),
+                      [len(camera_tracks[vidname]) for vidname in cameras]),
+            [trk.first_frame for trk in tracks],
+            [trk.last_frame for trk in tracks],
+            transition_matrix(cameras, transition_frames,
+                              CAMERA_TRANSITION_FRAMES), assignment_window)
+        offsets = np.cumsum([len(camera_tracks[vidname])
+                             for vidname in cameras])[:-1]
+        for vidname, camera_reids, camera_confidences in zip(
+                cameras, np.split(reids, offsets),
+                np.split(confidences, offsets)):
+            assignments[vidname] = (camera_reids, camera_confidences)
+    else:
+        for vidname, (_, indexes, scores, owners) in matches.items():
+            assignments[vidname] = vote(indexes[:, 0], scores[:, 0], owners,
+                                        len(camera_tracks[vidname]))
+
+    for vidname, tracks in camera_tracks.items():
+        convertdict = dict()
+        if vidname in matches:
+            track_feats = matches[vidname][0]
+            reids, confidences = assignments[vidname]
+            # Creating a dictionary mapping the trackIDs to the Re-IDs, tracks
+            # without crops keep their trackID
+            for trk, feats, reid, confidence in zip(tracks, track_feats, reids,
+                                                    confidences):
+                if len(feats) == 0:
+                    continue
+                if unknown_threshold is not None and confidence < unknown_threshold:
+                    reid = REID_UNKNOWN_ID
+                convertdict[trk.id] = reid
+
+        # Change trackIDs to Re-IDs and save
+        track_writers[vidname].write(
+            os.path.join(output_dir, "{}.{}".format(vidname, output_format)),
+            output_format, convertdict)
 
 
 def main():
     args = init_args()
 
-    detector = FasterRCNN()
-    attribute_extractor = MgnWrapper(args.weights_path)
-    dataloader = loaders.get_loader(args.video_path, args.loader,
-                                    args.interval)
+    detector = FasterRCNN(args.device,
+                          args.num_threads,
+                          score_threshold=args.score_threshold,
+                          max_side=args.detect_max_side)
+    attribute_extractor = MgnWrapper(args.weights_path, args.device,
+                                     args.num_threads)
+    dataloader = loaders.get_loader(args.video_path,
+                                    args.loader,
+                                    args.interval,
+                                    queue_depth=args.prefetch_depth)
 
     ref_img = cv2.imread(args.ref_image_path)
     # TODO: (nhendy) do this mapping in a config file
@@ -281,6 +726,8 @@ def main():
             CHECK_OPEN_COORDS_TWO,
             TRIGGER_ROI_COORDS_TWO,
             detector,
+            check_stride=args.trigger_stride,
+            crop_detection=args.trigger_crop_detection,
         ),
         BboxTrigger(
             # TODO: (nhendy) weird hardcoded name
@@ -291,41 +738,132 @@ def main():
             CHECK_OPEN_COORDS_ONE,
             TRIGGER_ROI_COORDS_ONE,
             detector,
+            check_stride=args.trigger_stride,
+            crop_detection=args.trigger_crop_detection,
         )
     ]
 
-    gallery = galleries.TriggerGallery(attribute_extractor, trigger_causes)
+    camera_rois = None
+    if args.detection_roi:
+        camera_rois = detection_rois(dataloader.get_vid_names(),
+                                     trigger_causes)
 
-    temp_dir = tempfile.mkdtemp()
+    index = None
+    if args.gallery_index:
+        index = GalleryIndex(args.gallery_index, dtype=args.gallery_dtype)
+    gallery = galleries.TriggerGallery(attribute_extractor,
+                                       trigger_causes,
+                                       index=index)
 
-    # create trackers for each video/camera
-    sort_trackers = {
-        vidnames: Sort()
+    temp_dir = tempfile.mkdtemp()
+    feature_queue = OnlineFeatureExtractor(
+        attribute_extractor) if args.online_features else None
+    search = get_search_backend(args.search,
+                                args.distance,
+                                nlist=args.ivf_nlist,
+                                nprobe=args.ivf_nprobe)
+    crop_store = get_crop_store(args.crop_store,
+                                max_bytes=args.crop_store_max_mb * 1024**2,
+                                path=args.crop_store_path)
+
+    # create trackers for each video/camera, finished tracks are handed to
+    # the camera's sink
+    track_sinks = {
+        vidnames: ListSink()
         for vidnames in dataloader.get_vid_names()
     }
-    output_files = {
-        vidnames: open(os.path.join(temp_dir, "{}.txt".format(vidnames)), "w")
+    if args.track_summaries:
+        os.makedirs(args.track_summaries, exist_ok=True)
+    sort_trackers = dict()
+    for vidnames, sink in track_sinks.items():
+        on_finish = sink
+        if args.track_summaries:
+            on_finish = TeeSink(
+                sink,
+                FileSink(
+                    os.path.join(args.track_summaries,
+                                 "{}.jsonl".format(vidnames))))
+        sort_trackers[vidnames] = Sort(max_crops=args.max_track_crops or None,
+                                       on_finish=on_finish)
+    # Full chunks of track rows are spilled to temp_dir
+    track_writers = {
+        vidnames: TrackWriter(spill_dir=temp_dir)
         for vidnames in dataloader.get_vid_names()
     }
 
+    scheduler = None
+    if args.adaptive_detection:
+        scheduler = DetectionScheduler(args.max_detect_interval)
+    motion_gates = None
+    if args.motion_gate != 'none':
+        motion_gates = {
+            vidnames: MotionGate(args.motion_gate)
+            for vidnames in dataloader.get_vid_names()
+        }
+
     # Run detector, Sort and fill up gallery
-    run_mot_and_fill_gallery(dataloader, gallery, detector, sort_trackers,
-                             output_files)
+    run_mot_and_fill_gallery(dataloader,
+                             gallery,
+                             detector,
+                             sort_trackers,
+                             track_writers,
+                             crop_store,
+                             detect_batch=args.detect_batch,
+                             feature_queue=feature_queue,
+                             attribute_extractor=attribute_extractor
+                             if args.appearance_association else None,
+                             scheduler=scheduler,
+                             optical_flow=args.optical_flow,
+                             motion_gates=motion_gates,
+                             roi_detection=args.roi_detection,
+                             camera_rois=camera_rois)
+    if motion_gates is not None:
+        for vidname, gate in motion_gates.items():
+            tqdm.write("{}: {} of {} samples static, skipped {:.1%}".format(
+                vidname, gate.skipped, gate.checked, gate.skip_ratio()))
+    if scheduler is not None:
+        for vidname in sort_trackers:
+            tqdm.write("{}: detected {} samples, skipped {:.1%}".format(
+                vidname, scheduler.detected.get(vidname, 0),
+                scheduler.skip_ratio(vidname)))
+    for sorto in sort_trackers.values():
+        sorto.finish_all()
+        sorto.on_finish.close()
+    if feature_queue is not None:
+        feature_queue.close()
 
     # Save images from gallery captured throughout video
     write_gallery_imgs(gallery.people, args.gallery_path)
 
-    # Load up the gallery feature vectors
-    gallery_feature_vectors = load_gallery_feat_vectors(
-        args.gallery_path, attribute_extractor)
+    # Gallery feature vectors were computed as people were added, the index
+    # also holds the people of previous runs
+    if index is not None:
+        gallery_feature_vectors = index.embeddings
+    else:
+        gallery_feature_vectors = gallery.feats
 
-    # TODO: (nhendy) this is needed because downstream functions
-    # assume the dict contain numpy arrays not files. Remove later
-    convert_files_to_numpy(temp_dir, output_files)
+    camera_tracks = {
+        vidnames: sink.summaries
+        for vidnames, sink in track_sinks.items()
+    }
 
     # Run reid model and map track ids to reid ids
-    run_reid_model_and_assign_ids(sort_trackers, attribute_extractor,
-                                  output_files, gallery_feature_vectors)
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_reid_model_and_assign_ids(camera_tracks, attribute_extractor,
+                                  track_writers, gallery_feature_vectors,
+                                  crop_store, args.distance,
+                                  search, args.report_search,
+                                  args.output_dir, args.output_format,
+                                  args.aggregation, args.pool_top_k,
+                                  args.unknown_threshold,
+                                  args.global_assignment, args.reid_candidates,
+                                  args.assignment_window,
+                                  args.transition_frames)
+    for track_writer in track_writers.values():
+        track_writer.close()
+    crop_store.close()
+    if index is not None:
+        index.close()
 
 
 if __name__ == "__main__":
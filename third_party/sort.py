@@ -18,37 +18,50 @@
 """
 from __future__ import print_function
 
-from numba import jit
+import collections
+import heapq
+import itertools
 import os.path
+import threading
 import numpy as np
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from skimage import io
-from sklearn.utils.linear_assignment_ import linear_assignment
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import glob
 import time
 import argparse
-from filterpy.kalman import KalmanFilter
 import cv2
 import sys
 
 
-@jit
-def iou(bb_test, bb_gt):
+# 0.95 quantile of the chi-square distribution with 4 degrees of freedom, used
+# to gate the Mahalanobis distance of a measurement to a track
+CHI2INV95_4DOF = 9.4877
+
+
+def iou_batch(bb_test, bb_gt):
     """
-  Computes IUO between two bboxes in the form [x1,y1,x2,y2]
+  Computes IUO between every pair of bboxes of two (N, 4+) and (M, 4+) arrays
+    in the form [x1,y1,x2,y2], returns a (N, M) matrix
   """
-    xx1 = np.maximum(bb_test[0], bb_gt[0])
-    yy1 = np.maximum(bb_test[1], bb_gt[1])
-    xx2 = np.minimum(bb_test[2], bb_gt[2])
-    yy2 = np.minimum(bb_test[3], bb_gt[3])
+    bb_test = np.asarray(bb_test, dtype=np.float64)[:, None, :4]
+    bb_gt = np.asarray(bb_gt, dtype=np.float64)[None, :, :4]
+    xx1 = np.maximum(bb_test[..., 0], bb_gt[..., 0])
+    yy1 = np.maximum(bb_test[..., 1], bb_gt[..., 1])
+    xx2 = np.minimum(bb_test[..., 2], bb_gt[..., 2])
+    yy2 = np.minimum(bb_test[..., 3], bb_gt[..., 3])
     w = np.maximum(0.0, xx2 - xx1)
     h = np.maximum(0.0, yy2 - yy1)
     wh = w * h
-    o = wh / ((bb_test[2] - bb_test[0]) * (bb_test[3] - bb_test[1]) +
-              (bb_gt[2] - bb_gt[0]) * (bb_gt[3] - bb_gt[1]) - wh)
+    o = wh / ((bb_test[..., 2] - bb_test[..., 0]) *
+              (bb_test[..., 3] - bb_test[..., 1]) +
+              (bb_gt[..., 2] - bb_gt[..., 0]) *
+              (bb_gt[..., 3] - bb_gt[..., 1]) - wh)
     return o
 
 
@@ -67,6 +80,31 @@ def convert_bbox_to_z(bbox):
     return np.array([x, y, s, r]).reshape((4, 1))
 
 
+def convert_bboxes_to_z(bboxes):
+    """
+  Takes a (N, 4+) array of bounding boxes in the form [x1,y1,x2,y2] and returns
+    the (N, 4) array of their [x,y,s,r] form
+  """
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    w = bboxes[:, 2] - bboxes[:, 0]
+    h = bboxes[:, 3] - bboxes[:, 1]
+    return np.stack(
+        (bboxes[:, 0] + w / 2.0, bboxes[:, 1] + h / 2.0, w * h, w / h),
+        axis=1)
+
+
+def convert_xs_to_bboxes(xs):
+    """
+  Takes a (N, 4+) array of states in the centre form [x,y,s,r] and returns the
+    (N, 4) array of their [x1,y1,x2,y2] form
+  """
+    w = np.sqrt(xs[:, 2] * xs[:, 3])
+    h = xs[:, 2] / w
+    return np.stack((xs[:, 0] - w / 2.0, xs[:, 1] - h / 2.0,
+                     xs[:, 0] + w / 2.0, xs[:, 1] + h / 2.0),
+                    axis=1)
+
+
 def convert_x_to_bbox(x, score=None):
     """
   Takes a bounding box in the centre form [x,y,s,r] and returns it in the form
@@ -85,88 +123,403 @@ def convert_x_to_bbox(x, score=None):
         ]).reshape((1, 5))
 
 
+class KalmanBoxStore(object):
+    """
+  Holds the constant velocity Kalman filters of many tracks as stacked arrays so
+    they are predicted and updated together.
+
+    Each filter lives in a slot: row slot of the (capacity, 7) states x and of the
+    (capacity, 7, 7) covariances P. Slots of finished tracks are reused.
+  """
+
+    # define constant velocity model
+    F = np.array([
+        [1, 0, 0, 0, 1, 0, 0],
+        [0, 1, 0, 0, 0, 1, 0],
+        [0, 0, 1, 0, 0, 0, 1],
+        [0, 0, 0, 1, 0, 0, 0],
+        [0, 0, 0, 0, 1, 0, 0],
+        [0, 0, 0, 0, 0, 1, 0],
+        [0, 0, 0, 0, 0, 0, 1],
+    ], dtype=np.float64)
+    # the measurement [x,y,s,r] is the first 4 entries of the state
+    R = np.diag([1.0, 1.0, 10.0, 10.0])
+    # give high uncertainty to the unobservable initial velocities
+    P0 = np.diag([10.0, 10.0, 10.0, 10.0, 10000.0, 10000.0, 10000.0])
+    Q = np.diag([1.0, 1.0, 1.0, 1.0, 0.01, 0.01, 0.0001])
+
+    def __init__(self, capacity=64):
+        capacity = max(capacity, 1)
+        self.x = np.zeros((capacity, 7))
+        self.P = np.zeros((capacity, 7, 7))
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def _grow(self):
+        capacity = len(self.x)
+        self.x = np.concatenate((self.x, np.zeros_like(self.x)))
+        self.P = np.concatenate((self.P, np.zeros_like(self.P)))
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, z):
+        """
+    Starts a filter at the [x,y,s,r] measurement z and returns its slot.
+    """
+        if len(self._free) == 0:
+            self._grow()
+        slot = self._free.pop()
+        self.x[slot] = 0.0
+        self.x[slot, :4] = np.ravel(z)[:4]
+        self.P[slot] = self.P0
+        return slot
+
+    def release(self, slot):
+        """
+    Frees the slot of a finished filter.
+    """
+        self._free.append(slot)
+
+    def predict(self, slots):
+        """
+    Advances the filters of slots and returns their (N, 4) predicted bounding boxes.
+    """
+        x = self.x[slots]
+        P = self.P[slots]
+        x[x[:, 6] + x[:, 2] <= 0, 6] = 0.0
+        x = np.dot(x, self.F.T)
+        P = np.matmul(np.matmul(self.F, P), self.F.T) + self.Q
+        self.x[slots] = x
+        self.P[slots] = P
+        return convert_xs_to_bboxes(x)
+
+    def update(self, slots, z):
+        """
+    Corrects the filters of slots with their (N, 4) [x,y,s,r] measurements z.
+    """
+        if len(slots) == 0:
+            return
+        x = self.x[slots]
+        P = self.P[slots]
+        y = z - x[:, :4]
+        S = P[:, :4, :4] + self.R
+        # K = P H' inv(S), S and P are symmetric
+        K = np.linalg.solve(S, P[:, :4, :]).transpose(0, 2, 1)
+        x = x + np.matmul(K, y[:, :, None])[:, :, 0]
+        # Joseph form P = (I-KH)P(I-KH)' + KRK'
+        I_KH = np.tile(np.eye(7), (len(slots), 1, 1))
+        I_KH[:, :, :4] -= K
+        P = (np.matmul(np.matmul(I_KH, P), I_KH.transpose(0, 2, 1)) +
+             np.matmul(np.matmul(K, self.R), K.transpose(0, 2, 1)))
+        self.x[slots] = x
+        self.P[slots] = P
+
+    def bboxes(self, slots):
+        """
+    Returns the (N, 4) bounding box estimates of the filters of slots.
+    """
+        return convert_xs_to_bboxes(self.x[slots])
+
+    def uncertainty(self, slots):
+        """
+    Returns the (N,) standard deviation of the box centres of the filters of
+    slots, relative to the side of their boxes.
+    """
+        x = self.x[slots]
+        P = self.P[slots]
+        side = np.sqrt(np.maximum(x[:, 2], 1.0))
+        return np.sqrt(P[:, 0, 0] + P[:, 1, 1]) / side
+
+    def gating_distance(self, slots, z):
+        """
+    Returns the (N, M) squared Mahalanobis distances between the filters of
+    slots and the (M, 4) [x,y,s,r] measurements z.
+    """
+        S = self.P[slots][:, :4, :4] + self.R
+        y = z[None, :, :] - self.x[slots][:, None, :4]
+        return np.einsum('nmi,nij,nmj->nm', y, np.linalg.inv(S), y)
+
+
+class TrackAppearance(object):
+    """
+  Reference crops of a track and their embeddings.
+
+    At most max_crops crops are kept, the ones with the highest quality. Crops
+    are referenced by their crop store key and embeddings may arrive from
+    another thread, after the crop was saved.
+  """
+
+    def __init__(self, max_crops=None):
+        if max_crops is not None and max_crops < 1:
+            raise ValueError(
+                "max_crops must be positive, got {}".format(max_crops))
+        self.max_crops = max_crops
+        # min heap of (quality, order, key) of the kept crops
+        self._crops = []
+        self._order = 0
+        self._features = dict()
+        # Running aggregate of the embeddings of all of the track's crops
+        self.feat_sum = None
+        self._lock = threading.Lock()
+
+    def save_crop(self, key, quality=0.0):
+        """
+    Keeps a crop, returns the key of the crop dropped to stay within
+    max_crops (possibly key itself) or None.
+    """
+        with self._lock:
+            entry = (quality, self._order, key)
+            self._order += 1
+            if self.max_crops is None or len(self._crops) < self.max_crops:
+                heapq.heappush(self._crops, entry)
+                return None
+            if quality <= self._crops[0][0]:
+                return key
+            dropped = heapq.heapreplace(self._crops, entry)[2]
+            self._features.pop(dropped, None)
+            return dropped
+
+    def add_features(self, feats, keys):
+        """
+    Adds the (N, D) embeddings of the crops of keys.
+    """
+        feats = np.asarray(feats, dtype=np.float32)
+        if len(feats) == 0:
+            return
+        with self._lock:
+            if self.feat_sum is None:
+                self.feat_sum = feats.sum(axis=0)
+            else:
+                self.feat_sum = self.feat_sum + feats.sum(axis=0)
+            kept = set(entry[2] for entry in self._crops)
+            for feat, key in zip(feats, keys):
+                if key in kept:
+                    self._features[key] = feat
+
+    def _kept(self):
+        return sorted(self._crops, key=lambda e: e[1])
+
+    @property
+    def crop_keys(self):
+        """
+    Returns the keys of the kept crops, oldest first.
+    """
+        with self._lock:
+            return [entry[2] for entry in self._kept()]
+
+    @property
+    def crop_qualities(self):
+        """
+    Returns the qualities of the kept crops, in the order of crop_keys.
+    """
+        with self._lock:
+            return [entry[0] for entry in self._kept()]
+
+    @property
+    def features(self):
+        """
+    Returns the embeddings of the kept crops that were featurized, oldest first.
+    """
+        return self.scored_features()[0]
+
+    def scored_features(self):
+        """
+    Returns the embeddings of the kept crops that were featurized and the
+    qualities of those crops, oldest first.
+    """
+        with self._lock:
+            kept = [entry for entry in self._kept() if entry[2] in self._features]
+            return ([self._features[entry[2]] for entry in kept],
+                    [entry[0] for entry in kept])
+
+    @property
+    def mean_feature(self):
+        """
+    Returns the L2 normalized mean embedding of the track, None if it has none.
+    """
+        feat_sum = self.feat_sum
+        if feat_sum is None:
+            return None
+        return feat_sum / max(np.linalg.norm(feat_sum), 1e-12)
+
+
+class TrackSummary(object):
+    """
+  What is kept of a track once it died: its id, span and appearance.
+
+    The appearance is shared with the dead tracker, so embeddings of its crops
+    still being computed are added to the summary.
+  """
+
+    def __init__(self, tracker):
+        self.id = tracker.id
+        self.first_frame = tracker.first_frame
+        self.last_frame = tracker.last_frame
+        self.hits = tracker.hits
+        self.appearance = tracker.appearance
+
+    def to_dict(self):
+        """
+    Returns the summary as a JSON serializable dict.
+    """
+        mean_feature = self.appearance.mean_feature
+        return {
+            "id": int(self.id),
+            "first_frame": int(self.first_frame),
+            "last_frame": int(self.last_frame),
+            "hits": int(self.hits),
+            "crop_keys": [int(key) for key in self.appearance.crop_keys],
+            "mean_feature":
+            None if mean_feature is None else mean_feature.tolist(),
+        }
+
+
 class KalmanBoxTracker(object):
     """
   This class represents the internel state of individual tracked objects observed as bbox.
+
+    The Kalman filter of the track is a slot of a KalmanBoxStore shared with
+    the other tracks of its Sort.
   """
 
     count = 1
 
-    def __init__(self, bbox):
-        """
-    Initialises a tracker using initial bounding box.
-    """
-        # define constant velocity model
-        self.kf = KalmanFilter(dim_x=7, dim_z=4)
-        self.kf.F = np.array([
-            [1, 0, 0, 0, 1, 0, 0],
-            [0, 1, 0, 0, 0, 1, 0],
-            [0, 0, 1, 0, 0, 0, 1],
-            [0, 0, 0, 1, 0, 0, 0],
-            [0, 0, 0, 0, 1, 0, 0],
-            [0, 0, 0, 0, 0, 1, 0],
-            [0, 0, 0, 0, 0, 0, 1],
-        ])
-        self.kf.H = np.array([
-            [1, 0, 0, 0, 0, 0, 0],
-            [0, 1, 0, 0, 0, 0, 0],
-            [0, 0, 1, 0, 0, 0, 0],
-            [0, 0, 0, 1, 0, 0, 0],
-        ])
-
-        self.kf.R[2:, 2:] *= 10.0
-        self.kf.P[
-            4:,
-            4:] *= 1000.0  # give high uncertainty to the unobservable initial velocities
-        self.kf.P *= 10.0
-        self.kf.Q[-1, -1] *= 0.01
-        self.kf.Q[4:, 4:] *= 0.01
-
-        self.kf.x[:4] = convert_bbox_to_z(bbox)
+    def __init__(self,
+                 bbox,
+                 store=None,
+                 track_id=None,
+                 frame=0,
+                 max_crops=None,
+                 embedding_budget=100):
+        """
+    Initialises a tracker using initial bounding box [x1,y1,x2,y2(,score)].
+    Without a track_id the id is taken from the process wide count.
+    """
+        self.store = store if store is not None else KalmanBoxStore(1)
+        self.slot = self.store.add(convert_bbox_to_z(bbox))
+        # state kept once the track released its slot
+        self._x = None
         self.time_since_update = 0
-        self.id = KalmanBoxTracker.count
-        KalmanBoxTracker.count += 1
+        if track_id is None:
+            track_id = KalmanBoxTracker.count
+            KalmanBoxTracker.count += 1
+        self.id = track_id
 
         self.history = []
         self.hits = 0
         self.hit_streak = 0
         self.age = 0
+        self.first_frame = frame
+        self.last_frame = frame
+        # score of the last detection assigned to the track
+        self.score = float(bbox[4]) if len(bbox) > 4 else 1.0
+
+        self.appearance = TrackAppearance(max_crops)
+        # embeddings of the latest detections, for appearance association
+        self.embeddings = collections.deque(maxlen=embedding_budget)
 
-        self.reid = list()
-        self.imgfiles = list()
+    @property
+    def x(self):
+        """
+    Returns the [x,y,s,r,vx,vy,vs] state vector of the track.
+    """
+        if self.slot is None:
+            return self._x
+        return self.store.x[self.slot]
 
     def update(self, bbox):
         """
     Updates the state vector with observed bbox.
     """
+        self.store.update([self.slot], convert_bboxes_to_z([bbox]))
+        self.mark_updated(self.last_frame + 1,
+                          bbox[4] if len(bbox) > 4 else self.score)
+
+    def mark_updated(self, frame, score):
+        """
+    Updates the track counters after its filter was corrected with a
+    detection of confidence score on frame.
+    """
+        self.last_frame = frame
+        self.score = float(score)
         self.time_since_update = 0
         self.history = []
         self.hits += 1
         self.hit_streak += 1
-        self.kf.update(convert_bbox_to_z(bbox))
 
     def predict(self):
         """
     Advances the state vector and returns the predicted bounding box estimate.
     """
-        if (self.kf.x[6] + self.kf.x[2]) <= 0:
-            self.kf.x[6] *= 0.0
-        self.kf.predict()
+        return self.mark_predicted(self.store.predict([self.slot])[0])
+
+    def mark_predicted(self, bbox):
+        """
+    Updates the track counters after its filter predicted bbox.
+    """
         self.age += 1
         if self.time_since_update > 0:
             self.hit_streak = 0
         self.time_since_update += 1
-        self.history.append(convert_x_to_bbox(self.kf.x))
+        self.history.append(np.reshape(bbox, (1, 4)))
         return self.history[-1]
 
     def get_state(self):
         """
     Returns the current bounding box estimate.
     """
-        return convert_x_to_bbox(self.kf.x)
+        return convert_x_to_bbox(self.x)
+
+    def release(self):
+        """
+    Copies the state out of the store and frees the slot of the track.
+    """
+        if self.slot is not None:
+            self._x = self.store.x[self.slot].copy()
+            self.store.release(self.slot)
+            self.slot = None
+
+
+
+def gated_assignment(scores, gate):
+    """
+    Maximises the total score (IOU or similarity in [-1, 1]) of a one to one
+    assignment restricted to the gated pairs
+
+    The bipartite graph of the gated pairs is split into connected components
+    that are solved independently. Components with a single pair are matched
+    directly and only the others go through the Hungarian solver.
+
+    Returns a (K, 2) array of matched [detection, tracker] indices
+    """
+    dets, trks = np.nonzero(gate)
+    if len(dets) == 0:
+        return np.empty((0, 2), dtype=int)
+    # Fast path: no detection or tracker is part of more than one gated pair
+    if (np.all(np.bincount(dets) <= 1) and np.all(np.bincount(trks) <= 1)):
+        return np.stack((dets, trks), axis=1)
+
+    num_dets, num_trks = gate.shape
+    graph = coo_matrix((np.ones(len(dets)), (dets, num_dets + trks)),
+                       shape=(num_dets + num_trks, num_dets + num_trks))
+    _, labels = connected_components(graph, directed=False)
+    det_labels = labels[:num_dets]
+    trk_labels = labels[num_dets:]
 
-    def save_img(self, name):
-        self.imgfiles.append(name)
+    matches = []
+    for label in np.unique(det_labels[dets]):
+        comp_dets = np.flatnonzero(det_labels == label)
+        comp_trks = np.flatnonzero(trk_labels == label)
+        if len(comp_dets) == 1 and len(comp_trks) == 1:
+            matches.append([[comp_dets[0], comp_trks[0]]])
+            continue
+        comp_gate = gate[np.ix_(comp_dets, comp_trks)]
+        # Pairs outside the gate get a cost no gated assignment can reach
+        cost = np.where(comp_gate, -scores[np.ix_(comp_dets, comp_trks)],
+                        len(comp_dets) + len(comp_trks))
+        rows, cols = linear_sum_assignment(cost)
+        keep = comp_gate[rows, cols]
+        matches.append(
+            np.stack((comp_dets[rows[keep]], comp_trks[cols[keep]]), axis=1))
+    return np.concatenate(matches, axis=0).astype(int)
 
 
 def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3):
@@ -179,106 +532,297 @@ def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3):
         return (
             np.empty((0, 2), dtype=int),
             np.arange(len(detections)),
-            np.empty((0, 5), dtype=int),
+            np.empty((0, ), dtype=int),
         )
-    iou_matrix = np.zeros((len(detections), len(trackers)), dtype=np.float32)
-
-    for d, det in enumerate(detections):
-        for t, trk in enumerate(trackers):
-            iou_matrix[d, t] = iou(det, trk)
-    matched_indices = linear_assignment(-iou_matrix)
-
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if d not in matched_indices[:, 0]:
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if t not in matched_indices[:, 1]:
-            unmatched_trackers.append(t)
-
-    # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if iou_matrix[m[0], m[1]] < iou_threshold:
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if len(matches) == 0:
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
+    if len(detections) == 0:
+        return (
+            np.empty((0, 2), dtype=int),
+            np.empty((0, ), dtype=int),
+            np.arange(len(trackers)),
+        )
+    iou_matrix = iou_batch(detections, trackers)
+    # pairs with low IOU can't be matched
+    matches = gated_assignment(iou_matrix, iou_matrix >= iou_threshold)
+
+    matched_detections = np.zeros(len(detections), dtype=bool)
+    matched_detections[matches[:, 0]] = True
+    matched_trackers = np.zeros(len(trackers), dtype=bool)
+    matched_trackers[matches[:, 1]] = True
+
+    return matches, np.flatnonzero(~matched_detections), np.flatnonzero(
+        ~matched_trackers)
+
+
+def associate_detections_with_appearance(detections,
+                                         trackers,
+                                         gating_distances,
+                                         similarities,
+                                         ages,
+                                         confirmed,
+                                         max_age,
+                                         iou_threshold=0.3,
+                                         max_cosine_distance=0.2):
+    """
+    Assigns detections to tracked objects by appearance, then by IOU (DeepSORT)
+
+    Confirmed trackers are matched first by a cascade over their age, the
+    trackers seen most recently being matched first. A pair can only match if
+    the detection is within the Mahalanobis gate of the tracker or overlaps it
+    by iou_threshold, and their cosine distance is at most
+    max_cosine_distance. The trackers left that are unconfirmed or were seen
+    on the previous frame are then matched by IOU.
+
+    Params:
+    detections, trackers - (M, 4+) and (N, 4+) bounding boxes
+    gating_distances - (M, N) squared Mahalanobis distances
+    similarities - (M, N) cosine similarities, -inf for trackers without embeddings
+    ages - (N,) frames since each tracker was last updated, at least 1
+    confirmed - (N,) whether each tracker is confirmed
 
-    return matches, np.array(unmatched_detections), np.array(
-        unmatched_trackers)
+    Returns 3 lists of matches, unmatched_detections and unmatched_trackers
+    """
+    unmatched_dets = np.ones(len(detections), dtype=bool)
+    unmatched_trks = np.ones(len(trackers), dtype=bool)
+    matches = [np.empty((0, 2), dtype=int)]
+
+    def match(dets, trks, scores, gate):
+        pairs = gated_assignment(scores, gate)
+        pairs = np.stack((dets[pairs[:, 0]], trks[pairs[:, 1]]), axis=1)
+        unmatched_dets[pairs[:, 0]] = False
+        unmatched_trks[pairs[:, 1]] = False
+        matches.append(pairs)
+
+    iou_matrix = iou_batch(detections, trackers)
+    gate = (((gating_distances <= CHI2INV95_4DOF) |
+             (iou_matrix >= iou_threshold)) &
+            (similarities >= 1.0 - max_cosine_distance))
+    for age in range(1, max_age + 2):
+        dets = np.flatnonzero(unmatched_dets)
+        trks = np.flatnonzero(confirmed & (ages == age) & unmatched_trks)
+        if len(dets) == 0:
+            break
+        if len(trks) > 0:
+            match(dets, trks, similarities[np.ix_(dets, trks)],
+                  gate[np.ix_(dets, trks)])
+
+    dets = np.flatnonzero(unmatched_dets)
+    trks = np.flatnonzero(unmatched_trks & (~confirmed | (ages == 1)))
+    if len(dets) > 0 and len(trks) > 0:
+        iou_matrix = iou_matrix[np.ix_(dets, trks)]
+        match(dets, trks, iou_matrix, iou_matrix >= iou_threshold)
+
+    return (np.concatenate(matches, axis=0), np.flatnonzero(unmatched_dets),
+            np.flatnonzero(unmatched_trks))
 
 
 class Sort(object):
-    def __init__(self, max_age=1, min_hits=3):
+    def __init__(self,
+                 max_age=1,
+                 min_hits=3,
+                 max_crops=None,
+                 on_finish=None,
+                 max_cosine_distance=0.2,
+                 embedding_budget=100):
         """
     Sets key parameters for SORT
+
+    max_crops caps the reference crops kept per track, None keeps them all.
+    on_finish is called with the TrackSummary of every track that dies, after
+    which the tracker is dropped. Without it dead trackers are kept in rejects.
+    max_cosine_distance and embedding_budget only apply when update is given
+    detection embeddings: the largest cosine distance of an appearance match
+    and the number of latest embeddings kept per track.
     """
         self.max_age = max_age
         self.min_hits = min_hits
+        self.max_crops = max_crops
+        self.on_finish = on_finish
+        self.max_cosine_distance = max_cosine_distance
+        self.embedding_budget = embedding_budget
         self.trackers = []
         self.frame_count = 0
+        self.kalman = KalmanBoxStore()
+        # track ids are only unique within a Sort
+        self._ids = itertools.count(1)
 
         self.rejects = []
 
-    def update(self, dets):
+    def _finish(self, trk):
+        trk.release()
+        if self.on_finish is None:
+            self.rejects.append(trk)
+        else:
+            self.on_finish(TrackSummary(trk))
+
+    def finish_all(self):
+        """
+        Finishes every live track, e.g. at the end of a stream
+        """
+        for trk in self.trackers:
+            self._finish(trk)
+        self.trackers = []
+
+    def _similarities(self, embeddings):
+        """
+        Returns the (M, N) largest cosine similarity of each detection embedding
+        to the embeddings of each tracker, -inf for trackers without any
+        """
+        similarities = np.full((len(embeddings), len(self.trackers)), -np.inf)
+        counts = np.array([len(trk.embeddings) for trk in self.trackers],
+                          dtype=int)
+        have = np.flatnonzero(counts > 0)
+        if len(embeddings) == 0 or len(have) == 0:
+            return similarities
+        gallery = np.concatenate(
+            [np.asarray(self.trackers[t].embeddings) for t in have])
+        offsets = np.concatenate(([0], np.cumsum(counts[have])[:-1]))
+        similarities[:, have] = np.maximum.reduceat(
+            np.dot(embeddings, gallery.T), offsets, axis=1)
+        return similarities
+
+    def update(self, dets, frame=None, embeddings=None):
         """
         Params:
         dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
+        frame - index of the frame of the detections, defaults to the number of update calls
+        embeddings - optional (M, D) L2 normalized appearance embeddings of the
+          detections. When given, detections are associated DeepSORT style
+          by appearance within a Mahalanobis gate before falling back to IOU
         Requires: this method must be called once for each frame even with empty detections.
         Returns the a similar array, where the last column is the object ID.
 
         NOTE: The number of objects returned may differ from the number of detections provided.
         """
         self.frame_count += 1
+        if frame is None:
+            frame = self.frame_count
 
         # get predicted locations from existing trackers.
+        slots = np.array([trk.slot for trk in self.trackers], dtype=int)
         trks = np.zeros((len(self.trackers), 5))
-        to_del = []
         ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict()[0]
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-            if np.any(np.isnan(pos)):
-                to_del.append(t)
-        trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-        for t in reversed(to_del):
-            self.trackers.pop(t)
-        matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(
-            dets, trks)
+        trks[:, :4] = self.kalman.predict(slots)
+        for trk, pos in zip(self.trackers, trks):
+            trk.mark_predicted(pos[:4].copy())
+        valid = np.all(np.isfinite(trks), axis=1)
+        if not np.all(valid):
+            for trk, keep in zip(self.trackers, valid):
+                if not keep:
+                    self._finish(trk)
+            trks = trks[valid]
+            slots = slots[valid]
+            self.trackers = [
+                trk for trk, keep in zip(self.trackers, valid) if keep
+            ]
+        if embeddings is None:
+            matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(
+                dets, trks)
+        else:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            matched, unmatched_dets, unmatched_trks = associate_detections_with_appearance(
+                dets,
+                trks,
+                self.kalman.gating_distance(
+                    slots, convert_bboxes_to_z(dets[:, :4])).T,
+                self._similarities(embeddings),
+                np.array([trk.time_since_update for trk in self.trackers],
+                         dtype=int),
+                np.array([trk.hits >= self.min_hits for trk in self.trackers],
+                         dtype=bool),
+                self.max_age,
+                max_cosine_distance=self.max_cosine_distance)
 
         # update matched trackers with assigned detections
-        for t, trk in enumerate(self.trackers):
-            if t not in unmatched_trks:
-                d = matched[np.where(matched[:, 1] == t)[0], 0]
-                trk.update(dets[d, :][0])
+        self.kalman.update(slots[matched[:, 1]],
+                           convert_bboxes_to_z(dets[matched[:, 0], :4]))
+        scores = dets[:, 4] if dets.shape[1] > 4 else np.ones(len(dets))
+        for d, t in matched:
+            self.trackers[t].mark_updated(frame, scores[d])
+            if embeddings is not None:
+                self.trackers[t].embeddings.append(embeddings[d])
 
         rettracks = list()
         newtracks = list()
         # create and initialise new trackers for unmatched detections
         for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :])
+            trk = KalmanBoxTracker(dets[i, :],
+                                   self.kalman,
+                                   track_id=next(self._ids),
+                                   frame=frame,
+                                   max_crops=self.max_crops,
+                                   embedding_budget=self.embedding_budget)
+            if embeddings is not None:
+                trk.embeddings.append(embeddings[i])
             self.trackers.append(trk)
             newtracks.append(trk)
-        i = len(self.trackers)
-        for trk in reversed(self.trackers):
-            d = trk.get_state()[0]
+        states = self.kalman.bboxes(
+            np.array([trk.slot for trk in self.trackers], dtype=int))
+        for trk, d in zip(reversed(self.trackers), states[::-1]):
             if (trk.time_since_update <
                     1) and (trk.hit_streak >= self.min_hits
                             or self.frame_count <= self.min_hits):
                 ret.append(np.concatenate((d, [trk.id])).reshape(
                     1, -1))  # +1 as MOT benchmark requires positive
                 rettracks.append(trk)
-            i -= 1
             # remove dead tracklet
             if trk.time_since_update > self.max_age:
-                temprej = self.trackers.pop(i)
-                self.rejects.append(temprej)
+                self._finish(trk)
+        self.trackers = [
+            trk for trk in self.trackers
+            if trk.time_since_update <= self.max_age
+        ]
         if len(ret) > 0:
             return np.concatenate(ret), rettracks, newtracks
         return np.empty((0, 5)), rettracks, newtracks
+
+    def coast(self, boxes=None):
+        """
+        Advances the tracks on a frame the detector skipped
+
+        Params:
+        boxes - optional (N, 4) [x1,y1,x2,y2] estimates of the live tracks, e.g.
+          from optical flow, in the order of self.trackers with NaN rows for
+          tracks without an estimate. They correct the filters but don't
+          count as hits
+        A skipped frame is not a miss: time_since_update, hits and max_age only
+        change on frames with detections.
+        Returns the tracks update would output, at their predicted locations,
+        and their trackers.
+        """
+        self.frame_count += 1
+        slots = np.array([trk.slot for trk in self.trackers], dtype=int)
+        states = self.kalman.predict(slots)
+        if boxes is not None:
+            boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+            found = np.all(np.isfinite(boxes), axis=1)
+            self.kalman.update(slots[found], convert_bboxes_to_z(boxes[found]))
+            states = self.kalman.bboxes(slots)
+        ret = []
+        rettracks = list()
+        for trk, d in zip(reversed(self.trackers), states[::-1]):
+            trk.age += 1
+            if not np.all(np.isfinite(d)):
+                continue
+            if (trk.time_since_update <
+                    1) and (trk.hit_streak >= self.min_hits
+                            or self.frame_count <= self.min_hits):
+                ret.append(np.concatenate((d, [trk.id])).reshape(1, -1))
+                rettracks.append(trk)
+        if len(ret) > 0:
+            return np.concatenate(ret), rettracks
+        return np.empty((0, 5)), rettracks
+
+    def uncertainty(self):
+        """
+        Returns the (N,) relative uncertainty of the position of the live
+        tracks, see KalmanBoxStore.uncertainty
+        """
+        return self.kalman.uncertainty(
+            np.array([trk.slot for trk in self.trackers], dtype=int))
+
+    def bboxes(self):
+        """
+        Returns the (N, 4) current bounding boxes of the live tracks
+        """
+        return self.kalman.bboxes(
+            np.array([trk.slot for trk in self.trackers], dtype=int))
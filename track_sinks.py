@@ -0,0 +1,83 @@
+'''
+Sinks receiving the summaries of finished SORT tracks
+
+A sink is any callable taking a TrackSummary, so it can be given to
+Sort(on_finish=...) directly.
+'''
+
+import json
+
+
+class ListSink:
+    """
+    Keeps the summaries in memory
+
+    Attributes:
+    summaries (list): TrackSummary of each finished track, in finishing order
+    """
+    def __init__(self):
+        self.summaries = list()
+
+    def __call__(self, summary):
+        self.summaries.append(summary)
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """
+    Writes each summary as one JSON line
+
+    The mean embedding written is the one known when the track finished,
+    embeddings still being computed online are not included.
+
+    Attributes:
+    path (str): path of the JSON lines file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a")
+
+    def __call__(self, summary):
+        self._file.write(json.dumps(summary.to_dict()) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class QueueSink:
+    """
+    Puts the summaries on a queue consumed by another thread or process
+
+    Attributes:
+    queue (queue.Queue): queue receiving the summaries
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, summary):
+        self.queue.put(summary)
+
+    def close(self):
+        pass
+
+
+class TeeSink:
+    """
+    Hands each summary to several sinks
+
+    Attributes:
+    sinks (list): sinks receiving every summary
+    """
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def __call__(self, summary):
+        for sink in self.sinks:
+            sink(summary)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
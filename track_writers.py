@@ -0,0 +1,141 @@
+'''
+Buffered output of the tracks found in a camera
+
+Track rows are frame index, track id, x1, y1, x2, y2. They are appended to
+preallocated chunks that are optionally spilled to .npy segments, and are only
+formatted once, when the results are written.
+'''
+
+import os
+import tempfile
+import numpy as np
+from constants import TRACK_WRITER_CHUNK_ROWS
+
+TRACK_FORMAT_CHOICES = ['txt', 'npy']
+TRACK_COLUMNS = 6
+
+
+def remap_ids(ids, mapping):
+    """
+    Replaces ids with their value in mapping, ids missing from mapping are kept
+
+    Parameters:
+    ids (ndarray): ids to remap
+    mapping (dict): new id of some of the ids
+
+    Returns:
+    ndarray: remapped copy of ids
+    """
+    ids = np.asarray(ids)
+    if len(mapping) == 0 or ids.size == 0:
+        return ids.copy()
+    keys = np.fromiter(mapping.keys(), dtype=np.float64, count=len(mapping))
+    values = np.fromiter(mapping.values(),
+                         dtype=np.float64,
+                         count=len(mapping))
+    order = np.argsort(keys)
+    keys = keys[order]
+    values = values[order]
+    # Look up every id at once in the sorted keys
+    positions = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+    found = keys[positions] == ids
+    return np.where(found, values[positions], ids).astype(ids.dtype)
+
+
+class TrackWriter:
+    """
+    Collects the track rows of one camera
+
+    Attributes:
+    chunk_rows (int): rows per chunk
+    spill_dir (str): directory full chunks are saved to, None keeps them in memory
+    """
+    def __init__(self, chunk_rows=TRACK_WRITER_CHUNK_ROWS, spill_dir=None):
+        if chunk_rows < 1:
+            raise ValueError(
+                "chunk_rows must be positive, got {}".format(chunk_rows))
+        self.chunk_rows = chunk_rows
+        self.spill_dir = spill_dir
+        # Full chunks, arrays or paths of spilled segments
+        self._chunks = list()
+        self._buffer = np.empty((chunk_rows, TRACK_COLUMNS), dtype=np.float64)
+        self._size = 0
+
+    def append(self, findex, tracks):
+        """
+        Adds the tracks of a frame
+
+        Parameters:
+        findex (int): frame index
+        tracks (ndarray): (N, 5) Sort output, one x1, y1, x2, y2, id row per track
+        """
+        tracks = np.asarray(tracks, dtype=np.float64).reshape(-1, 5)
+        rows = np.empty((len(tracks), TRACK_COLUMNS), dtype=np.float64)
+        rows[:, 0] = findex
+        rows[:, 1] = tracks[:, 4]
+        # Boxes are kept in whole pixels
+        rows[:, 2:] = np.trunc(tracks[:, :4])
+        start = 0
+        while start < len(rows):
+            count = min(len(rows) - start, self.chunk_rows - self._size)
+            end = self._size + count
+            self._buffer[self._size:end] = rows[start:start + count]
+            self._size = end
+            start += count
+            if self._size == self.chunk_rows:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        chunk = self._buffer[:self._size]
+        if self.spill_dir is not None:
+            fd, path = tempfile.mkstemp(suffix='.npy', dir=self.spill_dir)
+            with os.fdopen(fd, 'wb') as segment:
+                np.save(segment, chunk)
+            self._chunks.append(path)
+        else:
+            self._chunks.append(self._buffer)
+            self._buffer = np.empty_like(self._buffer)
+        self._size = 0
+
+    def __len__(self):
+        return len(self._chunks) * self.chunk_rows + self._size
+
+    def rows(self):
+        """Returns the (N, 6) frame index, id, x1, y1, x2, y2 rows"""
+        chunks = [
+            np.load(chunk) if isinstance(chunk, str) else chunk
+            for chunk in self._chunks
+        ]
+        chunks.append(self._buffer[:self._size])
+        return np.concatenate(chunks, axis=0)
+
+    def write(self, path, fmt='txt', mapping=None):
+        """
+        Writes all the rows at once
+
+        Parameters:
+        path (str): output file
+        fmt (str): 'txt' for space separated text, 'npy' for a numpy array
+        mapping (dict): new id of some track ids, e.g. their re-id
+
+        Returns:
+        ndarray: the rows written
+        """
+        rows = self.rows()
+        if mapping:
+            rows[:, 1] = remap_ids(rows[:, 1], mapping)
+        if fmt == 'txt':
+            np.savetxt(path, rows)
+        elif fmt == 'npy':
+            np.save(path, rows)
+        else:
+            raise ValueError("unknown track format {}".format(fmt))
+        return rows
+
+    def close(self):
+        """Removes the spilled segments"""
+        for chunk in self._chunks:
+            if isinstance(chunk, str) and os.path.exists(chunk):
+                os.remove(chunk)
+        self._chunks = list()
+        self._size = 0
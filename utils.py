@@ -1,3 +1,7 @@
+import numpy as np
+from constants import CROP_QUALITY_ASPECT_RATIO, CROP_QUALITY_FULL_AREA
+
+
 def crop_image(img, box):
     x = box[0][0]
     w = box[1][0] - box[0][0]
@@ -7,6 +11,51 @@ def crop_image(img, box):
     return cropped
 
 
+def crop_quality(box, score=1.0):
+    """
+    Rates how useful the crop of a person box is as a re-id reference
+
+    Parameters:
+    box (tuple): ((x1, y1), (x2, y2)) person box
+    score (float): detection confidence of the box
+
+    Returns:
+    float: quality in [0, 1], the product of the aspect ratio closeness, the
+           size of the box relative to the MGN input and score
+    """
+    w = max(box[1][0] - box[0][0], 1)
+    h = max(box[1][1] - box[0][1], 1)
+    aspect = np.exp(-abs(np.log(h / w / CROP_QUALITY_ASPECT_RATIO)))
+    size = min(w * h / CROP_QUALITY_FULL_AREA, 1.0)
+    return float(aspect * size * score)
+
+
+def bounding_region(regions):
+    """
+    Returns the region holding several regions
+
+    Parameters:
+    regions (list): 2D lists [[x1, y1], [x2, y2]] of region coordinates
+
+    Returns:
+    tuple: x1, y1, x2, y2 of the bounding region
+    """
+    coords = np.asarray(regions).reshape(-1, 4)
+    return (int(coords[:, 0].min()), int(coords[:, 1].min()),
+            int(coords[:, 2].max()), int(coords[:, 3].max()))
+
+
+def intersect_regions(first, second):
+    """
+    Returns the overlap of two x1, y1, x2, y2 regions, None when they don't overlap
+    """
+    x1, y1 = max(first[0], second[0]), max(first[1], second[1])
+    x2, y2 = min(first[2], second[2]), min(first[3], second[3])
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2, y2)
+
+
 # TODO: (nhendy) this is not normalized?
 def unitdotprod(vec1, vec2):
     return np.dot(vec1, np.transpose(vec2))